@@ -15,8 +15,97 @@ SUPPORTED_AUDIO_FILETYPES = (
 SUPPORTED_AUDIO_EXTENSIONS = [ filetype[0] for filetype in SUPPORTED_AUDIO_FILETYPES ]
 
 #Note that you can change this to any function you want, any
-#time hashing is used by Melodia, this function is referenced
+#time hashing is used by Melodia, this function is referenced. It must
+#return an object with the hashlib interface (update() and hexdigest()).
+#Files are hashed in chunks of HASH_CHUNK_SIZE bytes. A cheap fingerprint
+#(size, mtime and the first/last FINGERPRINT_BLOCK_SIZE bytes) is checked
+#before the full hash, and both are stored in HASH_RESULT_DB_TYPE.
+import hashlib
 import django.db.models.fields
 
-HASH_FUNCTION       = hash
-HASH_RESULT_DB_TYPE = django.db.models.fields.IntegerField(default =  -1)
+HASH_FUNCTION          = hashlib.sha1
+HASH_CHUNK_SIZE        = 1024 * 1024
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+HASH_RESULT_DB_TYPE    = django.db.models.fields.CharField(max_length = 300, default = None, null = True)
+
+#Metadata extraction during a scan is fanned out over this many workers.
+#Threads are used by default since tag parsing is bound by file access, set
+#METADATA_USE_PROCESSES to use a process pool instead.
+METADATA_WORKERS       = 4
+METADATA_USE_PROCESSES = False
+
+#Scans and metadata refreshes write songs in transactions of this many rows.
+#The achieved rows/sec is logged to the "archiver.batch" logger for tuning.
+ARCHIVER_BATCH_SIZE = 500
+
+#The archive watcher applies changes once no new events have arrived for
+#WATCHER_COALESCE_DELAY seconds, or at the latest WATCHER_MAX_DELAY seconds
+#after the first one. Folders that can't get an inotify watch are swept every
+#WATCHER_SWEEP_INTERVAL seconds instead.
+WATCHER_COALESCE_DELAY = 2
+WATCHER_MAX_DELAY      = 30
+WATCHER_SWEEP_INTERVAL = 300
+
+#Number of files copied in parallel when backing up to a local folder
+BACKUP_WORKERS = 4
+
+#Maximum number of files whose parsed metadata is kept in the on-disk
+#metadata cache (CACHE_DIR/metadata.sqlite). Set to 0 to disable the cache.
+METADATA_CACHE_SIZE = 500000
+
+#Dotted path to the full-text search backend class. None picks SQLite FTS5
+#when available, and a (slow) LIKE-based fallback otherwise.
+SEARCH_BACKEND = None
+
+#Podcast episodes are downloaded over at most DOWNLOAD_WORKERS connections at
+#once, and written to disk in chunks of DOWNLOAD_CHUNK_SIZE bytes. Requests
+#that get no response for DOWNLOAD_TIMEOUT seconds are abandoned.
+DOWNLOAD_WORKERS    = 4
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT    = 30
+
+#The feed scheduler syncs up to FEED_SYNC_WORKERS feeds at once, and at most
+#FEED_SYNC_PER_HOST from the same host. Feeds are checked about twice per
+#episode they publish, but no more often than FEED_SYNC_MIN_INTERVAL seconds
+#and no less often than FEED_SYNC_MAX_INTERVAL. Failing feeds back off
+#exponentially up to FEED_SYNC_MAX_BACKOFF seconds, and every delay is varied
+#by up to FEED_SYNC_JITTER (a fraction) either way.
+FEED_SYNC_WORKERS      = 8
+FEED_SYNC_PER_HOST     = 2
+FEED_SYNC_MIN_INTERVAL = 30 * 60
+FEED_SYNC_MAX_INTERVAL = 24 * 60 * 60
+FEED_SYNC_MAX_BACKOFF  = 24 * 60 * 60
+FEED_SYNC_JITTER       = 0.2
+
+#Podcast feeds are parsed incrementally, stopping after the episodes that
+#were already downloaded. Set to False to always parse whole feeds with
+#feedparser.
+FEED_STREAMING_PARSE = True
+
+#Songs are streamed to the web client in chunks of STREAM_CHUNK_SIZE bytes.
+#Set STREAM_SENDFILE_HEADER (e.g. "X-Sendfile") to have the front-end web
+#server send files itself instead. A response from the start of a song that
+#sends more than STREAM_PLAY_FRACTION of it counts as a play.
+STREAM_CHUNK_SIZE      = 64 * 1024
+STREAM_SENDFILE_HEADER = None
+STREAM_PLAY_FRACTION   = 0.5
+
+#Formats the web client may ask songs to be transcoded to, and the most disk
+#space (in bytes) finished transcodes may take up in CACHE_DIR/transcode.
+TRANSCODE_FORMATS    = ('mp3', 'ogg')
+TRANSCODE_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+#Cover art is stored once per distinct image in CACHE_DIR/covers, along with
+#square thumbnails of each of THUMBNAIL_SIZES pixels saved as THUMBNAIL_FORMAT
+#(a PIL format name). Covers are extracted by THUMBNAIL_WORKERS processes.
+THUMBNAIL_SIZES   = (64, 150, 300)
+THUMBNAIL_FORMAT  = "JPEG"
+THUMBNAIL_WORKERS = 4
+
+#Waveform peaks are stored in CACHE_DIR/waveforms, the finest level with one
+#peak per WAVEFORM_FRAMES_PER_PEAK frames and each further level halving that
+#until a level has at most WAVEFORM_MIN_PEAKS peaks. Songs are decoded by
+#WAVEFORM_WORKERS processes.
+WAVEFORM_FRAMES_PER_PEAK = 256
+WAVEFORM_MIN_PEAKS       = 64
+WAVEFORM_WORKERS         = 4
@@ -1061,25 +1061,153 @@ class DecodingError(IOError):
         self.error_message = error_message
 
 
+#the number of bytes read from the start of a file to identify its type
+SNIFF_SIZE = 64
+
+#identifies a file's type from its first SNIFF_SIZE bytes
+#each entry is a (tests, type names, confirm) tuple
+#where tests is a tuple of (offset, string) pairs which must all match,
+#type names are the AudioFile NAMEs the file may then be
+#and confirm is True if the candidate's is_type() must still accept
+#the file, for types a few magic bytes aren't enough to be sure of
+MAGIC_TABLE = ((((0, 'fLaC'),), ('flac',), True),
+               (((0, 'OggS'), (0x1C, '\x7FFLAC')), ('oga',), False),
+               (((0, 'OggS'), (0x1C, '\x01vorbis')), ('ogg',), False),
+               (((0, 'OggS'), (0x1C, 'Speex  ')), ('spx',), False),
+               (((0, 'RIFF'), (8, 'WAVE')), ('wav',), False),
+               (((0, 'RIFF'), (8, 'RMP3')), ('mp3',), False),
+               (((0, 'FORM'), (8, 'AIFF')), ('aiff',), False),
+               (((0, '.snd'),), ('au',), False),
+               (((0, 'wvpk'),), ('wv',), False),
+               (((0, 'ajkg'), (4, '\x02')), ('shn',), False),
+               (((4, 'ftyp'), (8, 'mp41')), ('m4a', 'alac'), True),
+               (((4, 'ftyp'), (8, 'mp42')), ('m4a', 'alac'), True),
+               (((4, 'ftyp'), (8, 'M4A ')), ('m4a', 'alac'), True),
+               (((4, 'ftyp'), (8, 'M4B ')), ('m4a', 'alac'), True))
+
+#types identified by MPEG audio frame headers rather than MAGIC_TABLE
+MPEG_FRAME_TYPES = ('mp3', 'mp2', 'aac')
+
+
+def __sniff_mpeg_frame__(header):
+    """Returns the type names of an MPEG audio frame header
+    at the start of the given string."""
+
+    if ((len(header) < 4) or (header[0] != '\xFF')):
+        return ()
+
+    flags = ord(header[1])
+    if (((flags & 0xFE) == 0xF8) and (len(header) >= 7)):
+        #12 bit sync, MPEG-2 ID and layer 0 is an AAC ADTS header
+        return ('aac',)
+    elif ((flags & 0xE0) == 0xE0):
+        #11 bit sync, followed by the MPEG version and layer
+        mpeg_version = (flags >> 3) & 0x3
+        layer = (flags >> 1) & 0x3
+        if (mpeg_version in (0x03, 0x02, 0x00)):
+            if (layer in (0x01, 0x03)):
+                return ('mp3',)
+            elif (layer == 0x02):
+                return ('mp2',)
+
+    return ()
+
+
+def __sniff_past_id3v2__(file, header):
+    """Returns a list of (type name, confirm) tuples
+    for the start of the audio following an ID3v2 tag.
+
+    header is the start of the file, beginning with the tag's header.
+    This peeks at the file just past the tag."""
+
+    if (len(header) < 10):
+        return []
+
+    #the tag's length is a 28 bit syncsafe integer
+    length = 0
+    for byte in header[6:10]:
+        length = (length << 7) | (ord(byte) & 0x7F)
+
+    file.seek(10 + length, 0)
+    peek = file.read(SNIFF_SIZE)
+    frame = peek.lstrip(chr(0))
+
+    if ((len(peek) == SNIFF_SIZE) and (len(frame) < 4)):
+        #more padding than we've read, so leave it to is_type()
+        return [("mp3", True), ("mp2", True)]
+    elif (frame.startswith('fLaC')):
+        #FlacAudio.is_type() rejects these, with a warning
+        return [("flac", True)]
+    else:
+        #only MP3 and MP2 look past ID3v2 tags
+        return [(name, False) for name in __sniff_mpeg_frame__(frame)
+                if (name != 'aac')]
+
+
+def sniff_types(file, filename=None):
+    """Returns a list of (AudioFile class, confirm) tuples
+    for the types the file may be, most likely first.
+
+    file is a seekable file object rewound to the start of the file.
+    Its first SNIFF_SIZE bytes are matched against MAGIC_TABLE,
+    with one more small read past an ID3v2 tag if there is one.
+    If confirm is True, the class's is_type() must accept the file
+    before it is opened as that type.
+    If filename is given, types with its suffix go first."""
+
+    header = file.read(SNIFF_SIZE)
+
+    candidates = []
+    for (tests, type_names, confirm) in MAGIC_TABLE:
+        if (all([header[offset:offset + len(magic)] == magic
+                 for (offset, magic) in tests])):
+            candidates.extend([(name, confirm) for name in type_names])
+
+    if (header.startswith('ID3')):
+        candidates.extend(__sniff_past_id3v2__(file, header))
+    else:
+        candidates.extend([(name, False) for name in
+                           __sniff_mpeg_frame__(header)])
+
+    #types we have no magic bytes for are probed by is_type() as before
+    sniffed = set(MPEG_FRAME_TYPES)
+    for (tests, type_names, confirm) in MAGIC_TABLE:
+        sniffed.update(type_names)
+    candidates.extend([(name, True) for name in TYPE_MAP.keys()
+                       if (name not in sniffed)])
+
+    types = [(TYPE_MAP[name], confirm) for (name, confirm) in candidates
+             if (name in TYPE_MAP)]
+
+    if (filename is not None):
+        suffix = os.path.splitext(filename)[1][1:].lower()
+        #a stable sort, so the table's order is kept otherwise
+        types.sort(key=lambda pair: pair[0].SUFFIX != suffix)
+
+    return types
+
+
 def open(filename):
     """Returns an AudioFile located at the given filename path.
 
     This works solely by examining the file's contents
     after opening it.
+    Its type is identified by sniff_types() from a single read
+    of its first bytes, rather than by trying every type's is_type().
     Raises UnsupportedFile if it's not a file we support based on its headers.
     Raises InvalidFile if the file appears to be something we support,
     but has errors of some sort.
     Raises IOError if some problem occurs attempting to open the file.
     """
 
-    available_types = frozenset(TYPE_MAP.values())
-
     f = file(filename, "rb")
     try:
-        for audioclass in TYPE_MAP.values():
-            f.seek(0, 0)
-            if (audioclass.is_type(f)):
-                return audioclass(filename)
+        for (audioclass, confirm) in sniff_types(f, filename):
+            if (confirm):
+                f.seek(0, 0)
+                if (not audioclass.is_type(f)):
+                    continue
+            return audioclass(filename)
         else:
             raise UnsupportedFile(filename)
 
@@ -1090,21 +1218,64 @@ def open(filename):
 #takes a list of filenames
 #returns a list of AudioFile objects, sorted by track_number()
 #any unsupported files are filtered out
-def open_files(filename_list, sorted=True, messenger=None):
+def _open_cached(filename, metadata_cache):
+    """Returns an (AudioFile, sort_key) tuple for filename,
+    where sort_key is its (album_number, track_number).
+
+    metadata_cache must provide get(url, size, mtime, namespace) and
+    put(url, size, mtime, value, namespace) methods.
+    The AudioFile itself (pickling keeps what its constructor parsed)
+    and its sort key are remembered there,
+    so an unchanged file is neither probed nor read again.
+    """
+
+    try:
+        stat = os.stat(filename)
+    except OSError, err:
+        raise IOError(str(err))
+
+    cached = metadata_cache.get(filename, stat.st_size, stat.st_mtime,
+                                namespace="audiotools_file")
+    if (cached is not None):
+        return cached
+
+    audiofile = open(filename)
+    sort_key = (audiofile.album_number(), audiofile.track_number())
+    try:
+        metadata_cache.put(filename, stat.st_size, stat.st_mtime,
+                           (audiofile, sort_key),
+                           namespace="audiotools_file")
+    except (cPickle.PicklingError, TypeError):
+        #some types keep attributes that can't be pickled,
+        #so they're parsed every time
+        pass
+    return (audiofile, sort_key)
+
+
+def open_files(filename_list, sorted=True, messenger=None,
+               metadata_cache=None):
     """Returns a list of AudioFile objects from a list of filenames.
 
     Files are sorted by album number then track number, by default.
     Unsupported files are filtered out.
     Error messages are sent to messenger, if given.
+    If metadata_cache is given, what is parsed from each file
+    is remembered there and reused while the file is unchanged.
     """
 
     toreturn = []
+    sort_keys = {}
     if (messenger is None):
         messenger = Messenger("audiotools", None)
 
     for filename in filename_list:
         try:
-            toreturn.append(open(filename))
+            if (metadata_cache is not None):
+                (audiofile, sort_key) = _open_cached(filename, metadata_cache)
+                sort_keys[id(audiofile)] = sort_key
+                toreturn.append(audiofile)
+            else:
+                toreturn.append(open(filename))
         except UnsupportedFile:
             pass
         except IOError, err:
@@ -1114,8 +1285,9 @@ def open_files(filename_list, sorted=True, messenger=None):
             messenger.error(unicode(err))
 
     if (sorted):
-        toreturn.sort(lambda x, y: cmp((x.album_number(), x.track_number()),
-                                       (y.album_number(), y.track_number())))
+        #cached sort keys spare reading every file's metadata again
+        toreturn.sort(key=lambda x: sort_keys.get(
+                id(x), (x.album_number(), x.track_number())))
     return toreturn
 
 
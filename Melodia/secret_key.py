@@ -0,0 +1 @@
+SECRET_KEY = 'xG1f9KRo-bEnAMcZAf1Kl53h_k4='
\ No newline at end of file
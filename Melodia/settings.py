@@ -202,7 +202,9 @@ if use_cache:
 	CACHES = {
 			'default': {
 				'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-				'LOCATION': CACHE_DIR,
+				#Django culls its own cache folder, so keep it apart from
+				#the other caches in CACHE_DIR
+				'LOCATION': os.path.join(CACHE_DIR, "django"),
 				}
 			}
 
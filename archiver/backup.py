@@ -0,0 +1,242 @@
+"""
+Incremental backups of an :class:`Archive` to a local or mounted folder.
+
+The backup folder holds a manifest (:data:`MANIFEST_NAME`) recording the
+``(size, mtime, digest)`` of every song as of the last time it was copied.
+The size and mtime come from the archiver's own scan data, which a quick scan
+keeps current. A backup run only copies songs whose size or mtime differ from
+the manifest, so nothing has to be re-read or re-stat'ed on either side for
+songs that haven't changed. The digest is computed from the bytes as they
+are copied, and is what :func:`BackupEngine.verify` checks against. Songs
+that were removed from the archive are removed from the backup folder and the
+manifest too. Copies run in parallel over
+:data:`melodia_settings.BACKUP_WORKERS` threads, and statistics for every run
+are kept in the manifest.
+"""
+
+import datetime, errno, json, os, shutil, time
+from multiprocessing.pool import ThreadPool
+
+from Melodia import melodia_settings
+from archiver import hashing
+
+MANIFEST_NAME = ".melodia-manifest.json"
+
+#How many runs worth of statistics to keep in the manifest
+_kept_runs = 50
+
+#copystat() can round the mtime it sets on some filesystems
+_mtime_tolerance = 0.001
+
+def is_local_location(location):
+	"""
+	Check whether a backup location is a local (or mounted) folder, as
+	opposed to an rsync-style remote like ``host:/music`` or ``rsync://host/music``.
+	"""
+	if "://" in location:
+		return False
+
+	first_component = location.split(os.sep, 1)[0]
+	return ":" not in first_component
+
+def _copy_file(job):
+	"""
+	Worker function for :func:`BackupEngine.run` - copy a single file into
+	place, hashing it on the way.
+
+	:rtype: Tuple of ``(job, bytes copied, digest, error)``
+	"""
+	url, target_url = job
+
+	try:
+		target_folder = os.path.dirname(target_url)
+		if not os.path.isdir(target_folder):
+			try:
+				os.makedirs(target_folder)
+			except OSError:
+				#Another worker may have created it first
+				if not os.path.isdir(target_folder):
+					raise
+
+		partial_url = target_url + ".part"
+		digest      = melodia_settings.HASH_FUNCTION()
+		copied      = 0
+		with open(url, 'rb') as source_file:
+			with open(partial_url, 'wb') as target_file:
+				for chunk in iter(lambda: source_file.read(melodia_settings.HASH_CHUNK_SIZE), ''):
+					digest.update(chunk)
+					target_file.write(chunk)
+					copied += len(chunk)
+
+		shutil.copystat(url, partial_url)
+		os.rename(partial_url, target_url)
+
+		return (job, copied, digest.hexdigest(), None)
+
+	except (IOError, OSError) as exc:
+		return (job, 0, None, str(exc))
+
+class BackupEngine(object):
+	"""
+	Back up an archive to a folder.
+
+	:param archive: The :class:`Archive` to back up
+	:param location: Backup folder - defaults to the archive's :data:`backup_location`
+	:param workers: Number of parallel copies - defaults to :data:`melodia_settings.BACKUP_WORKERS`
+	"""
+
+	def __init__(self, archive, location = None, workers = None):
+		self.archive       = archive
+		self.location      = location or archive.backup_location
+		self.workers       = workers or melodia_settings.BACKUP_WORKERS
+		self.manifest_path = os.path.join(self.location, MANIFEST_NAME)
+
+	def load_manifest(self):
+		"""
+		:rtype: Dictionary with ``files`` (relative path to ``[size, mtime, digest]``)
+		        and ``runs`` (list of per-run statistics).
+		"""
+		try:
+			with open(self.manifest_path, 'r') as manifest_file:
+				return json.load(manifest_file)
+		except (IOError, ValueError):
+			return {"files": {}, "runs": []}
+
+	def _save_manifest(self, manifest):
+		"Write the manifest so that an interruption never leaves half of it behind"
+		partial_path = self.manifest_path + ".part"
+		with open(partial_path, 'w') as manifest_file:
+			json.dump(manifest, manifest_file)
+		os.rename(partial_path, self.manifest_path)
+
+	def _target_url(self, relative_url):
+		return os.path.join(self.location, relative_url)
+
+	def run(self, progress_callback = lambda x, y: None):
+		"""
+		Copy every new or changed song to the backup folder, and remove the
+		copies of songs that are no longer in the archive.
+
+		:param progress_callback: Called with the number of files copied so far
+		                          first, and the number to be copied second.
+		:rtype: Dictionary of statistics for this run - ``copied``,
+		        ``skipped``, ``removed``, ``bytes``, ``errors``, ``seconds``.
+		"""
+		start_time = time.time()
+		if not os.path.isdir(self.location):
+			os.makedirs(self.location)
+
+		manifest = self.load_manifest()
+		files    = manifest["files"]
+
+		jobs    = []
+		entries = {}
+		skipped = 0
+		current = set()
+		for url, size, mtime in self.archive.song_set.values_list(
+				'url', 'file_size', 'file_mtime').iterator():
+			relative_url = os.path.relpath(url, self.archive.root_folder)
+			current.add(relative_url)
+
+			#The stored hash may be older than the scan, the size and mtime aren't
+			if files.get(relative_url, [])[:2] == [size, mtime]:
+				skipped += 1
+				continue
+
+			target_url = self._target_url(relative_url)
+			entries[target_url] = (relative_url, [size, mtime])
+			jobs.append((url, target_url))
+
+		copied       = 0
+		copied_bytes = 0
+		errors       = []
+
+		#Songs deleted (or moved) since the last run
+		removed = 0
+		for relative_url in [url for url in files if url not in current]:
+			try:
+				os.remove(self._target_url(relative_url))
+			except OSError as exc:
+				if exc.errno != errno.ENOENT:
+					errors.append(str(exc))
+					continue
+
+			del files[relative_url]
+			removed += 1
+
+		pool = ThreadPool(self.workers)
+		try:
+			for index, ((url, target_url), file_bytes, digest, error) in enumerate(
+					pool.imap_unordered(_copy_file, jobs)):
+				if error is None:
+					relative_url, entry = entries[target_url]
+					files[relative_url] = entry + [digest]
+					copied       += 1
+					copied_bytes += file_bytes
+				else:
+					errors.append(error)
+
+				progress_callback(index + 1, len(jobs))
+
+			pool.close()
+
+		except:
+			pool.terminate()
+			raise
+
+		finally:
+			pool.join()
+
+			#Whatever made it across is recorded, even if we were interrupted
+			run_stats = {
+					"finished": datetime.datetime.now().isoformat(),
+					"copied":   copied,
+					"skipped":  skipped,
+					"removed":  removed,
+					"bytes":    copied_bytes,
+					"errors":   errors,
+					"seconds":  time.time() - start_time,
+					}
+			manifest["runs"] = (manifest["runs"] + [run_stats])[-_kept_runs:]
+			self._save_manifest(manifest)
+
+		return run_stats
+
+	def verify(self):
+		"""
+		Check the backup folder against the manifest. Files whose size and mtime
+		still match the manifest are trusted without being read - only files
+		that look different are hashed and compared to the recorded hash.
+
+		:rtype: Dictionary with ``verified`` (count), and ``missing`` and
+		        ``mismatched`` (lists of relative paths).
+		"""
+		verified   = 0
+		missing    = []
+		mismatched = []
+
+		for relative_url, (size, mtime, digest) in self.load_manifest()["files"].iteritems():
+			target_url = self._target_url(relative_url)
+
+			try:
+				target_stat = os.stat(target_url)
+			except OSError:
+				missing.append(relative_url)
+				continue
+
+			if target_stat.st_size != size:
+				mismatched.append(relative_url)
+
+			elif abs(target_stat.st_mtime - mtime) < _mtime_tolerance:
+				verified += 1
+
+			else:
+				#Only the mtime differs - compare the actual content. Older
+				#manifests stored the song's whole file_hash.
+				known_digest = hashing.split_hash(digest)[1] or digest
+				if known_digest is not None and hashing.file_digest(target_url) == known_digest:
+					verified += 1
+				else:
+					mismatched.append(relative_url)
+
+		return {"verified": verified, "missing": missing, "mismatched": mismatched}
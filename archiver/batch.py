@@ -0,0 +1,136 @@
+"""
+Batched persistence for the archiver. Scans and metadata refreshes queue up
+their inserts, updates and deletes in a :class:`BatchWriter`, which writes
+them in transactions of :data:`melodia_settings.ARCHIVER_BATCH_SIZE` rows
+instead of one implicit transaction per row.
+
+Every flush is logged to the ``archiver.batch`` logger with the rows per
+second achieved so far, which is what to look at when tuning the batch size
+for a specific database.
+"""
+
+import logging, time
+
+from django.db import transaction
+
+from Melodia import melodia_settings
+from archiver.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+class BatchWriter(object):
+	"""
+	Queue writes for a model and apply them in batches. Use as a context
+	manager so the last partial batch is written on exit:
+
+	.. code-block:: python
+
+	   with BatchWriter(Song) as writer:
+	       writer.insert(Song(url = url))
+	       writer.update(song_id, metadata_stale = True)
+	       writer.delete(other_song_id)
+
+	:param model: The model class being written
+	:param batch_size: Rows per transaction - defaults to :data:`melodia_settings.ARCHIVER_BATCH_SIZE`
+	"""
+
+	def __init__(self, model, batch_size = None):
+		self.model      = model
+		self.batch_size = batch_size or melodia_settings.ARCHIVER_BATCH_SIZE
+
+		self._inserts = []
+		self._updates = []
+		self._deletes = []
+
+		#Running totals, see stats()
+		self.rows    = 0
+		self.batches = 0
+		self.elapsed = 0.0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		#Don't write a partial batch on top of an error
+		if exc_type is None:
+			self.flush()
+
+	def _pending(self):
+		return len(self._inserts) + len(self._updates) + len(self._deletes)
+
+	def _queued(self):
+		if self._pending() >= self.batch_size:
+			self.flush()
+
+	def insert(self, instance):
+		"Queue a new, unsaved model instance to be inserted"
+		self._inserts.append(instance)
+		self._queued()
+
+	def update(self, pk, **fields):
+		"Queue an update of some fields on the row with primary key `pk`"
+		self._updates.append((pk, fields))
+		self._queued()
+
+	def delete(self, pk):
+		"Queue the row with primary key `pk` to be deleted"
+		self._deletes.append(pk)
+		self._queued()
+
+	def flush(self):
+		"Write everything queued so far in a single transaction"
+		rows = self._pending()
+		if not rows:
+			return
+
+		start_time = time.time()
+
+		with transaction.commit_on_success():
+			for chunk in chunked(self._deletes):
+				self.model.objects.filter(pk__in = chunk).delete()
+
+			#Rows getting the same values (e.g. marking songs as stale)
+			#can share a single UPDATE statement
+			grouped_updates = {}
+			for pk, fields in self._updates:
+				grouped_updates.setdefault(tuple(sorted(fields.items())), []).append(pk)
+
+			for field_items, pks in grouped_updates.iteritems():
+				for chunk in chunked(pks):
+					self.model.objects.filter(pk__in = chunk).update(**dict(field_items))
+
+			#Stay under SQLite's limit of 999 parameters per statement
+			insert_chunk_size = max(1, 999 // len(self.model._meta.local_fields))
+			for chunk in chunked(self._inserts, insert_chunk_size):
+				self.model.objects.bulk_create(chunk)
+
+		self._inserts = []
+		self._updates = []
+		self._deletes = []
+
+		self.rows    += rows
+		self.batches += 1
+		self.elapsed += time.time() - start_time
+
+		logger.info("%s: wrote %d rows in %d batches of up to %d (%.1f rows/sec)",
+		            self.model.__name__, self.rows, self.batches, self.batch_size,
+		            self.rows_per_second())
+
+	def rows_per_second(self):
+		"Average write throughput so far"
+		if not self.elapsed:
+			return 0.0
+
+		return self.rows / self.elapsed
+
+	def stats(self):
+		"""
+		:rtype: Dictionary with the ``rows`` and ``batches`` written, the
+		        ``elapsed`` seconds spent writing, and ``rows_per_second``.
+		"""
+		return {
+				'rows':            self.rows,
+				'batches':         self.batches,
+				'elapsed':         self.elapsed,
+				'rows_per_second': self.rows_per_second(),
+				}
@@ -0,0 +1,190 @@
+"""
+HTTP downloads for podcasts. Feeds are fetched with conditional requests
+(``If-None-Match`` / ``If-Modified-Since``), so checking a feed that hasn't
+changed costs a single ``304 Not Modified``. Episodes are streamed straight to
+disk in chunks of :data:`melodia_settings.DOWNLOAD_CHUNK_SIZE` bytes, into a
+``.part`` file that is renamed into place once complete. An interrupted
+download leaves its ``.part`` file behind, and the next attempt continues it
+with an HTTP ``Range`` request.
+
+:class:`DownloadEngine` runs many downloads at once, over at most
+:data:`melodia_settings.DOWNLOAD_WORKERS` connections.
+"""
+
+import os, re, socket, time, urllib2
+from multiprocessing.pool import ThreadPool
+
+from Melodia import melodia_settings
+
+_user_agent = "Melodia/0.1"
+
+_content_range_regex = re.compile(r"bytes\s+(\d+|\*)(?:-\d+)?/(\d+|\*)")
+
+def _open(url, headers):
+	"Open a URL with some extra request headers"
+	request = urllib2.Request(url, headers = dict(headers, **{"User-Agent": _user_agent}))
+	return urllib2.urlopen(request, timeout = melodia_settings.DOWNLOAD_TIMEOUT)
+
+def open_feed(url, etag = None, last_modified = None):
+	"""
+	Fetch a feed, unless it hasn't changed since it was last fetched.
+
+	:param url: URL of the feed
+	:param etag: ``ETag`` header from the last time the feed was fetched
+	:param last_modified: ``Last-Modified`` header from the last time the feed was fetched
+	:rtype: Tuple of ``(response, etag, last_modified)``. ``response`` is the
+	        open response to read the feed from (the caller must close it), or
+	        ``None`` if the feed is unchanged. ``etag`` and ``last_modified``
+	        are the values to send next time.
+	"""
+	headers = {}
+	if etag:
+		headers["If-None-Match"] = etag
+	if last_modified:
+		headers["If-Modified-Since"] = last_modified
+
+	try:
+		response = _open(url, headers)
+	except urllib2.HTTPError as exc:
+		if exc.code == 304:
+			return (None, etag, last_modified)
+		raise
+
+	info = response.info()
+	return (response, info.getheader("ETag"), info.getheader("Last-Modified"))
+
+def _content_range(response_headers):
+	"Parse a ``Content-Range`` header into ``(start, total)``, with None for unknown parts"
+	match = _content_range_regex.match(response_headers.getheader("Content-Range") or "")
+	if match is None:
+		return (None, None)
+
+	start, total = match.groups()
+	return (int(start) if start != "*" else None, int(total) if total != "*" else None)
+
+def download_file(job):
+	"""
+	Download a single file, continuing a previous partial download if there is
+	one. Worker function for :func:`DownloadEngine.run`.
+
+	:param job: Tuple of ``(url, target_url)``
+	:rtype: Tuple of ``(job, bytes_downloaded, error)`` - ``error`` is
+	        ``None`` on success, and a message otherwise.
+	"""
+	url, target_url = job
+	partial_url = target_url + ".part"
+
+	try:
+		target_folder = os.path.dirname(target_url)
+		if not os.path.isdir(target_folder):
+			try:
+				os.makedirs(target_folder)
+			except OSError:
+				#Another worker may have created it first
+				if not os.path.isdir(target_folder):
+					raise
+
+		offset = os.path.getsize(partial_url) if os.path.exists(partial_url) else 0
+
+		try:
+			response = _open(url, {"Range": "bytes=%d-" % offset} if offset else {})
+		except urllib2.HTTPError as exc:
+			if exc.code == 416 and offset:
+				#Nothing left to fetch - either the partial file is already
+				#complete, or the file on the server has changed
+				total = _content_range(exc.info())[1]
+				if total == offset:
+					os.rename(partial_url, target_url)
+					return (job, 0, None)
+
+				os.unlink(partial_url)
+			raise
+
+		try:
+			if offset and response.getcode() == 206 and _content_range(response.info())[0] == offset:
+				partial_file = open(partial_url, 'ab')
+			else:
+				#The server sent the whole file
+				offset       = 0
+				partial_file = open(partial_url, 'wb')
+
+			downloaded = 0
+			with partial_file:
+				while True:
+					chunk = response.read(melodia_settings.DOWNLOAD_CHUNK_SIZE)
+					if not chunk:
+						break
+
+					partial_file.write(chunk)
+					downloaded += len(chunk)
+
+			expected = response.info().getheader("Content-Length")
+
+		finally:
+			response.close()
+
+		if expected is not None and downloaded != int(expected):
+			#Keep the partial file, the next attempt continues from it
+			return (job, downloaded, "Connection closed after %d of %s bytes" % (downloaded, expected))
+
+		os.rename(partial_url, target_url)
+		return (job, downloaded, None)
+
+	except (urllib2.URLError, socket.error, IOError, OSError) as exc:
+		return (job, 0, str(exc))
+
+class DownloadEngine(object):
+	"""
+	Download many files at once.
+
+	:param workers: Maximum number of simultaneous downloads (and so of open
+	                connections) - defaults to :data:`melodia_settings.DOWNLOAD_WORKERS`
+	"""
+
+	def __init__(self, workers = None):
+		self.workers = workers or melodia_settings.DOWNLOAD_WORKERS
+
+	def run(self, jobs, progress_callback = lambda x, y: None):
+		"""
+		Download every file in `jobs`.
+
+		:param jobs: List of ``(url, target_url)`` tuples
+		:param progress_callback: Called with the number of files finished so
+		                          far first, and the total number of files second.
+		:rtype: Dictionary of statistics - ``downloaded`` (list of target URLs
+		        that were completed), ``bytes``, ``errors`` (dictionary of
+		        target URL to error message) and ``seconds``.
+		"""
+		start_time = time.time()
+
+		downloaded       = []
+		downloaded_bytes = 0
+		errors           = {}
+
+		pool = ThreadPool(self.workers)
+		try:
+			for index, ((url, target_url), file_bytes, error) in enumerate(
+					pool.imap_unordered(download_file, jobs)):
+				downloaded_bytes += file_bytes
+				if error is None:
+					downloaded.append(target_url)
+				else:
+					errors[target_url] = error
+
+				progress_callback(index + 1, len(jobs))
+
+			pool.close()
+
+		except:
+			pool.terminate()
+			raise
+
+		finally:
+			pool.join()
+
+		return {
+				"downloaded": downloaded,
+				"bytes":      downloaded_bytes,
+				"errors":     errors,
+				"seconds":    time.time() - start_time,
+				}
@@ -0,0 +1,157 @@
+"""
+Incremental parsing of podcast feeds. Feeds list their newest episodes first,
+and a routine sync only needs the ones published since the last sync - so
+instead of building the whole document like :mod:`feedparser` does,
+:func:`read_episodes` reads RSS ``<item>`` and Atom ``<entry>`` elements one
+at a time with :func:`iterparse`, and stops reading once it reaches episodes
+that are already known. Each element is thrown away once it has been read, so
+memory use doesn't grow with the size of the back catalogue.
+
+Episodes are returned as dictionaries with the same keys :mod:`feedparser`
+uses (``published_parsed``, ``enclosures``, ``links``, ``title``), so either
+parser's results can be used by :class:`Feed`. Documents that aren't
+well-formed XML, or in which no episodes were found (such as RSS 1.0 feeds,
+whose items are namespaced), are handed to :mod:`feedparser` instead, which
+copes with more broken and unusual feeds.
+"""
+
+import calendar, datetime, email.utils, re, time
+import xml.etree.cElementTree as ElementTree
+
+import feedparser
+from django.utils import timezone
+
+_atom_namespace = "{http://www.w3.org/2005/Atom}"
+_itunes_namespace = "{http://www.itunes.com/dtds/podcast-1.0.dtd}"
+
+_item_tags = ("item", _atom_namespace + "entry")
+
+_iso8601_regex = re.compile(r"(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?"
+                            r"\s*(Z|[+-]\d\d:?\d\d)?$")
+
+#Keep reading at least this many episodes, so there are a few gaps between
+#episodes to work out how often the feed publishes
+_minimum_episodes = 10
+
+def _parse_date(text):
+	"""
+	Parse an RFC 822 (RSS) or ISO 8601 (Atom) date.
+
+	:rtype: UTC :class:`time.struct_time` like :mod:`feedparser` gives, or ``None``
+	"""
+	if not text:
+		return None
+	text = text.strip()
+
+	parsed = email.utils.parsedate_tz(text)
+	if parsed is not None:
+		return time.gmtime(email.utils.mktime_tz(parsed))
+
+	match = _iso8601_regex.match(text)
+	if match is None:
+		return None
+
+	year, month, day, hour, minute, second, zone = match.groups()
+	timestamp = calendar.timegm((int(year), int(month), int(day),
+	                             int(hour or 0), int(minute or 0), int(second or 0)))
+	if zone and zone != "Z":
+		offset     = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+		timestamp -= offset if zone[0] == "+" else -offset
+
+	return time.gmtime(timestamp)
+
+def _parse_item(element):
+	"Turn an RSS ``<item>`` or Atom ``<entry>`` element into a feedparser-style dictionary"
+	episode = {"enclosures": [], "links": []}
+
+	for child in element:
+		tag  = child.tag
+		text = child.text
+
+		if tag in ("title", _atom_namespace + "title"):
+			episode["title"] = (text or "").strip()
+
+		elif tag in ("pubDate", _atom_namespace + "published"):
+			episode["published_parsed"] = _parse_date(text)
+
+		elif tag == _atom_namespace + "updated":
+			episode["updated_parsed"] = _parse_date(text)
+
+		elif tag == "enclosure":
+			episode["enclosures"].append({"href": child.get("url"), "type": child.get("type"),
+			                              "length": child.get("length")})
+
+		elif tag == _atom_namespace + "link":
+			link = {"href": child.get("href"), "type": child.get("type"),
+			        "rel": child.get("rel", "alternate")}
+			episode["links"].append(link)
+			if link["rel"] == "enclosure":
+				episode["enclosures"].append(link)
+
+	return episode
+
+def _episode_time(episode):
+	published = episode.get("published_parsed") or episode.get("updated_parsed")
+	if published is None:
+		return None
+
+	return timezone.make_aware(datetime.datetime.utcfromtimestamp(calendar.timegm(published)),
+	                           timezone.utc)
+
+class _RecordingReader(object):
+	"File-like wrapper that keeps a copy of everything read, for the fallback parser"
+	def __init__(self, stream):
+		self.stream = stream
+		self.chunks = []
+
+	def read(self, size = -1):
+		data = self.stream.read(size)
+		self.chunks.append(data)
+		return data
+
+	def parse_rest(self):
+		"Parse the whole document - what was read so far and the rest - with feedparser"
+		document = "".join(self.chunks) + self.stream.read()
+		return list(feedparser.parse(document).entries)
+
+def read_episodes(stream, known_until = None):
+	"""
+	Read the episodes from the head of a feed, newest first.
+
+	:param stream: File-like object to read the feed document from
+	:param known_until: :class:`datetime.datetime` of the newest episode
+	                    already downloaded (taken to be UTC if it is naive).
+	                    Reading stops at the first episode published at or
+	                    before it (once a few episodes have been read).
+	                    ``None`` reads the whole feed.
+	:rtype: List of episode dictionaries
+	"""
+	reader   = _RecordingReader(stream)
+	episodes = []
+
+	if known_until is not None and timezone.is_naive(known_until):
+		known_until = timezone.make_aware(known_until, timezone.utc)
+
+	try:
+		for event, element in ElementTree.iterparse(reader, events = ("end",)):
+			if element.tag not in _item_tags:
+				continue
+
+			episode = _parse_item(element)
+			episodes.append(episode)
+			element.clear()
+
+			if known_until is not None and len(episodes) >= _minimum_episodes:
+				episode_time = _episode_time(episode)
+				if episode_time is not None and episode_time <= known_until:
+					break
+
+	except SyntaxError:
+		#Not well-formed - let feedparser try the whole document
+		return reader.parse_rest()
+
+	if not episodes:
+		#A feed format the streaming pass doesn't know, like RSS 1.0
+		return reader.parse_rest()
+
+	return episodes
@@ -0,0 +1,189 @@
+"""
+Syncing every :class:`Feed` on its own schedule. The :class:`FeedScheduler`
+runs :func:`Feed.sync_podcast` for every feed that is due, in parallel, but
+never with more than :data:`melodia_settings.FEED_SYNC_PER_HOST` syncs
+against the same host at once.
+
+How often a feed is synced follows how often it publishes
+(:data:`Feed.update_interval`), kept between
+:data:`melodia_settings.FEED_SYNC_MIN_INTERVAL` and
+:data:`melodia_settings.FEED_SYNC_MAX_INTERVAL`. A feed that fails to sync is
+retried after a delay that doubles with every failure in a row, up to
+:data:`melodia_settings.FEED_SYNC_MAX_BACKOFF`. Every delay is jittered so
+feeds drift apart instead of coming due together.
+
+The schedule is stored on each feed (:data:`Feed.next_sync`), so restarting
+the scheduler picks up where it left off rather than syncing everything at
+once. Feeds that have never been scheduled are spread out over the minimum
+interval.
+"""
+
+import datetime, logging, random, time, urlparse, Queue
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from django.utils import timezone
+
+from Melodia import melodia_settings
+
+_logger = logging.getLogger("archiver.feed_scheduler")
+
+def _host(feed):
+	"Host a feed is fetched from"
+	return urlparse.urlsplit(feed.url).netloc.lower()
+
+def _sync_podcast(feed):
+	feed.sync_podcast()
+
+class FeedScheduler(object):
+	"""
+	Sync feeds as they come due.
+
+	:param workers: Number of feeds synced at once - defaults to :data:`melodia_settings.FEED_SYNC_WORKERS`
+	:param per_host: Number of feeds synced at once from the same host - defaults to :data:`melodia_settings.FEED_SYNC_PER_HOST`
+	:param sync_function: Called with a :class:`Feed` to sync it - defaults to calling :func:`Feed.sync_podcast`
+	"""
+
+	def __init__(self, workers = None, per_host = None, sync_function = _sync_podcast):
+		self.workers       = workers or melodia_settings.FEED_SYNC_WORKERS
+		self.per_host      = per_host or melodia_settings.FEED_SYNC_PER_HOST
+		self.sync_function = sync_function
+
+	def _jitter(self, seconds):
+		jitter = melodia_settings.FEED_SYNC_JITTER
+		return seconds * random.uniform(1 - jitter, 1 + jitter)
+
+	def sync_interval(self, feed):
+		"Seconds to wait after a successful sync of a feed"
+		#Check twice as often as the feed publishes, so new episodes are
+		#picked up within half an interval
+		interval = feed.update_interval / 2 or melodia_settings.FEED_SYNC_MIN_INTERVAL
+
+		return max(melodia_settings.FEED_SYNC_MIN_INTERVAL,
+		           min(melodia_settings.FEED_SYNC_MAX_INTERVAL, interval))
+
+	def backoff(self, feed):
+		"Seconds to wait after a feed has failed :data:`Feed.sync_failures` times in a row"
+		return min(melodia_settings.FEED_SYNC_MAX_BACKOFF,
+		           melodia_settings.FEED_SYNC_MIN_INTERVAL * 2 ** max(feed.sync_failures - 1, 0))
+
+	def schedule_new(self, now = None):
+		"Give feeds that have never been scheduled a first sync time"
+		from archiver.models import Feed
+
+		now = now or timezone.now()
+		for feed_id in Feed.objects.filter(next_sync = None).values_list('id', flat = True):
+			first_sync = now + datetime.timedelta(
+					seconds = random.uniform(0, melodia_settings.FEED_SYNC_MIN_INTERVAL))
+			Feed.objects.filter(id = feed_id).update(next_sync = first_sync)
+
+	def due_feeds(self, now = None):
+		"List the feeds due to be synced, most overdue first"
+		from archiver.models import Feed
+
+		return list(Feed.objects.filter(next_sync__lte = now or timezone.now())
+		                        .order_by('next_sync'))
+
+	def _sync(self, feed):
+		"Worker function - sync a single feed"
+		try:
+			self.sync_function(feed)
+			return (feed, None)
+
+		except Exception as exc:
+			_logger.exception("Syncing the feed %s failed", feed.url)
+			return (feed, exc)
+
+	def _record(self, feed, error):
+		"Store the outcome of a sync, and when the feed should be synced next"
+		from archiver.models import Feed
+
+		if error is None:
+			feed.sync_failures = 0
+			delay = self.sync_interval(feed)
+		else:
+			feed.sync_failures += 1
+			delay = self.backoff(feed)
+
+		feed.next_sync = timezone.now() + datetime.timedelta(seconds = self._jitter(delay))
+
+		#Only the schedule is written, the sync saved everything else
+		Feed.objects.filter(id = feed.id).update(next_sync = feed.next_sync,
+		                                         sync_failures = feed.sync_failures)
+
+	def run_once(self, now = None):
+		"""
+		Sync every feed that is due, and schedule its next sync.
+
+		:param now: Time used to decide which feeds are due - defaults to now
+		:rtype: Tuple of ``(synced, failed)`` feed counts.
+		"""
+		self.schedule_new()
+		pending = self.due_feeds(now)
+
+		synced  = 0
+		failed  = 0
+		running = 0
+		running_hosts = defaultdict(int)
+
+		results = Queue.Queue()
+		pool    = ThreadPool(self.workers)
+		try:
+			while pending or running:
+				#Start every feed whose host has room, up to the worker limit
+				for feed in list(pending):
+					if running >= self.workers:
+						break
+
+					host = _host(feed)
+					if running_hosts[host] >= self.per_host:
+						continue
+
+					pending.remove(feed)
+					running += 1
+					running_hosts[host] += 1
+					pool.apply_async(self._sync, (feed,), callback = results.put)
+
+				#A timeout keeps the wait interruptible
+				feed, error = results.get(True, 365 * 24 * 3600)
+				running -= 1
+				running_hosts[_host(feed)] -= 1
+
+				#Statistics and schedule updates are done here, on the thread
+				#owning the database connection
+				self._record(feed, error)
+				if error is None:
+					synced += 1
+				else:
+					failed += 1
+
+			pool.close()
+
+		except:
+			pool.terminate()
+			raise
+
+		finally:
+			pool.join()
+
+		return (synced, failed)
+
+	def run(self, poll_interval = 60, progress_callback = lambda synced, failed: None):
+		"""
+		Sync feeds as they come due, until interrupted.
+
+		:param poll_interval: Longest time to sleep in seconds, so newly added feeds are noticed
+		:param progress_callback: Called with the ``(synced, failed)`` counts of every round
+		"""
+		from archiver.models import Feed
+
+		while True:
+			progress_callback(*self.run_once())
+
+			upcoming = Feed.objects.exclude(next_sync = None).order_by('next_sync')[:1]
+			sleep_time = poll_interval
+			if upcoming:
+				until_due  = upcoming[0].next_sync - timezone.now()
+				sleep_time = min(poll_interval, max(until_due.total_seconds(), 0))
+
+			time.sleep(sleep_time)
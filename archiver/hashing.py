@@ -0,0 +1,108 @@
+"""
+File hashing for the archiver. Two values are kept for every file:
+
+   * A **digest** of the full file content, read in chunks of
+     :data:`melodia_settings.HASH_CHUNK_SIZE` bytes so large files are never
+     held in memory.
+   * A cheap **fingerprint** built from the file size, modification time and
+     the first and last :data:`melodia_settings.FINGERPRINT_BLOCK_SIZE` bytes.
+
+Both are stored together in :data:`Song.file_hash` as ``fingerprint:digest``.
+When checking whether a file changed, the fingerprint is compared first and
+the full digest is only computed if the fingerprint no longer matches.
+
+The hash itself is pluggable - :data:`melodia_settings.HASH_FUNCTION` can be
+anything with the :mod:`hashlib` interface (``update()`` and ``hexdigest()``).
+"""
+
+import os
+
+from Melodia import melodia_settings
+
+_separator = ":"
+
+def file_digest(url, chunk_size = None):
+	"""
+	Hash the full content of a file, reading it in fixed-size chunks.
+
+	:param url: Full path to the file
+	:param chunk_size: Bytes to read at a time - defaults to :data:`melodia_settings.HASH_CHUNK_SIZE`
+	:rtype: Hex digest string
+	"""
+	chunk_size = chunk_size or melodia_settings.HASH_CHUNK_SIZE
+	digest     = melodia_settings.HASH_FUNCTION()
+
+	with open(url, 'rb') as hash_file:
+		for chunk in iter(lambda: hash_file.read(chunk_size), ''):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+def file_fingerprint(url, block_size = None):
+	"""
+	Build a cheap fingerprint of a file that changes whenever the file's size,
+	modification time, first block or last block change.
+
+	:param url: Full path to the file
+	:param block_size: Size of the head and tail blocks - defaults to :data:`melodia_settings.FINGERPRINT_BLOCK_SIZE`
+	:rtype: Hex digest string
+	"""
+	block_size  = block_size or melodia_settings.FINGERPRINT_BLOCK_SIZE
+	fingerprint = melodia_settings.HASH_FUNCTION()
+
+	with open(url, 'rb') as hash_file:
+		file_stat = os.fstat(hash_file.fileno())
+		fingerprint.update("%d/%r/" % (file_stat.st_size, file_stat.st_mtime))
+		fingerprint.update(hash_file.read(block_size))
+
+		#Small files are already covered by the head block
+		if file_stat.st_size > block_size:
+			hash_file.seek(max(block_size, file_stat.st_size - block_size))
+			fingerprint.update(hash_file.read(block_size))
+
+	return fingerprint.hexdigest()
+
+def join_hash(fingerprint, digest):
+	"Combine a fingerprint and digest into the value stored in the database"
+	return fingerprint + _separator + digest
+
+def split_hash(file_hash):
+	"""
+	Split a stored hash back into its fingerprint and digest.
+
+	:rtype: Tuple of ``(fingerprint, digest)``. Both are ``None`` if the
+	        stored value is missing or was not created by this module.
+	"""
+	if not isinstance(file_hash, basestring) or _separator not in file_hash:
+		return (None, None)
+
+	return tuple(file_hash.split(_separator, 1))
+
+def file_hash(url):
+	"""
+	Compute the full stored hash (fingerprint and digest) of a file.
+
+	:param url: Full path to the file
+	:rtype: String to be stored in :data:`Song.file_hash`
+	"""
+	return join_hash(file_fingerprint(url), file_digest(url))
+
+def check_file(url, known_file_hash):
+	"""
+	Check whether a file's content changed since `known_file_hash` was
+	computed. The full digest is only computed if the fingerprint differs.
+
+	:param url: Full path to the file
+	:param known_file_hash: Value previously returned by :func:`file_hash`, or ``None``
+	:rtype: Tuple of ``(changed, file_hash)``. `changed` is `True` if the
+	        content changed, `file_hash` is the up-to-date value to store.
+	"""
+	known_fingerprint, known_digest = split_hash(known_file_hash)
+
+	fingerprint = file_fingerprint(url)
+	if fingerprint == known_fingerprint:
+		return (False, known_file_hash)
+
+	#Only the size, mtime or head/tail changed - it's time for the real thing
+	digest = file_digest(url)
+	return (digest != known_digest, join_hash(fingerprint, digest))
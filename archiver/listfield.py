@@ -2,13 +2,37 @@
 Testing documentation
 '''
 from django.db import models
-import re, itertools
+from django.core.exceptions import ValidationError
 
-class IntegerListField(models.TextField):
+from array import array
+import re, sys
+
+#Unsigned 32-bit integers - 'I' is 32 bits on every platform we care about,
+#but fall back to 'L' just in case.
+_typecode = 'I' if array('I').itemsize == 4 else 'L'
+
+#Lists stored by older versions of this field were text: "[1, 2, 3]"
+_legacy_regex = re.compile(r"^\[[0-9,\s]*\]$")
+_digits_regex = re.compile(r"[0-9]+")
+
+def _parse_legacy(value):
+	"Parse the text format used by older versions of this field"
+	return array(_typecode, [int(i) for i in _digits_regex.findall(value)])
+
+class IntegerListField(models.Field):
 	"""
-	Store a list of integers in a database string.
-	Format is: 
-	[<int_1>, <int_2>, <int_3>, ... , <int_n>]
+	Store a list of integers in a database binary column.
+	Format is the integers packed as little-endian unsigned 32-bit values,
+	so decoding a list is a single copy into an :class:`array.array` rather
+	than parsing text. In Python the value is an ``array('I')``, which
+	supports the usual list operations (``append``, ``insert``, ``del``, ...).
+
+	Values in the old text format (``[<int_1>, <int_2>, ... , <int_n>]``) are
+	still read, and converted when saved. Databases created by older versions
+	have a text column - run the ``convert_playlists`` management command
+	once to change the column to the binary type (except on SQLite, where a
+	text column holds binary values as they are) and convert every stored
+	list.
 	"""
 
 	description = "Field type for storing lists of integers."
@@ -16,41 +40,57 @@ class IntegerListField(models.TextField):
 	__metaclass__ = models.SubfieldBase
 
 	def __init__(self, *args, **kwargs):
+		kwargs.setdefault('default', lambda: array(_typecode))
 		super(IntegerListField, self).__init__(*args, **kwargs)
 
+	def db_type(self, connection):
+		if connection.vendor == 'postgresql':
+			return 'bytea'
+		if connection.vendor == 'mysql':
+			return 'longblob'
+		return 'blob'
 
 	#Convert database to python
 	def to_python(self, value):
-		if isinstance(value, list):
+		if isinstance(value, array):
 			return value
 
-		#Process a database string
-		
-		#Validation first
-		if len(value) <= 0:
-			return []
+		if isinstance(value, (list, tuple)):
+			return array(_typecode, value)
+
+		if value is None:
+			return array(_typecode)
 
-		if value[0] != '[' or value[-1] != ']':
-			raise ValidationError("Invalid input to parse a list of integers!")
+		if isinstance(value, unicode) or (isinstance(value, str) and _legacy_regex.match(value)):
+			#Lists saved in the text format
+			if value and not _legacy_regex.match(value):
+				raise ValidationError("Invalid input to parse a list of integers!")
 
-		#Note that any non-digit string is a valid separator
-		_csv_regex = "[0-9]"
-		csv_regex  = re.compile(_csv_regex)
+			return _parse_legacy(value)
 
-		#Synonymous to:
-		#string_list = filter(None, csv_regex.findall(value))
-		string_list  = itertools.ifilter(None, csv_regex.findall(value))
-		value_list   = [int(i) for i in string_list]
+		#Process a database buffer - copied straight into the array
+		value_list = array(_typecode)
+		value_list.fromstring(value)
+		if sys.byteorder == 'big':
+			value_list.byteswap()
 
 		return value_list
 
 	#Convert python to database
 	def get_prep_value(self, value):
-		if not isinstance(value, list):
+		if isinstance(value, (list, tuple)):
+			value = array(_typecode, value)
+
+		if not isinstance(value, array):
 			raise ValidationError("Invalid list given to put in database!")
 
-		separator_string = ", "
+		if sys.byteorder == 'big':
+			value = array(_typecode, value)
+			value.byteswap()
 
-		list_elements = separator_string.join(map(str, value))
+		return buffer(value.tostring())
 
-		return "[" + list_elements + "]"
+	def value_to_string(self, obj):
+		#Used when serializing, e.g. dumpdata - in the text format, which
+		#to_python reads back on loaddata
+		return "[%s]" % ", ".join(str(i) for i in self._get_val_from_obj(obj))
@@ -0,0 +1,55 @@
+"""
+Convert playlists stored in the old text format of :class:`IntegerListField`
+to the binary format.
+
+Older versions of the field used a text column. On PostgreSQL and MySQL the
+column is altered to the field's binary type (``bytea`` / ``longblob``)
+first, after reading every stored list, and every list is then written back.
+SQLite keeps the old column: a text column there stores binary values as
+they are, so only the lists still in the text format are rewritten.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from archiver.listfield import IntegerListField
+from archiver.models import Playlist
+
+#Schema change to the binary column type, per database vendor. Every list is
+#rewritten afterwards, so the USING clause doesn't have to convert anything.
+_alter_column = {
+	'postgresql': "ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE bytea USING decode('', 'hex')",
+	'mysql':      "ALTER TABLE %(table)s MODIFY %(column)s longblob NOT NULL",
+	}
+
+class Command(BaseCommand):
+	help = "Convert playlists stored as text (\"[1, 2, 3]\") to the binary IntegerListField format."
+
+	def handle(self, *args, **options):
+		field = Playlist._meta.get_field('song_list')
+		table = connection.ops.quote_name(Playlist._meta.db_table)
+		column = connection.ops.quote_name(field.column)
+		alter_column = _alter_column.get(connection.vendor)
+
+		cursor = connection.cursor()
+		cursor.execute("SELECT id, %s FROM %s" % (column, table))
+
+		converted = 0
+		with transaction.commit_on_success():
+			rows = cursor.fetchall()
+
+			if alter_column is not None:
+				cursor.execute(alter_column % {"table": table, "column": column})
+
+			for playlist_id, song_list in rows:
+				#Binary values come back as buffers, text values as strings
+				if alter_column is None and not isinstance(song_list, basestring):
+					continue
+
+				cursor.execute("UPDATE %s SET %s = %%s WHERE id = %%s" % (table, column),
+				               [field.get_prep_value(field.to_python(song_list)), playlist_id])
+				converted += isinstance(song_list, basestring)
+
+			transaction.set_dirty()
+
+		self.stdout.write("Converted %d playlist(s).\n" % converted)
@@ -0,0 +1,37 @@
+"""
+Keep podcast feeds up to date, syncing each one as it comes due.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from archiver.feed_scheduler import FeedScheduler
+
+class Command(BaseCommand):
+	help = "Sync podcast feeds in parallel as they come due, backing off from feeds that fail."
+
+	option_list = BaseCommand.option_list + (
+			make_option("--once", action = "store_true", dest = "once", default = False,
+			            help = "Sync the feeds that are due now, then exit."),
+			make_option("--workers", type = "int", dest = "workers", default = None,
+			            help = "Number of feeds synced at once."),
+			make_option("--per-host", type = "int", dest = "per_host", default = None,
+			            help = "Number of feeds synced at once from the same host."),
+			)
+
+	def handle(self, *args, **options):
+		scheduler = FeedScheduler(workers = options["workers"], per_host = options["per_host"])
+
+		if options["once"]:
+			self._report(*scheduler.run_once())
+			return
+
+		try:
+			scheduler.run(progress_callback = self._report)
+		except KeyboardInterrupt:
+			pass
+
+	def _report(self, synced, failed):
+		if synced or failed:
+			self.stdout.write("%d feed(s) synced, %d failed\n" % (synced, failed))
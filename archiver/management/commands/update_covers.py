@@ -0,0 +1,31 @@
+"""
+Extract cover art and generate its thumbnails ahead of time.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from archiver.models import Archive
+
+class Command(BaseCommand):
+	args = "[archive_id ...]"
+	help = "Extract the cover art of songs and generate thumbnails, so the web client never waits for one."
+
+	option_list = BaseCommand.option_list + (
+			make_option("--all", action = "store_false", dest = "only_missing", default = True,
+			            help = "Process every song, not only those added or changed since the last run."),
+			)
+
+	def handle(self, *args, **options):
+		archives = Archive.objects.all()
+		if args:
+			archives = archives.filter(id__in = args)
+
+		archives = list(archives)
+		if not archives:
+			raise CommandError("No archives to update.")
+
+		for archive in archives:
+			archive.update_covers(only_missing = options["only_missing"])
+			self.stdout.write("Updated covers of %s\n" % archive.name)
@@ -0,0 +1,24 @@
+"""
+Compute waveform peaks ahead of time, for the web player's scrubber.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from archiver.models import Archive
+
+class Command(BaseCommand):
+	args = "[archive_id ...]"
+	help = "Decode songs that have no waveform peaks yet and store their peaks."
+
+	def handle(self, *args, **options):
+		archives = Archive.objects.all()
+		if args:
+			archives = archives.filter(id__in = args)
+
+		archives = list(archives)
+		if not archives:
+			raise CommandError("No archives to update.")
+
+		for archive in archives:
+			failed = archive.update_waveforms()
+			self.stdout.write("Updated waveforms of %s (%d failed)\n" % (archive.name, failed))
@@ -0,0 +1,55 @@
+"""
+Keep archives up to date as files change, without periodic full scans.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from archiver.models import Archive
+from archiver.watcher import ArchiveWatcher
+
+class Command(BaseCommand):
+	args = "[archive_id ...]"
+	help = "Watch archive folders with inotify and apply added, changed or removed songs as they happen."
+
+	option_list = BaseCommand.option_list + (
+			make_option("--delay", type = "float", dest = "delay", default = None,
+			            help = "Seconds without new events before changes are applied."),
+			make_option("--sweep-interval", type = "float", dest = "sweep_interval", default = None,
+			            help = "Seconds between sweeps of folders that can't be watched."),
+			make_option("--no-initial-scan", action = "store_false", dest = "initial_scan", default = True,
+			            help = "Don't quick scan each archive before starting to watch."),
+			)
+
+	def handle(self, *args, **options):
+		archives = Archive.objects.all()
+		if args:
+			archives = archives.filter(id__in = args)
+
+		archives = list(archives)
+		if not archives:
+			raise CommandError("No archives to watch.")
+
+		if options["initial_scan"]:
+			#Catch up on anything that changed while nobody was watching
+			for archive in archives:
+				self._report(archive, archive.quick_scan())
+				archive._update_song_metadata(only_stale = True)
+
+		watcher = ArchiveWatcher(archives,
+		                         coalesce_delay = options["delay"],
+		                         sweep_interval = options["sweep_interval"],
+		                         progress_callback = self._report)
+
+		self.stdout.write("Watching %d archive(s).\n" % len(archives))
+		try:
+			watcher.run()
+		except KeyboardInterrupt:
+			pass
+
+	def _report(self, archive, counts):
+		added, changed, removed = counts
+		if added or changed or removed:
+			self.stdout.write("%s: %d added, %d changed, %d removed\n"
+			                  % (archive.name, added, changed, removed))
@@ -0,0 +1,188 @@
+"""
+Metadata extraction for :class:`Song` files. Nothing in this module touches
+the database - every function works on a filename and returns plain Python
+values - so extraction can be fanned out over a pool of workers while a
+single writer saves the results.
+"""
+
+import os
+from itertools import imap
+
+from Melodia import melodia_settings
+from archiver import hashing, metadata_cache
+
+def read_file_info(url):
+	"""
+	Grab the file-based metadata for a song, other than its hash.
+
+	:param url: Full path to the file
+	:rtype: Dictionary of :class:`Song` field names to values
+	"""
+	file_stat = os.stat(url)
+
+	return {
+			'file_size':  file_stat.st_size,
+			'file_mtime': file_stat.st_mtime,
+			'file_inode': file_stat.st_ino,
+			}
+
+def _first_tag(tags, key):
+	"Return the first value of a mutagen tag, or None if it is not set"
+	try:
+		return tags[key][0]
+	except (KeyError, IndexError, ValueError):
+		return None
+
+def _tag_int(value):
+	"Convert a tag value to an integer, or None if it is not a number"
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+def read_tags(url):
+	"""
+	Grab the tag and stream metadata for a song using what is locally available.
+
+	:param url: Full path to the file
+	:rtype: Dictionary of :class:`Song` field names to values. Empty if the
+	        file could not be read.
+	"""
+	#Use mutagen to get the song metadata
+	import mutagen
+	from archiver.models.song import _default_string, _default_int
+
+	try:
+		#Use mutagen to scan local metadata - don't update anything else (i.e. play_count)
+		track      = mutagen.File(url)
+		track_easy = mutagen.File(url, easy = True)
+	except Exception:
+		#Couldn't grab the local data
+		return {}
+
+	if track is None or track_easy is None:
+		#Not a format mutagen understands
+		return {}
+
+	date        = _first_tag(track_easy, 'date') or ''
+	disc_pair   = (_first_tag(track_easy, 'discnumber') or '').split('/')
+	track_pair  = (_first_tag(track_easy, 'tracknumber') or '').split('/')
+
+	return {
+			'title':        _first_tag(track_easy, 'title') or _default_string,
+			'artist':       _first_tag(track_easy, 'artist') or _default_string,
+			'album_artist': _first_tag(track_easy, 'albumartist') or _default_string,
+			'album':        _first_tag(track_easy, 'album') or _default_string,
+			'year':         _tag_int(date[0:4]) or _default_int,
+			'genre':        _first_tag(track_easy, 'genre') or _default_string,
+
+			'disc_number':  _tag_int(disc_pair[0]) or _default_int,
+			'disc_total':   _tag_int(disc_pair[-1]) or _default_int,
+			'track_number': _tag_int(track_pair[0]) or _default_int,
+			'track_total':  _tag_int(track_pair[-1]) or _default_int,
+			'comment':      _first_tag(track_easy, 'comment') or _default_string,
+
+			'bit_rate':     getattr(track.info, 'bitrate', None) or _default_int,
+			'duration':     getattr(track.info, 'length', None) or _default_int,
+			}
+
+def read_tags_cached(url, size, mtime):
+	"""
+	Like :func:`read_tags`, but served from the shared
+	:mod:`archiver.metadata_cache` when the file hasn't changed since it was
+	last read.
+
+	:param url: Full path to the file
+	:param size: Current size of the file
+	:param mtime: Current modification time of the file
+	"""
+	cache = metadata_cache.get_cache()
+
+	tags = cache.get(url, size, mtime)
+	if tags is None:
+		tags = read_tags(url)
+
+		#Don't remember failures, the file may be readable next time
+		if tags:
+			cache.put(url, size, mtime, tags)
+
+	return tags
+
+def extract_metadata(job):
+	"""
+	Worker function for :func:`iter_extracted`. Tags are only re-read if the
+	file's content has changed.
+
+	The hash of every file is kept in the shared :mod:`archiver.metadata_cache`
+	next to its tags, so a file already read in its current state (same size
+	and mtime) is neither hashed nor parsed again - e.g. on a full
+	:func:`Archive.scan`, or a scan resumed after being interrupted.
+
+	:param job: Tuple of ``(song_id, url, known_file_hash)``
+	:rtype: Tuple of ``(song_id, fields)``. `fields` is a dictionary of
+	        :class:`Song` field names to values, or ``None`` if the file
+	        could not be read.
+	"""
+	song_id, url, known_file_hash = job
+	cache = metadata_cache.get_cache()
+
+	try:
+		fields = read_file_info(url)
+		size, mtime = fields['file_size'], fields['file_mtime']
+
+		file_hash = cache.get(url, size, mtime, namespace = "file_hash")
+		if file_hash is None:
+			changed, file_hash = hashing.check_file(url, known_file_hash)
+			cache.put(url, size, mtime, file_hash, namespace = "file_hash")
+		else:
+			changed = hashing.split_hash(file_hash)[1] != hashing.split_hash(known_file_hash)[1]
+
+	except (IOError, OSError):
+		return (song_id, None)
+
+	fields['file_hash'] = file_hash
+	if changed:
+		fields.update(read_tags_cached(url, size, mtime))
+
+	fields['metadata_stale'] = False
+	return (song_id, fields)
+
+def iter_extracted(jobs, workers = None):
+	"""
+	Run :func:`extract_metadata` over a list of jobs using a pool of workers,
+	yielding results in whatever order they complete.
+
+	:param jobs: List of ``(song_id, url, known_file_hash)`` tuples
+	:param workers: Number of workers to use - defaults to
+	                :data:`melodia_settings.METADATA_WORKERS`. With one
+	                worker or less, everything runs in the calling thread.
+	"""
+	if workers is None:
+		workers = melodia_settings.METADATA_WORKERS
+
+	if workers <= 1:
+		for result in imap(extract_metadata, jobs):
+			yield result
+		return
+
+	if melodia_settings.METADATA_USE_PROCESSES:
+		from multiprocessing import Pool
+		pool = Pool(workers)
+	else:
+		#Tag parsing spends most of its time waiting on the disk
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(workers)
+
+	try:
+		chunk_size = max(1, min(32, len(jobs) // (workers * 4)))
+		for result in pool.imap_unordered(extract_metadata, jobs, chunk_size):
+			yield result
+
+		pool.close()
+
+	except:
+		pool.terminate()
+		raise
+
+	finally:
+		pool.join()
@@ -0,0 +1,209 @@
+"""
+On-disk cache of parsed song metadata, so repeated scans don't have to open
+files whose tags have already been read. Entries are stored in a SQLite
+database under ``CACHE_DIR`` and keyed by ``(namespace, url, size, mtime)`` -
+a file that changes on disk simply misses the cache. The namespace lets
+different readers share the cache: the archiver stores its parsed tags under
+``"tags"`` and file hashes under ``"file_hash"``, and
+:func:`audiotools.open_files` can store what it parsed out of each file.
+
+The cache holds at most :data:`melodia_settings.METADATA_CACHE_SIZE` entries,
+evicting the least recently used ones. Reads don't write to the database
+straight away - the access times of entries that were read are saved in
+batches, and before every eviction. Setting it to ``0`` disables caching.
+Entries can also be dropped explicitly with :func:`invalidate`.
+"""
+
+import os, sqlite3, threading, time
+import cPickle as pickle
+
+from django.conf import settings
+
+from Melodia import melodia_settings
+from archiver.utils import chunked
+
+_schema = """
+CREATE TABLE IF NOT EXISTS metadata (
+	namespace TEXT NOT NULL,
+	url       TEXT NOT NULL,
+	size      INTEGER NOT NULL,
+	mtime     REAL NOT NULL,
+	value     BLOB NOT NULL,
+	last_used REAL NOT NULL,
+	PRIMARY KEY (namespace, url)
+);
+CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used);
+"""
+
+#Check whether eviction is needed once every this many writes
+_evict_interval = 256
+
+#Save the access times of entries that were read once this many are waiting
+_touch_interval = 256
+
+class MetadataCache(object):
+	"""
+	LRU cache of metadata values keyed by file. Safe to use from several
+	threads or processes at once - each gets its own connection.
+
+	:param path: Location of the cache database - defaults to ``metadata.sqlite`` in ``CACHE_DIR``
+	:param max_entries: Maximum number of entries - defaults to :data:`melodia_settings.METADATA_CACHE_SIZE`
+	"""
+
+	def __init__(self, path = None, max_entries = None):
+		self.path        = path or os.path.join(settings.CACHE_DIR, "metadata.sqlite")
+		self.max_entries = max_entries or melodia_settings.METADATA_CACHE_SIZE
+
+		self._local   = threading.local()
+		self._lock    = threading.Lock()
+		self._writes  = 0
+		#(namespace, url) -> time it was last read, not saved yet
+		self._touched = {}
+
+	def _connection(self):
+		#Connections can't be shared between threads, or survive a fork
+		if getattr(self._local, "pid", None) != os.getpid():
+			connection = sqlite3.connect(self.path, timeout = 30)
+			connection.text_factory = str
+			connection.executescript(_schema)
+
+			self._local.connection = connection
+			self._local.pid        = os.getpid()
+
+		return self._local.connection
+
+	def _key(self, url):
+		if isinstance(url, unicode):
+			return url.encode('utf-8')
+		return url
+
+	def get(self, url, size, mtime, namespace = "tags"):
+		"""
+		Look up the value stored for a file.
+
+		:rtype: The stored value, or ``None`` if the file isn't cached or has
+		        changed since.
+		"""
+		connection = self._connection()
+		row = connection.execute("SELECT value FROM metadata WHERE namespace = ? AND url = ? "
+		                         "AND size = ? AND mtime = ?",
+		                         (namespace, self._key(url), size, mtime)).fetchone()
+		if row is None:
+			return None
+
+		with self._lock:
+			self._touched[(namespace, self._key(url))] = time.time()
+			save_touches = len(self._touched) >= _touch_interval
+
+		if save_touches:
+			self._save_touches()
+
+		return pickle.loads(str(row[0]))
+
+	def _save_touches(self):
+		"Save the access times of the entries read since the last time, in one go"
+		with self._lock:
+			touched, self._touched = self._touched, {}
+
+		if touched:
+			connection = self._connection()
+			with connection:
+				connection.executemany("UPDATE metadata SET last_used = ? WHERE namespace = ? AND url = ?",
+				                       [(last_used, namespace, url)
+				                        for (namespace, url), last_used in touched.iteritems()])
+
+	def put(self, url, size, mtime, value, namespace = "tags"):
+		"Store a value for a file, replacing anything previously stored for it"
+		connection = self._connection()
+		with connection:
+			connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+			                   (namespace, self._key(url), size, mtime,
+			                    sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+			                    time.time()))
+
+		with self._lock:
+			self._writes += 1
+			evict_now = self._writes % _evict_interval == 0
+
+		if evict_now:
+			self.evict()
+
+	def evict(self):
+		"Drop the least recently used entries until the cache is within its size"
+		self._save_touches()
+
+		connection = self._connection()
+		with connection:
+			entries = connection.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+			if entries > self.max_entries:
+				connection.execute("DELETE FROM metadata WHERE rowid IN "
+				                   "(SELECT rowid FROM metadata ORDER BY last_used LIMIT ?)",
+				                   (entries - self.max_entries,))
+
+	def invalidate(self, urls):
+		"Drop every entry (in every namespace) for a URL or list of URLs"
+		if isinstance(urls, basestring):
+			urls = [urls]
+
+		connection = self._connection()
+		with connection:
+			for chunk in chunked(self._key(url) for url in urls):
+				connection.execute("DELETE FROM metadata WHERE url IN (%s)"
+				                   % ", ".join("?" * len(chunk)), chunk)
+
+	def invalidate_folder(self, folder):
+		"Drop every entry for files under a folder"
+		prefix = self._key(folder).rstrip(os.sep) + os.sep
+
+		connection = self._connection()
+		with connection:
+			connection.execute("DELETE FROM metadata WHERE substr(url, 1, ?) = ?",
+			                   (len(prefix), prefix))
+
+	def clear(self):
+		"Drop everything"
+		connection = self._connection()
+		with connection:
+			connection.execute("DELETE FROM metadata")
+
+class _DisabledCache(object):
+	"Stand-in used when caching is turned off - never stores anything"
+	def get(self, url, size, mtime, namespace = "tags"):
+		return None
+
+	def put(self, url, size, mtime, value, namespace = "tags"):
+		pass
+
+	def evict(self):
+		pass
+
+	def invalidate(self, urls):
+		pass
+
+	def invalidate_folder(self, folder):
+		pass
+
+	def clear(self):
+		pass
+
+_default_cache = None
+
+def get_cache():
+	"Return the shared cache, creating it on first use"
+	global _default_cache
+
+	if _default_cache is None:
+		if melodia_settings.METADATA_CACHE_SIZE > 0:
+			_default_cache = MetadataCache()
+		else:
+			_default_cache = _DisabledCache()
+
+	return _default_cache
+
+def invalidate(urls):
+	"Drop cached metadata for a URL or list of URLs from the shared cache"
+	get_cache().invalidate(urls)
+
+def invalidate_folder(folder):
+	"Drop cached metadata for every file under a folder from the shared cache"
+	get_cache().invalidate_folder(folder)
@@ -2,4 +2,6 @@
 from archive import Archive
 from song import Song
 from playlist import Playlist
+from playlist_entry import PlaylistEntry
+from smart_playlist import SmartPlaylist
 from feed import Feed
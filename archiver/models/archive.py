@@ -7,13 +7,19 @@ of music - basically, multiple filesystem folders holding your music.
 
 from django.db import models
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
 import datetime
-import re, os
+import os
 from itertools import ifilter
 
-from Melodia.melodia_settings import SUPPORTED_AUDIO_EXTENSIONS
-from Melodia.melodia_settings import HASH_FUNCTION as hash
+from archiver import metadata_cache, search
+from archiver.batch import BatchWriter
+from archiver.metadata import iter_extracted
+from archiver.utils import chunked, is_supported_file, stat_file
+
+#Song fields used to compare the database against the filesystem
+_sync_fields = ('id', 'url', 'file_size', 'file_mtime', 'file_inode')
 
 class Archive (models.Model):
     """
@@ -54,62 +60,215 @@ class Archive (models.Model):
     #Backup settings
     backup_location  = models.CharField(max_length = 255, default = None, null = True)
     backup_frequency = models.IntegerField(default = 10800) #1 week in minutes
-    last_backup      = models.DateTimeField(default = datetime.datetime.now) #Note that this by default will be the time the archive was instantiated
+    last_backup      = models.DateTimeField(default = timezone.now) #Note that this by default will be the time the archive was instantiated
 
     class Meta:
         app_label = 'archiver'
 
+    def _walk_filesystem(self):
+        """
+        Walk the archive's root folder and find every supported audio file.
+
+        :rtype: Dictionary mapping the full URL of each file to its
+                ``(size, mtime, inode)`` tuple.
+        """
+        on_disk = {}
+
+        for dirname, dirnames, filenames in os.walk(self.root_folder):
+            #For each filename that is supported
+            for filename in ifilter(is_supported_file, filenames):
+                full_url  = os.path.abspath(os.path.join(dirname, filename))
+                file_stat = stat_file(full_url)
+
+                #The file may have vanished between listing and stat()
+                if file_stat is not None:
+                    on_disk[full_url] = file_stat
+
+        return on_disk
+
     def _scan_filesystem(self):
         """
-        Scan the archive's root filesystem and add any new songs without adding
-        metadata, delete songs that exist no more.
-        .. todo:: 
-           
-           This should be fixed so that we don't drop all songs and re-add
-           them. That's just terrible design.
+        Scan the archive's root filesystem and bring the database in line with
+        it, without adding metadata. Files are compared to the database using
+        their ``(url, size, mtime, inode)``:
+
+           * New files are inserted and marked for a metadata refresh.
+           * Files that no longer exist are deleted.
+           * Files whose size, mtime or inode changed are marked for a
+             metadata refresh.
+           * Files that were moved within the archive (same inode and size
+             under a new URL) keep their database row, so play counts and
+             ratings survive.
+
+        :rtype: Tuple of ``(added, changed, removed)`` song counts.
         """
         #This method is implemented since the other scan methods all need to
         #use the same code. DRY FTW
-        
-        _supported_extns_regex = '|'.join(( '.*' + ext + '$' for ext
-                                            in SUPPORTED_AUDIO_EXTENSIONS))
-        regex  = re.compile(_supported_extns_regex, re.IGNORECASE)
+        known_songs = self.song_set.values_list(*_sync_fields).iterator()
 
-        #It's hackish, but far fewer transactions to delete everything first,
-        #and add it all back. If we get interrupted, just re-run it.
-        song_set.all().delete()
+        return self._sync_songs(self._walk_filesystem(), known_songs)
 
-        #For each filename that is supported
-        for filename in ifilter(lambda filename: re.match(regex, filename), filenames):
-            rel_url = os.path.join(dirname, filename)
-            full_url = os.path.abspath(rel_url)
-            new_song = Song(url = full_url)
-            new_song.save()
-            song_set.add(new_song)
+    def update_paths(self, urls):
+        """
+        Bring the database in line with the filesystem for a specific set of
+        files, without walking the rest of the archive. This is the
+        incremental counterpart of :func:`quick_scan` - files that exist are
+        inserted or updated, files that don't are deleted.
+
+        :param urls: Iterable of paths to files within this archive.
+        :rtype: Tuple of ``(added, changed, removed)`` song counts.
+        """
+        #Stored URLs are absolute, like the filesystem scan makes them
+        urls = set(os.path.abspath(url) for url in urls)
+
+        on_disk = {}
+        for url in ifilter(is_supported_file, urls):
+            file_stat = stat_file(url)
+            if file_stat is not None and os.path.isfile(url):
+                on_disk[url] = file_stat
+
+        known_songs = []
+        for chunk in chunked(urls):
+            known_songs.extend(self.song_set.filter(url__in = chunk)
+                                            .values_list(*_sync_fields))
+
+        return self._sync_songs(on_disk, known_songs)
+
+    def _sync_songs(self, on_disk, known_songs):
+        """
+        Apply the difference between the files found on disk and the songs
+        known to the database. Both arguments must cover the same part of the
+        archive - any known song missing from `on_disk` is deleted.
 
-    def _update_song_metadata(self, progress_callback = lambda x, y: None):
+        :param on_disk: Dictionary mapping full URLs to ``(size, mtime, inode)``
+        :param known_songs: Iterable of ``(id, url, size, mtime, inode)`` tuples
+        :rtype: Tuple of ``(added, changed, removed)`` song counts.
+        """
+        from song import Song
+        from smart_playlist import SmartPlaylist
+
+        changed  = {}
+        vanished = {}
+        vanished_by_inode = {}
+        for song_id, url, size, mtime, inode in known_songs:
+            file_stat = on_disk.pop(url, None)
+
+            if file_stat is None:
+                vanished[song_id] = url
+                vanished_by_inode.setdefault((inode, size), []).append(song_id)
+            elif file_stat != (size, mtime, inode):
+                changed[song_id] = file_stat
+
+        #Anything left over in on_disk is a new file, unless it was just moved
+        renamed = {}
+        for url, file_stat in on_disk.items():
+            size, mtime, inode = file_stat
+            song_ids = vanished_by_inode.get((inode, size))
+
+            if song_ids:
+                song_id = song_ids.pop()
+                renamed[song_id] = (url, file_stat)
+                del on_disk[url]
+
+                #Cached metadata is keyed by URL, so the old entry is useless
+                metadata_cache.invalidate(vanished.pop(song_id))
+
+        for url in vanished.itervalues():
+            metadata_cache.invalidate(url)
+
+        #Vanished songs are removed from the search index in one go below
+        with search.suspended():
+            with BatchWriter(Song) as writer:
+                for song_id, (size, mtime, inode) in changed.iteritems():
+                    writer.update(song_id, file_size = size,
+                                           file_mtime = mtime,
+                                           file_inode = inode,
+                                           metadata_stale = True,
+                                           cover_hash = None)
+
+                for song_id, (url, (size, mtime, inode)) in renamed.iteritems():
+                    writer.update(song_id, url = url,
+                                           file_size = size,
+                                           file_mtime = mtime,
+                                           file_inode = inode)
+
+                for song_id in vanished.iterkeys():
+                    writer.delete(song_id)
+
+                for url, (size, mtime, inode) in on_disk.iteritems():
+                    writer.insert(Song(url = url,
+                                       file_size = size,
+                                       file_mtime = mtime,
+                                       file_inode = inode,
+                                       metadata_stale = True,
+                                       parent_archive = self))
+
+        search.remove_songs(vanished.keys())
+
+        #bulk_create doesn't hand back ids, so new songs are found by URL.
+        #An unchanged rescan has nothing to refresh and stays at one query.
+        if (on_disk or renamed) and SmartPlaylist.objects.exists():
+            refreshed = renamed.keys()
+            for chunk in chunked(on_disk.iterkeys()):
+                refreshed.extend(self.song_set.filter(url__in = chunk)
+                                              .values_list('id', flat = True))
+
+            SmartPlaylist.refresh_songs(refreshed)
+
+        return (len(on_disk), len(changed), len(vanished))
+
+    def _update_song_metadata(self, progress_callback = lambda x, y: None,
+                              only_stale = False):
         """
         Scan every song in this archive (database only) and make sure all
         songs are correct. The progress_callback function is called with the
         current song being operated on first, and the total songs second.
 
+        Reading files is spread over a pool of
+        :data:`melodia_settings.METADATA_WORKERS` workers, and the results are
+        saved by this thread through a :class:`BatchWriter`.
+
         :param progess_callback: Function called to give progress. First
         argument is an integer for the song currently in progress, second
         argument is the total number of songs to be operated on.
+        :param only_stale: Boolean, if `True` only songs marked by the
+        filesystem scan as new or changed are refreshed.
         """
-        total_songs  = song_set.count()
+        from song import Song
+        from smart_playlist import SmartPlaylist
 
-        for index, song in enumerate(song_set.all()):
-            song.populate_metadata()
-            song.save()
-            progress_callback(index + 1, total_songs)
+        songs = self.song_set.all()
+        if only_stale:
+            songs = songs.filter(metadata_stale = True)
+
+        jobs = [(song_id, os.path.join(self.root_folder, url), file_hash)
+                for song_id, url, file_hash
+                in songs.values_list('id', 'url', 'file_hash').iterator()]
+        total_songs = len(jobs)
+
+        updated  = []
+        retagged = []
+        with BatchWriter(Song) as writer:
+            for index, (song_id, fields) in enumerate(iter_extracted(jobs)):
+                #Files that disappeared since the filesystem scan are left for
+                #the next scan to remove
+                if fields is not None:
+                    writer.update(song_id, **fields)
+                    updated.append(song_id)
+
+                    if 'title' in fields:
+                        retagged.append(song_id)
+
+                progress_callback(index + 1, total_songs)
+
+        #Only songs whose tags were actually re-read need re-indexing
+        search.index_songs(retagged)
+        SmartPlaylist.refresh_songs(updated)
 
     def _needs_backup(self):
         "Check if the current archive is due for a backup"
-        import datetime
-
         prev_backup_time = self.last_backup
-        current_time     = datetime.datetime.now()
+        current_time     = timezone.now()
 
         delta = current_time - prev_backup_time
         if delta > datetime.timedelta(seconds = self.backup_frequency):
@@ -120,9 +279,12 @@ class Archive (models.Model):
     def quick_scan(self):
         """
         Scan this archive's root folder, add or remove songs from the DB
-        as necessary.
+        as necessary. Only files that were added, changed or removed since
+        the last scan touch the database.
+
+        :rtype: Tuple of ``(added, changed, removed)`` song counts.
         """
-        self._scan_filesystem()
+        return self._scan_filesystem()
 
     def scan(self):
         """
@@ -134,15 +296,109 @@ class Archive (models.Model):
         self._scan_filesystem()
         self._update_song_metadata()
 
+    def update_covers(self, progress_callback = lambda x, y: None,
+                      only_missing = True):
+        """
+        Extract the cover art of this archive's songs and generate its
+        thumbnails, see :mod:`archiver.thumbnails`. Work is spread over a pool
+        of :data:`melodia_settings.THUMBNAIL_WORKERS` processes, and covers
+        shared by several songs are only stored and resized once.
+
+        :param progress_callback: Function called with the number of songs
+        done so far and the total number of songs.
+        :param only_missing: Boolean, if `True` only songs that haven't been
+        looked at since they were added or changed are processed.
+        """
+        from song import Song
+        from archiver.thumbnails import iter_covers
+
+        songs = self.song_set.all()
+        if only_missing:
+            songs = songs.filter(cover_hash__isnull = True)
+
+        jobs = [(song_id, os.path.join(self.root_folder, url))
+                for song_id, url in songs.values_list('id', 'url').iterator()]
+        total_songs = len(jobs)
+
+        with BatchWriter(Song) as writer:
+            for index, (song_id, cover_hash) in enumerate(iter_covers(jobs)):
+                #Unreadable files are tried again next time
+                if cover_hash is not None:
+                    writer.update(song_id, cover_hash = cover_hash)
+
+                progress_callback(index + 1, total_songs)
+
+    def update_waveforms(self, progress_callback = lambda x, y: None):
+        """
+        Decode the songs in this archive that have no waveform peaks yet and
+        store their peaks, see :mod:`archiver.waveform`. Work is spread over a
+        pool of :data:`melodia_settings.WAVEFORM_WORKERS` processes.
+
+        :param progress_callback: Function called with the number of songs
+        done so far and the total number of songs.
+        :rtype: Number of songs whose peaks couldn't be computed.
+        """
+        from archiver.waveform import iter_waveforms, song_key, waveform_path
+
+        songs = self.song_set.only('id', 'url', 'file_hash', 'file_size', 'file_mtime')
+
+        jobs = []
+        for song in songs.iterator():
+            path = waveform_path(song_key(song))
+            if not os.path.exists(path):
+                jobs.append((song.id, os.path.join(self.root_folder, song.url), path))
+        total_songs = len(jobs)
+
+        failed = 0
+        for index, (song_id, succeeded) in enumerate(iter_waveforms(jobs)):
+            if not succeeded:
+                failed += 1
+
+            progress_callback(index + 1, total_songs)
+
+        return failed
+
     def run_backup(self, force_backup = False):
         """
-        Backup the current archive
+        Backup the current archive. Local (or mounted) backup locations use
+        the incremental :class:`archiver.backup.BackupEngine`, which only copies
+        songs that changed since the last backup. Remote locations
+        (``host:/path``) are still handed to ``rsync``.
 
         :param force_backup: Boolean value, if `True` will ensure backup runs.
+        :rtype: Dictionary of statistics for this run, or ``None`` if no backup
+                was needed or rsync was used.
         """
-        if force_backup or self._needs_backup():
+        from archiver.backup import BackupEngine, is_local_location
+
+        if not self.backup_location:
+            return None
+
+        if not (force_backup or self._needs_backup()):
+            return None
+
+        run_stats = None
+        if is_local_location(self.backup_location):
+            run_stats = BackupEngine(self).run()
+            succeeded = not run_stats["errors"]
+        else:
             import subprocess
-            subprocess.call(['rsync', '-av', self.root_folder, self.backup_location])
+            succeeded = subprocess.call(['rsync', '-av', self.root_folder, self.backup_location]) == 0
+
+        if succeeded:
+            self.last_backup = timezone.now()
+            self.save()
+
+        return run_stats
+
+    def verify_backup(self):
+        """
+        Check this archive's local backup against its manifest, see
+        :func:`archiver.backup.BackupEngine.verify`.
+        """
+        from archiver.backup import BackupEngine
+
+        return BackupEngine(self).verify()
 
     def reorganize(self, format_string,
                     progress_function = lambda w, x, y, z: None,
@@ -170,64 +426,51 @@ class Archive (models.Model):
         All re-organization takes place relative to the archive's
         :data:`root_folder`.
 
+        All moves are planned before any file is touched - see
+        :mod:`archiver.reorganize`. Moves within a device are a rename,
+        moves across devices are copied and the original removed once the
+        database points at the copy. If a reorganize is interrupted, running
+        it again with the same `format_string` resumes where it stopped.
+
         :param format_string: String describing how each song should be re-organized
         :param progress_function: Optional function to get current progress - see notes below.
         :param dry_run: Boolean, if `True` will do everything except move files
+        :rtype: List of ``(song_id, url, new_url)`` moves that were skipped
+                because they would overwrite another song or an existing file,
+                or because the song's file had vanished.
 
         The progress_function is called with the current song number as its first argument, total songs as its second,
         current song URL as the third argument, and new URL as the fourth.
         """
-        import os, shutil, errno
-
-        total_songs = song_set.count()
-
-        for index, song in enumerate(song_set.all()):
-            _current_filename              = os.path.basename(song.url)
-            _current_filename_no_extension = os.path.splitext(_current_filename)[0]
-
-            _release_year = song.release_date.year
+        from song import Song
+        from archiver import reorganize
 
-            new_location = format_string.replace("%a", song.artist)\
-                                        .replace("%A", song.album)\
-                                        .replace("%d", str(song.disc_number))\
-                                        .replace("%e", str(song.disc_total))\
-                                        .replace("%f", _current_filename)\
-                                        .replace("%g", _current_filename_no_extension)\
-                                        .replace("%n", str(song.track_number))\
-                                        .replace("%o", str(song.track_total))\
-                                        .replace("%y", str(_release_year))
+        journal = reorganize.Journal(self)
 
-            new_url = os.path.join(self.root_folder, new_location)
-
-            progress_function(index + 1, total_songs, song.url, new_url)
-
-            if not dry_run:
-                new_folder = os.path.dirname(new_url)
-                try:
-                    #`mkdir -p` functionality
-                    if not os.path.isdir(new_folder):
-                        os.makedirs(new_folder)
+        resumed = None if dry_run else journal.load(format_string)
+        if resumed is not None:
+            moves, completed = resumed
+            moves      = [move for move in moves if (move[0], move[2]) not in completed]
+            collisions = []
+        else:
+            moves, collisions = reorganize.plan_moves(self, self.song_set.all(), format_string)
 
-                    #Safely copy the file - don't 'move' it, but do a full 'copy' 'rm'
-                    #This way if the process is ever interrupted, we have an unaltered copy
-                    #of the file.
-                    shutil.copyfile(song.url, new_url)
-                    shutil.copystat(song.url, new_url)
+        if dry_run:
+            for index, (song_id, url, new_url) in enumerate(moves):
+                progress_function(index + 1, len(moves), url, new_url)
+            return collisions
 
-                    #Notify the database about the new URL
-                    old_url  = song.url
-                    song.url = new_url
-                    song.save()
+        if resumed is None:
+            journal.start(format_string, moves)
 
-                    #Actually remove the file since all references to the original location have been removed
-                    os.remove(old_url)
+        def on_moved(song_id, new_url):
+            #Notify the database about the new URL
+            file_stat = os.stat(new_url)
+            Song.objects.filter(id = song_id).update(url = new_url,
+                                                     file_mtime = file_stat.st_mtime,
+                                                     file_inode = file_stat.st_ino)
 
-                except OSError as exc:
-                    if exc.errno == errno.EEXIST and os.path.isdir(new_folder):
-                        #This is safe to skip - makedirs() is complaining about a folder already existing
-                        pass
-                    else: raise
+        skipped = reorganize.execute_moves(moves, journal, on_moved, progress_function)
+        journal.finish()
 
-                except IOError as exc:
-                    #shutil error - likely that folders weren't specified correctly raise
-					raise
+        return collisions + skipped
@@ -1,14 +1,20 @@
 """
 The Feed model describes a podcast of anything that can be parsed by :mod:`feedparser`.
-Most of the heavy lifting is done via :mod:`feedparser`, we just download the
-podcast files.
+Feeds are read with :mod:`archiver.feed_parser`, which only parses as far into
+the feed as it needs to, and falls back to :mod:`feedparser` for documents it
+can't handle - we just download the podcast files.
 """
 
 from django.db import models
-import datetime, time
+from django.utils import timezone
+from warnings import warn
+import calendar, datetime, os, urllib, urlparse
 import feedparser
 
 from archive import Archive
+from archiver import download, feed_parser
+from Melodia import melodia_settings
+from archiver.utils import is_supported_file
 
 # What mime types should be downloaded from the podcast XML
 _audio_type_mime_types = [
@@ -50,71 +56,211 @@ class Feed(models.Model):
 
        Reference to the :class:`Archive` this podcast belongs to. Informs the
        feed where it should store its files at.
+
+    .. data:: etag
+
+       String ``ETag`` header sent with the feed the last time it was
+       downloaded. Used to skip downloading a feed that hasn't changed.
+
+    .. data:: last_modified
+
+       String ``Last-Modified`` header sent with the feed the last time it was
+       downloaded. Used like :data:`etag`, for servers without ETags.
+
+    .. data:: update_interval
+
+       Integer number of seconds typically between two episodes of this
+       podcast, as seen in the feed the last time it was downloaded. ``0``
+       if it isn't known yet. Used by the :class:`FeedScheduler` to decide
+       how often to check the feed.
+
+    .. data:: next_sync
+
+       DateTime object for when the :class:`FeedScheduler` should next sync
+       this podcast, or ``None`` if it has never been scheduled.
+
+    .. data:: sync_failures
+
+       Integer number of syncs in a row that have failed. The scheduler backs
+       off for longer after each one.
     """
 
     url = models.URLField()
     name = models.CharField(max_length = 64)
     max_episodes = models.IntegerField(default = 0) # Default store everything
     current_episodes = models.IntegerField(default = 0)
-    last_episode = models.DateTimeField(default = datetime.datetime(1970, 1, 1))
+    last_episode = models.DateTimeField(default = timezone.make_aware(datetime.datetime(1970, 1, 1), timezone.utc))
     parent_archive = models.ForeignKey(Archive)
+    etag = models.CharField(max_length = 255, blank = True, default = "")
+    last_modified = models.CharField(max_length = 64, blank = True, default = "")
+    update_interval = models.IntegerField(default = 0)
+    next_sync = models.DateTimeField(default = None, null = True)
+    sync_failures = models.IntegerField(default = 0)
 
     class Meta:
         app_label = 'archiver'
 
-    def _get_episode_time(episode):
+    def _get_folder(self):
+        "Folder this podcast's episodes are stored in"
+        return os.path.join(self.parent_archive.root_folder, self.name)
+
+    def _get_episode_time(self, episode):
         """
-        Get a datetime.datetime object of a podcast episode's published time.
-        Expects a specific element from feed_object.entries.
+        Get an aware (UTC) datetime.datetime object of a podcast episode's
+        published time. Expects a single episode from :func:`_read_episodes`.
         """
-        t = time.mktime(episode.published_parsed)
-        return datetime.datetime.fromtimestamp(t)
+        published = episode.get('published_parsed') or episode.get('updated_parsed')
+        if published is None:
+            return None
+
+        return timezone.make_aware(datetime.datetime.utcfromtimestamp(calendar.timegm(published)),
+                                   timezone.utc)
+
+    def _get_episode_link(self, episode):
+        "Get the URL of the audio file for an episode, or None if there isn't one"
+        for link in episode.get('enclosures', []) + episode.get('links', []):
+            if link.get('type') in _audio_type_mime_types and link.get('href'):
+                return link['href']
+
+        return None
 
-    def _calculate_new_episodes(feed_object):
+    def _get_episode_url(self, episode_time, link):
         """
-        Calculate how many new episodes there are of a podcast (and consequently
-        how many we need to remove).
+        Get the local URL an episode is stored at. File names start with the
+        publishing date, so that they sort oldest first.
+        """
+        filename = os.path.basename(urllib.unquote(urlparse.urlsplit(link).path))
+        return os.path.join(self._get_folder(),
+                            "%s %s" % (episode_time.strftime("%Y-%m-%d"), filename))
+
+    def _calculate_new_episodes(self, episodes, forbid_delete = False):
+        """
+        Find the episodes of a podcast published since the last one downloaded.
+
+        :rtype: List of ``(episode_time, link)`` tuples, newest first.
         """
-        num_episodes = 0
+        new_episodes = []
 
-        #feed_object.entries starts at the most recent
-        for episode in feed_object.entries:
-            if _get_episode_time(episode) > last_episode:
-                num_episodes += 1
+        for episode in episodes:
+            episode_time = self._get_episode_time(episode)
+            link         = self._get_episode_link(episode)
+            if episode_time is None or link is None or episode_time <= self.last_episode:
+                continue
 
-            #Don't set ourselves up to download any more than max_episodes
-            if num_episodes > max_episodes and max_episodes > 0:
-                return num_episodes
+            new_episodes.append((episode_time, link))
 
-        return num_episodes
+        new_episodes.sort(reverse = True)
 
-    def _download_podcast(feed_object, num_episodes = -1):
+        #Don't set ourselves up to download any more than max_episodes
+        if self.max_episodes > 0 and not forbid_delete:
+            new_episodes = new_episodes[:self.max_episodes]
+
+        return new_episodes
+
+    def _calculate_update_interval(self, episodes):
         """
-        Update this podcast with episodes from the server copy. The feed_object is a reference to a
-        feedparser object so we don't have to redownload a feed multiple times.
+        Work out how often this podcast publishes, from the times of the
+        episodes in the feed.
+
+        :rtype: Median number of seconds between episodes, or ``0`` if there
+                aren't enough episodes to tell.
         """
+        episode_times = sorted(filter(None, (self._get_episode_time(episode)
+                                             for episode in episodes)))
+        gaps = sorted((later - earlier).total_seconds()
+                      for earlier, later in zip(episode_times, episode_times[1:]))
+        gaps = [gap for gap in gaps if gap > 0]
+        if not gaps:
+            return 0
 
-        num_episodes = _calculate_new_episodes()
+        return int(gaps[len(gaps) // 2])
 
-        #feedparser-specific way of building the list
-        new_episodes = feed_object.entries[:num_episodes]
+    def _read_episodes(self, stream):
+        """
+        Read the episodes of the feed document in `stream`, newest first. With
+        :data:`melodia_settings.FEED_STREAMING_PARSE` set, only the head of
+        the feed up to the last episode already downloaded is read.
+        """
+        if not melodia_settings.FEED_STREAMING_PARSE:
+            return feedparser.parse(stream.read()).entries
 
-        for episode in new_episodes:
-            episode_audio_links = [link for link in episodes['links']
-                                            if link['type'] in _audio_type_mime_types_string]
+        return feed_parser.read_episodes(stream, self.last_episode)
 
-            print episode_audio_links
+    def _stored_episodes(self):
+        "Get the URLs of the episodes stored locally, oldest first"
+        folder = self._get_folder()
+        if not os.path.isdir(folder):
+            return []
 
-                
-    def sync_podcast(dry_run = False, forbid_delete = False):
+        return sorted(os.path.join(folder, filename)
+                      for filename in os.listdir(folder) if is_supported_file(filename))
+
+    def sync_podcast(self, dry_run = False, forbid_delete = False):
+        """
+        Update the podcast with episodes from the server copy. New episodes
+        are downloaded in parallel by a :class:`download.DownloadEngine`, and
+        the parent :class:`Archive` is updated with the files that were added
+        or removed. If the feed hasn't changed since the last sync, this is a
+        single conditional request.
+
+        :param dry_run: Calculate what would have been downloaded or deleted, but do not actually do either.
+        :param forbid_delete: Run, and only download new episodes. Ignores the :data:`max_episodes` field for this podcast.
+        :rtype: Tuple of ``(downloaded, deleted)`` lists of local URLs.
         """
-        Update the podcast with episodes from the server copy.
+        response, etag, last_modified = download.open_feed(self.url, self.etag, self.last_modified)
+        if response is None:
+            return ([], [])
 
-		:param dry_run: Calculate what would have been downloaded or deleted, but do not actually do either.
-		:param forbid_delete: Run, and only download new episodes. Ignores the :data:`max_episodes` field for this podcast.
+        try:
+            episodes = self._read_episodes(response)
+        finally:
+            #Anything after the episodes we needed is never downloaded
+            response.close()
 
-		.. todo::
-		   Actually write this method...
+        #Keep the old estimate if too little of the feed was read to tell
+        self.update_interval = self._calculate_update_interval(episodes) or self.update_interval
+        new_episodes = self._calculate_new_episodes(episodes, forbid_delete)
 
-        """
-        pass
+        #Episodes already on disk (from a sync that was partly successful) are kept
+        jobs = [(link, self._get_episode_url(episode_time, link))
+                for episode_time, link in new_episodes
+                if not os.path.exists(self._get_episode_url(episode_time, link))]
+
+        stored_episodes = self._stored_episodes()
+        if dry_run:
+            obsolete = []
+            if self.max_episodes > 0 and not forbid_delete:
+                episodes = sorted(set(stored_episodes + [url for link, url in jobs]))
+                obsolete = episodes[:-self.max_episodes]
+
+            return ([url for link, url in jobs], obsolete)
+
+        stats = download.DownloadEngine().run(jobs)
+        for url, error in stats["errors"].iteritems():
+            warn("The podcast episode: " + url + " could not be downloaded: " + error)
+
+        obsolete = []
+        if self.max_episodes > 0 and not forbid_delete:
+            episodes = sorted(set(stored_episodes + stats["downloaded"]))
+            obsolete = episodes[:-self.max_episodes]
+            for url in obsolete:
+                os.remove(url)
+
+        self.parent_archive.update_paths(stats["downloaded"] + obsolete)
+
+        #Only move past episodes up to the oldest one that failed, so it is
+        #retried on the next sync
+        for episode_time, link in reversed(new_episodes):
+            if self._get_episode_url(episode_time, link) in stats["errors"]:
+                break
+            self.last_episode = max(self.last_episode, episode_time)
+
+        #If anything failed, the feed has to be fetched again next time to retry it
+        if not stats["errors"]:
+            self.etag          = etag or ""
+            self.last_modified = last_modified or ""
+
+        self.current_episodes = len(self._stored_episodes())
+        self.save()
+
+        return (stats["downloaded"], obsolete)
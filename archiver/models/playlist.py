@@ -7,13 +7,15 @@ This way we can guarantee song order, re-order the playlist, have songs
 appear multiple times, etc.
 """
 
-from django.db import models
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 
 from song import Song
+from playlist_entry import PlaylistEntry
 from archiver.listfield import IntegerListField
+from archiver.utils import chunked
 
-import re
+import itertools, os, re, urllib, urlparse
 from warnings import warn
 
 class Playlist(models.Model):
@@ -29,10 +31,50 @@ class Playlist(models.Model):
 
 	   List made up of Python integers. Each integer is assumed
 	   to be a primary key to the :data:`Song.id` field for a song.
+
+	.. data:: use_entries
+
+	   Boolean selecting the storage mode. If `False` (the default), songs are
+	   kept in :data:`song_list` and written out in full when the playlist is
+	   saved. If `True`, songs are kept as :class:`PlaylistEntry` rows with
+	   gap-based ordering keys, so :func:`insert`, :func:`move` and
+	   :func:`remove` write a single row straight away - better for very long
+	   playlists. Use :func:`convert_to_entries` to switch an existing playlist.
 	"""
 
-	name       = models.CharField(max_length = 255)
-	song_list = IntegerListField()
+	name        = models.CharField(max_length = 255)
+	song_list   = IntegerListField()
+	use_entries = models.BooleanField(default = False)
+
+	def _entry_at(self, position):
+		"Return the :class:`PlaylistEntry` at a list index, or None"
+		entries = list(self.entries.order_by('position')[position:position + 1])
+		return entries[0] if entries else None
+
+	def convert_to_entries(self):
+		"""
+		Switch this playlist to the entry-based storage mode (see
+		:data:`use_entries`), moving the current :data:`song_list` over.
+		"""
+		if self.use_entries:
+			return
+
+		song_ids = list(self.song_list)
+
+		self.use_entries = True
+		self.song_list   = []
+		self.save()
+
+		self._replace_entries(song_ids)
+
+	def _replace_entries(self, song_ids):
+		"Replace every entry of this playlist with the given songs, in order"
+		with transaction.commit_on_success():
+			self.entries.all().delete()
+			PlaylistEntry.objects.bulk_create([
+					PlaylistEntry(playlist = self, song_id = song_id,
+					              position = (index + 1) * PlaylistEntry.GAP)
+					for index, song_id in enumerate(song_ids)])
 
 	def insert(self, position, new_song):
 		"""
@@ -45,7 +87,13 @@ class Playlist(models.Model):
 		if not isinstance(new_song, Song):
 			#Not given a song reference, raise an error
 			raise ValidationError("Not given a song reference to insert.")
-			
+
+		if self.use_entries:
+			next_entry = self._entry_at(position)
+			PlaylistEntry(playlist = self, song = new_song,
+			              position = PlaylistEntry.key_between(self, next_entry)).save()
+			return
+
 		self.song_list.insert(position, new_song.id)
 
 	def append(self, new_song):
@@ -59,6 +107,12 @@ class Playlist(models.Model):
 			#Not given a song reference, raise an error
 			raise ValidationError("Not given a song reference to insert.")
 
+		if self.use_entries:
+			last_position = self.entries.aggregate(models.Max('position'))['position__max'] or 0
+			PlaylistEntry(playlist = self, song = new_song,
+			              position = last_position + PlaylistEntry.GAP).save()
+			return
+
 		self.song_list.append(new_song.id)
 
 	def move(self, original_position, new_position):
@@ -87,6 +141,17 @@ class Playlist(models.Model):
 		if original_position == new_position:
 			return
 
+		if self.use_entries:
+			moved_entry = self._entry_at(original_position)
+			if moved_entry is None:
+				return False
+
+			#Placed above the song at new_position, so no shifting to account for
+			next_entry = self._entry_at(new_position)
+			moved_entry.position = PlaylistEntry.key_between(self, next_entry, exclude = moved_entry)
+			moved_entry.save()
+			return
+
 		song_id = self.song_list[original_position]
 
 		if new_position < original_position:
@@ -103,58 +168,106 @@ class Playlist(models.Model):
 
 		:param position: Index of the song to be removed
 		"""
+		if self.use_entries:
+			removed_entry = self._entry_at(position)
+			if removed_entry is None:
+				return False
+
+			removed_entry.delete()
+			return
+
 		if position > len(self.song_list):
 			return False
 
 		del self.song_list[position]
 
-	def export(self, playlist_type = "m3u"):
+	def _iter_songs(self):
 		"""
-		Export this internal playlist to a file format.
+		Iterate over the songs in this playlist, in order. Songs are fetched
+		with one query per chunk of the playlist rather than one per entry.
+		Songs that no longer exist are skipped.
+		"""
+		if self.use_entries:
+			#Entries are read in key order, along with their songs
+			for entry in self.entries.select_related('song').order_by('position').iterator():
+				yield entry.song
+			return
+
+		for chunk in chunked(self.song_list):
+			songs = Song.objects.in_bulk(set(chunk))
+
+			for song_id in chunk:
+				if song_id in songs:
+					yield songs[song_id]
+
+	def iter_export(self, playlist_type = "m3u"):
+		"""
+		Export this internal playlist to a file format, one line at a time.
+		This lets the web layer stream a playlist without building it in memory.
 		Supported formats:
 
 		   * pls
 		   * m3u
 
 		:param playlist_type: String containing the file type to export to
-		:rtype: String containing the file content for this playlist.
+		:rtype: Generator of strings, each a line of the playlist (including the newline).
 		"""
 
 		if playlist_type == "pls":
 			#Playlist header
-			playlist_string = "[playlist]"
+			yield u"[playlist]\n"
 
 			#Playlist body
-			for index, song_id in enumerate(self.song_list):
-				song = self.songs.get(id = song_id)
-
-				playlist_string += "File" + str(index + 1) + "=" + song.url + "\n"
-				playlist_string += "Title" + str(index + 1) + "=" + song.title + "\n"
-				playlist_string += "Length" + str(index + 1) + "=" + str(song.duration) + "\n"
+			entries = 0
+			for song in self._iter_songs():
+				entries += 1
+				yield u"File%d=%s\n" % (entries, song.url)
+				yield u"Title%d=%s\n" % (entries, song.title)
+				yield u"Length%d=%d\n" % (entries, song.duration)
 
 			#Playlist footer
-			playlist_string += "NumberOfEntries=" + str(len(self.song_list))
-			playlist_string += "Version=2"
-			return playlist_string
+			yield u"NumberOfEntries=%d\n" % entries
+			yield u"Version=2\n"
 
 		elif playlist_type == "m3u":
 			#Playlist header
-			playlist_string += "#EXTM3U" + "\n"
+			yield u"#EXTM3U\n"
 
 			#Playlist body
-			for song_id in self.song_list:
-				song = self.songs.get(id = song_id)
+			for song in self._iter_songs():
+				yield u"#EXTINF:%d,%s - %s\n" % (song.duration, song.artist, song.title)
+				yield song.url + u"\n"
 
-				playlist_string += "#EXTINF:" + str(song.duration) + "," + song.artist + " - " + song.title + "\n"
-				playlist_string += song.url + "\n\n"
+		else:
+			raise ValueError("Unsupported playlist type: " + playlist_type)
 
-			return playlist_string
+	def export(self, playlist_type = "m3u"):
+		"""
+		Export this internal playlist to a file format.
+		See :func:`iter_export` for the supported formats.
 
-	def playlist_import(self, playlist_string = None):
+		:param playlist_type: String containing the file type to export to
+		:rtype: String containing the file content for this playlist.
+		"""
+		return u"".join(self.iter_export(playlist_type))
+
+	def playlist_import(self, playlist_string = None, base_folder = None,
+	                    case_insensitive = False):
 		"""
 		Import and convert a playlist into native DB format.
 
-		:param playlist_string: A string with the file content we're trying to import.
+		The playlist is parsed line by line, and its entries are resolved
+		against the database in chunks - one query per chunk of entries
+		rather than one per entry. Entries may be absolute paths, paths
+		relative to `base_folder`, or ``file://`` URIs.
+
+		:param playlist_string: A string with the file content we're trying to
+		                        import, or a file-like object to read it from.
+		:param base_folder: Folder that relative entries are relative to -
+		                    usually the folder the playlist file was in.
+		:param case_insensitive: Boolean, if `True` entries that don't match a
+		                         song exactly are matched ignoring case (for
+		                         playlists from case-insensitive filesystems).
 
 		:rtype: Returns true of the playlist format was recognized. See notes on processing below.
 
@@ -166,64 +279,103 @@ class Playlist(models.Model):
 
 		   For example, if you try to import a song which does not exist in an :class:`Archive`,
 		   it will fail that song silently.
-
-		.. todo::
-
-		   Actually write the import code.
 		"""
-		#TODO: Code playlist importing
-		self.song_list = []
 		if not playlist_string:
 			#Make sure we have a string to operate on.
 			return False
 
-		#Figure out what format we're in
-		if playlist_string[0:7] == "#EXTM3U":
-			#Import m3u format playlist
-			print playlist_string
+		if isinstance(playlist_string, basestring):
+			lines = iter(playlist_string.splitlines())
+		else:
+			lines = iter(playlist_string)
 
-			#Expected format is "#EXTINF:" followed by the song url on the next line.
-			line_iterator = playlist_string.split("\n").__iter__()
+		#Figure out what format we're in, from the first non-blank line
+		header = next((line.strip() for line in lines if line.strip()), "")
 
-			#In case we end iteration early
-			try:
-				for line in line_iterator:
+		if header[0:7].upper() == "#EXTM3U":
+			#Expected format is "#EXTINF:" lines followed by the song url,
+			#anything else that isn't a comment is a song url too
+			entries = (line.strip() for line in lines
+			           if line.strip() and not line.startswith("#"))
 
-					if line[0:8] == "#EXTINF:":
-						song_url = line_iterator.next() #Consume the next line
+		elif header[0:10].lower() == "[playlist]":
+			#This one is a bit simpler - we're just looking for lines like "File1="
+			entries = (match.group(1).strip() for match in itertools.imap(_pls_file_regex.match, lines)
+			           if match)
 
-						try:
-							song = Song.objects.get(url = song_url)
-							self.append(song)
+		else:
+			#If we got here, the playlist format wasn't recognized.
+			return False
 
-						except ObjectDoesNotExist:
-							#The URL of our song could not be found
-							warn("The playlist entry: " + song_url + " could not be found, and has not been added to your playlist.")
-							continue
+		song_ids = []
+		resolver = _SongResolver(base_folder, case_insensitive)
+		for chunk in chunked(entries):
+			for song_url, song_id in resolver.resolve(chunk):
+				if song_id is None:
+					#The URL of our song could not be found
+					warn("The playlist entry: " + song_url + " could not be found, and has not been added to your playlist.")
+					continue
 
-			#Silently end processing
-			except StopIteration:
-				pass
+				song_ids.append(song_id)
 
-			return True
+		if self.use_entries:
+			self._replace_entries(song_ids)
+		else:
+			self.song_list = song_ids
 
-		if playlist_string[0:10] == "[playlist]":
-			#Import pls format playlist
-			#This one is a bit simpler - we're just looking for lines that start with "File="
-			pls_regex = re.compile("^File=", re.IGNORECASE)
+		return True
 
-			for file_line in pls_regex.match(pls_regex, playlist_string):
-				song_url = file_line[5:]
-				try:
-					song = Song.objects.get(url = song_url)
-					self.append(song)
+_pls_file_regex = re.compile(r"^\s*File[0-9]+\s*=(.*)$", re.IGNORECASE)
 
-				except ObjectDoesNotExist:
-					#The URL of our song could not be found
-					warn("The playlist entry: " + song_url + " could not be found, and has not been added to your playlist.")
-					continue
+class _SongResolver(object):
+	"""
+	Turns playlist entries into :class:`Song` ids for :func:`Playlist.playlist_import`.
+	Entries are normalised (``file://`` URIs, relative paths) and looked up
+	in bulk. The case-insensitive map of every song URL is only built once
+	per import, and only if an entry fails to match exactly.
+	"""
+
+	def __init__(self, base_folder = None, case_insensitive = False):
+		self.base_folder      = base_folder
+		self.case_insensitive = case_insensitive
+		self._folded_urls     = None
+
+	def normalise(self, entry):
+		"Turn a playlist entry into the absolute path a Song would have"
+		if entry.lower().startswith("file://"):
+			entry = urllib.unquote(urlparse.urlparse(entry).path)
+
+		if not os.path.isabs(entry) and self.base_folder:
+			entry = os.path.join(self.base_folder, entry)
+
+		if os.path.isabs(entry):
+			entry = os.path.normpath(entry)
+
+		return entry
+
+	def _folded(self):
+		if self._folded_urls is None:
+			self._folded_urls = dict((url.lower(), song_id) for url, song_id
+			                         in Song.objects.values_list('url', 'id').iterator())
+
+		return self._folded_urls
+
+	def resolve(self, entries):
+		"""
+		Resolve a chunk of entries with a single query.
+
+		:rtype: List of ``(entry, song_id)`` in the same order as `entries`.
+		        `song_id` is ``None`` for entries that match no song.
+		"""
+		urls  = [self.normalise(entry) for entry in entries]
+		found = dict(Song.objects.filter(url__in = set(urls)).values_list('url', 'id'))
+
+		resolved = []
+		for entry, url in itertools.izip(entries, urls):
+			song_id = found.get(url)
+			if song_id is None and self.case_insensitive:
+				song_id = self._folded().get(url.lower())
 
-			return True
+			resolved.append((entry, song_id))
 
-		#If we got here, the playlist format wasn't recognized.
-		return False
+		return resolved
@@ -0,0 +1,104 @@
+"""
+The :class:`PlaylistEntry` model backs the entry-based storage mode of a
+:class:`Playlist`. Each entry is one row with an ordering key
+(:data:`position`). Keys are spaced :data:`PlaylistEntry.GAP` apart, so
+inserting or moving an entry only has to pick a key between its new
+neighbours and update that one row. When two neighbours run out of room
+between them, the playlist's keys are renumbered - which is rare, and the
+only time more than one row is rewritten (in a couple of bulk UPDATEs).
+"""
+
+from django.db import connection, models, transaction
+from django.db.models import F
+
+from song import Song
+from archiver.utils import chunked, QUERY_CHUNK_SIZE
+
+class PlaylistEntry(models.Model):
+	"""
+	.. data:: playlist
+
+	   Reference to the :class:`Playlist` this entry belongs to.
+
+	.. data:: song
+
+	   Reference to the :class:`Song` at this point of the playlist.
+
+	.. data:: position
+
+	   Integer ordering key. Only the order of the keys is meaningful, not
+	   their values - use list indexes when talking to :class:`Playlist`.
+	"""
+
+	playlist = models.ForeignKey('Playlist', related_name = 'entries')
+	song     = models.ForeignKey(Song)
+	position = models.BigIntegerField()
+
+	#Space between the keys of neighbouring entries after a renumber
+	GAP = 2 ** 20
+
+	class Meta:
+		app_label = 'archiver'
+		ordering  = ('position',)
+		unique_together = (('playlist', 'position'),)
+
+	@classmethod
+	def renumber(cls, playlist):
+		"Spread a playlist's keys :data:`GAP` apart again, keeping their order"
+		entry_ids = list(cls.objects.filter(playlist = playlist)
+		                            .order_by('position').values_list('id', flat = True))
+		new_keys  = [(entry_id, (index + 1) * cls.GAP) for index, entry_id in enumerate(entry_ids)]
+
+		table  = connection.ops.quote_name(cls._meta.db_table)
+		cursor = connection.cursor()
+
+		with transaction.commit_on_success():
+			#Move everything out of the way first so the unique constraint holds
+			cls.objects.filter(playlist = playlist).update(position = F('position') * -1)
+
+			#One CASE per chunk - three parameters per entry
+			for chunk in chunked(new_keys, QUERY_CHUNK_SIZE // 2):
+				cursor.execute("UPDATE %s SET position = CASE id %s END WHERE id IN (%s)"
+				               % (table, " ".join(["WHEN %s THEN %s"] * len(chunk)),
+				                  ", ".join(["%s"] * len(chunk))),
+				               [value for entry_key in chunk for value in entry_key] +
+				               [entry_id for entry_id, key in chunk])
+
+			#Raw SQL doesn't tell Django there is something to commit
+			transaction.set_dirty()
+
+	@classmethod
+	def key_between(cls, playlist, next_entry, exclude = None):
+		"""
+		Find an ordering key that places an entry just before `next_entry`,
+		renumbering the playlist if there is no room left. The neighbour is
+		found by seeking on the ``(playlist, position)`` index, so the cost
+		doesn't grow with how far into the playlist the entry goes.
+
+		:param playlist: The :class:`Playlist`
+		:param next_entry: The :class:`PlaylistEntry` to place the entry
+		                   before, or ``None`` to place it at the end
+		:param exclude: Optional entry to ignore (the one being moved)
+		"""
+		for attempt in range(2):
+			entries = cls.objects.filter(playlist = playlist)
+			if exclude is not None:
+				entries = entries.exclude(id = exclude.id)
+
+			if next_entry is None:
+				#Past the end of the playlist - append
+				before = entries.aggregate(models.Max('position'))['position__max'] or 0
+				return before + cls.GAP
+
+			after  = next_entry.position
+			before = list(entries.filter(position__lt = after).order_by('-position')
+			                     .values_list('position', flat = True)[:1])
+			before = before[0] if before else 0
+
+			if after - before > 1:
+				return (before + after) // 2
+
+			cls.renumber(playlist)
+			next_entry.position = cls.objects.filter(id = next_entry.id).values_list('position', flat = True)[0]
+
+		raise RuntimeError("Could not find room in playlist %d after renumbering" % playlist.id)
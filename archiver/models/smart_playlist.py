@@ -0,0 +1,214 @@
+"""
+A :class:`SmartPlaylist` is a playlist defined by a filter expression over
+:class:`Song` fields (see :mod:`archiver.smart_query`), like
+``rating >= 4 and genre = rock``. Its membership is stored in the database
+rather than being worked out every time the playlist is viewed. When songs
+are added or change, only those songs are checked against each smart
+playlist - the song table is only scanned in full when a playlist's
+expression is first set or changed.
+
+Refreshes triggered by songs saved one at a time can be collected with
+:func:`SmartPlaylist.deferred_refresh` and run together at the end. Whether
+any smart playlists exist is remembered in the shared Django cache, so saving
+a song costs nothing extra in a library without them.
+"""
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.exceptions import ValidationError
+
+from song import Song
+from archiver import smart_query
+from archiver.utils import chunked
+
+#Song ids waiting for a refresh, while in a deferred_refresh() block
+_deferred = threading.local()
+
+#Cache key remembering whether there are any smart playlists at all
+_exist_key = "melodia.smart_playlists.exist"
+
+class SmartPlaylist(models.Model):
+	"""
+	.. data:: name
+
+	   String with the human-readable name for this playlist.
+
+	.. data:: query
+
+	   String with the filter expression selecting the songs in this playlist.
+	   See :mod:`archiver.smart_query` for the syntax.
+
+	.. data:: songs
+
+	   The songs currently matching :data:`query`. This is maintained by the
+	   archiver, and shouldn't be changed by hand.
+	"""
+
+	class Meta:
+		app_label = 'archiver'
+
+	name  = models.CharField(max_length = 255)
+	query = models.TextField()
+	songs = models.ManyToManyField(Song, related_name = 'smart_playlists')
+
+	def __init__(self, *args, **kwargs):
+		super(SmartPlaylist, self).__init__(*args, **kwargs)
+
+		#Remember the saved expression, so save() knows when to rebuild
+		self._saved_query = self.query if self.pk else None
+
+	def _filter(self):
+		"Return the :class:`Q` object for this playlist's expression"
+		return smart_query.parse(self.query)
+
+	def clean(self):
+		try:
+			self._filter()
+		except smart_query.FilterSyntaxError as exc:
+			raise ValidationError(str(exc))
+
+	def save(self, *args, **kwargs):
+		#Check the expression before anything is written
+		self._filter()
+
+		super(SmartPlaylist, self).save(*args, **kwargs)
+
+		if self.query != self._saved_query:
+			self.rebuild()
+			self._saved_query = self.query
+
+	def rebuild(self):
+		"Recompute the membership of this playlist from every song"
+		through = self.songs.through
+
+		with transaction.commit_on_success():
+			through.objects.filter(smartplaylist = self).delete()
+
+			song_ids = Song.objects.filter(self._filter()).values_list('id', flat = True)
+			for chunk in chunked(song_ids.iterator()):
+				through.objects.bulk_create([through(smartplaylist = self, song_id = song_id)
+				                             for song_id in chunk])
+
+	def _update_chunk(self, chunk, members = None):
+		"""
+		Bring the membership of a chunk of songs up to date.
+
+		:param members: Set of the ids in `chunk` that are currently members,
+		                or None to look them up
+		"""
+		through  = self.songs.through
+		matching = set(Song.objects.filter(id__in = chunk)
+		                           .filter(self._filter()).values_list('id', flat = True))
+		if members is None:
+			members = set(through.objects.filter(smartplaylist = self, song_id__in = chunk)
+			                             .values_list('song_id', flat = True))
+
+		if members - matching:
+			through.objects.filter(smartplaylist = self,
+			                       song_id__in = list(members - matching)).delete()
+
+		if matching - members:
+			through.objects.bulk_create([through(smartplaylist = self, song_id = song_id)
+			                             for song_id in matching - members])
+
+	def update_songs(self, song_ids):
+		"""
+		Bring the membership of some songs up to date - songs that now match
+		are added, and songs that no longer match are removed. Only the given
+		songs are looked at, so the cost depends on how many songs changed
+		rather than on the size of the library.
+
+		:param song_ids: List of :class:`Song` ids that were added or changed
+		"""
+		with transaction.commit_on_success():
+			for chunk in chunked(song_ids):
+				self._update_chunk(chunk)
+
+	@classmethod
+	def refresh_songs(cls, song_ids):
+		"""
+		Update every smart playlist for songs that were added or changed.
+		Songs that are deleted drop out of smart playlists by themselves.
+		The current memberships of the songs in all playlists are read at
+		once, so each playlist only costs the query matching its expression
+		(and any writes).
+
+		:param song_ids: List of :class:`Song` ids
+		"""
+		if not song_ids:
+			return
+
+		pending = getattr(_deferred, 'song_ids', None)
+		if pending is not None:
+			pending.update(song_ids)
+			return
+
+		smart_playlists = list(cls.objects.all())
+		if not smart_playlists:
+			return
+
+		through = cls.songs.through
+		with transaction.commit_on_success():
+			for chunk in chunked(song_ids):
+				members = defaultdict(set)
+				for smart_playlist_id, song_id in (through.objects.filter(song_id__in = chunk)
+				                                          .values_list('smartplaylist_id', 'song_id')):
+					members[smart_playlist_id].add(song_id)
+
+				for smart_playlist in smart_playlists:
+					smart_playlist._update_chunk(chunk, members[smart_playlist.id])
+
+	@classmethod
+	@contextmanager
+	def deferred_refresh(cls):
+		"""
+		Collect the refreshes asked for within a ``with`` block - such as those
+		of songs saved one at a time - and run them as one refresh at the end:
+
+		.. code-block:: python
+
+		   with SmartPlaylist.deferred_refresh():
+		       for song in songs:
+		           song.rating = 5
+		           song.save()
+		"""
+		if getattr(_deferred, 'song_ids', None) is not None:
+			#Nested - the outermost block refreshes
+			yield
+			return
+
+		_deferred.song_ids = set()
+		try:
+			yield
+			song_ids = _deferred.song_ids
+		finally:
+			_deferred.song_ids = None
+
+		cls.refresh_songs(list(song_ids))
+
+def _smart_playlists_exist():
+	"Check whether there are any smart playlists, without a query most of the time"
+	exist = cache.get(_exist_key)
+	if exist is None:
+		exist = SmartPlaylist.objects.exists()
+		cache.set(_exist_key, exist)
+
+	return exist
+
+def _smart_playlists_changed(**kwargs):
+	"Forget whether smart playlists exist - connected to their signals"
+	cache.delete(_exist_key)
+
+def _song_saved(sender, instance, raw = False, **kwargs):
+	"Keep smart playlists up to date with songs saved one at a time, e.g. a new rating"
+	if not raw and _smart_playlists_exist():
+		SmartPlaylist.refresh_songs([instance.id])
+
+post_save.connect(_song_saved, sender = Song)
+post_save.connect(_smart_playlists_changed, sender = SmartPlaylist)
+post_delete.connect(_smart_playlists_changed, sender = SmartPlaylist)
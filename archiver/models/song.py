@@ -5,8 +5,11 @@ about the song.
 """
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from Melodia import melodia_settings
 
+from archiver import hashing, metadata, search
+
 from archive import Archive
 
 import datetime
@@ -109,11 +112,38 @@ class Song (models.Model):
 
 	   Size of the file in bytes.
 
+	.. data:: file_mtime
+
+	   Modification time of the file (seconds since the epoch, floating-point)
+	   as of the last filesystem scan.
+
+	.. data:: file_inode
+
+	   Inode number of the file as of the last filesystem scan. Used to
+	   recognize files that were moved within the archive.
+
+	.. data:: metadata_stale
+
+	   Boolean set by the filesystem scan when this file is new or has
+	   changed on disk, and cleared once its metadata has been refreshed.
+
+	.. data:: cover_hash
+
+	   Content hash of the cover art embedded in this file, addressing it in
+	   the thumbnail cache (see :mod:`archiver.thumbnails`). ``None`` until
+	   the covers have been updated, and an empty string if the file has no
+	   cover.
+
 	.. data:: play_count
 
 	   How many times this file has been played through (defined as greater
 	   than 50% of the song heard before skipping)
 
+	.. data:: bytes_streamed
+
+	   How many bytes of this file have been sent to the web client. Kept up
+	   to date by the streaming view.
+
 	.. data:: skip_count
 
 	   How many times this file has been skipped (defined as less than 50% of
@@ -146,7 +176,7 @@ class Song (models.Model):
 	artist       = models.CharField(max_length = 64, default = _default_string)
 	album_artist = models.CharField(max_length = 64, default = _default_string)
 	album        = models.CharField(max_length = 64, default = _default_string)
-	year         = models.IntegerField(default = _default_string)
+	year         = models.IntegerField(default = _default_int)
 	genre        = models.CharField(max_length = 64, default = _default_string)
 	bpm          = models.IntegerField(default = _default_int)
 	disc_number  = models.IntegerField(default = _default_int)
@@ -162,11 +192,16 @@ class Song (models.Model):
 	url              = models.CharField(max_length = 255)
 	file_hash        = melodia_settings.HASH_RESULT_DB_TYPE
 	file_size        = models.IntegerField(default = _default_int)
+	file_mtime       = models.FloatField(default = _default_int)
+	file_inode       = models.BigIntegerField(default = _default_int)
+	metadata_stale   = models.BooleanField(default = True)
+	cover_hash       = models.CharField(max_length = 40, null = True, default = None)
 
 	#Melodia metadata
-	play_count = models.IntegerField(default = _default_int)
-	skip_count = models.IntegerField(default = _default_int)
-	rating     = models.IntegerField(default = _default_int, choices = _default_rating_choices)
+	play_count     = models.IntegerField(default = _default_int)
+	skip_count     = models.IntegerField(default = _default_int)
+	bytes_streamed = models.BigIntegerField(default = 0)
+	rating         = models.IntegerField(default = _default_int, choices = _default_rating_choices)
 
 	#Link back to the archive this comes from
 	parent_archive = models.ForeignKey(Archive)
@@ -182,91 +217,71 @@ class Song (models.Model):
 	class Meta:
 		app_label = 'archiver'
 
+		#A file can only be in an archive once. The URL goes first so the
+		#index also serves lookups by URL alone (playlist imports). The
+		#composite indexes for browsing are created in sql/song.sql.
+		unique_together = (('url', 'parent_archive'),)
+
 	def _get_full_url(self):
 		"Combine this song's URL with the URL of its parent"
-		return os.path.join(parent_archive.root_folder, self.url)
+		return os.path.join(self.parent_archive.root_folder, self.url)
 
 	def _file_not_changed(self):
 		"Make sure the hash for this file is valid - return True if it has not changed."
-		#Overload the hash function with whatever Melodia as a whole is using
-		from Melodia.melodia_settings import HASH_FUNCTION as hash
-
-		#Check if there's a hash entry - if there is, the song may not have changed,
-		#and we can go ahead and return
-		if self.file_hash != None:
-			song_file = open(self._get_full_url, 'rb')
-			current_file_hash = hash(song_file.read())
+		#The cheap fingerprint is checked first, the file is only fully hashed
+		#if that doesn't match. Either way, keep the up-to-date value.
+		changed, self.file_hash = hashing.check_file(self._get_full_url(), self.file_hash)
 
-			if current_file_hash == self.file_hash:
-				#The song data hasn't changed at all, we don't need to do anything
-				return True
+		return not changed
 
-		return False
+	def _set_fields(self, fields):
+		"Set this song's fields from a dictionary of field names to values"
+		for field_name, value in fields.iteritems():
+			setattr(self, field_name, value)
 
 	def _grab_file_info(self):
-		"Populate file-based metadata about this song."
-		import os
-		#Overload the hash function with whatever Melodia as a whole is using
-		from Melodia.melodia_settings import HASH_FUNCTION as hash
-		
-		file_handle = open(self._get_full_url, 'rb')
-		
-		self.file_hash = hash(file_handle.read())
-		self.file_size = os.stat(self._get_full_url).st_size
+		"Populate file-based metadata (other than the hash) about this song."
+		self._set_fields(metadata.read_file_info(self._get_full_url()))
 
 	def _grab_metadata_local(self):
 		"Populate this song's metadata using what is locally available"
-		#Use mutagen to get the song metadata
-		import mutagen
-
-		try:
-			#Use mutagen to scan local metadata - don't update anything else (i.e. play_count)
-			track             = mutagen.File(self._get_full_url)
-			track_easy        = mutagen.File(self._get_full_url, easy=True)
-
-			self.title        = track_easy['title'][0]  or _default_string
-			self.artist       = track_easy['artist'][0] or _default_string
-			self.album_artist = track_easy['albumartist'][0] or _default_string
-			self.album        = track_easy['album'][0]  or _default_string
-			self.year         = int(track_easy['date'][0][0:4]) or _default_int
-			self.genre        = track_easy["genre"][0] or _default_string
-
-			self.disc_number  = int(track_easy['discnumber'][0].split('/')[0]) or _default_int
-			self.disc_total   = int(track_easy['discnumber'][0].split('/')[-1]) or _default_int
-			self.track_number = int(track_easy['track_number'][0].split('/')[0]) or _default_int
-			self.track_total  = int(track_easy['track_number'][0].split('/')[-1])  or _default_int
-			self.comment      = track_easy['comment'][0] or _default_string
-
-			self.bit_rate         = track.info.bitrate or _default_int
-			self.duration         = track.info.length or _default_int
-
-		except:
+		fields = metadata.read_tags_cached(self._get_full_url(), self.file_size, self.file_mtime)
+		if not fields:
 			#Couldn't grab the local data
 			return False
 
+		self._set_fields(fields)
+
 	def populate_metadata(self):
 		"""
 		Populate the metadata of this song (only if file hash has changed), and save the result.
 		"""
-		if self._file_not_changed():
+		#Whatever happens below, the filesystem scan's request for a refresh
+		#has been answered
+		self.metadata_stale = False
+
+		file_not_changed = self._file_not_changed()
+		self._grab_file_info()
+
+		if file_not_changed:
 			return
 
 		#If we've gotten to here, we do actually need to fully update the metadata
-		if use_echonest:
-			self._grab_echonest()
-
-		else:
-			self._grab_metadata_local()
+		self._grab_metadata_local()
 			
-	def convert(self, output_location, output_format):
+	def convert(self, output_location, output_format, compression = None):
 		"""
 		Convert a song to a new format.
 
 		:param output_location: String URL of where the resulting file should be stored
-		:param output_format: Output format of the resulting file
+		:param output_format: Output format of the resulting file, like ``"mp3"``
+		:param compression: Compression mode of the output format, or None for its default
+		:raises TranscodeError: If the song can't be converted
+		"""
+		#audiotools is only loaded when something actually gets converted
+		from archiver import transcode
 
-		.. todo::
+		transcode.transcode(self._get_full_url(), output_location, output_format, compression)
 
-		   Actually write the code to convert files, or abandon if necessary
-		"""
-		pass #Need to get pydub code in place
+post_save.connect(search.song_saved, sender = Song)
+post_delete.connect(search.song_deleted, sender = Song)
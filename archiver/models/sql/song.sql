@@ -0,0 +1,7 @@
+-- Indexes for the Song table, run by syncdb after the table is created.
+
+-- Browsing by album: group by album artist and album, in disc/track order
+CREATE INDEX archiver_song_album_order ON archiver_song (album_artist, album, disc_number, track_number);
+
+-- Browsing and sorting by artist, then title
+CREATE INDEX archiver_song_artist_title ON archiver_song (artist, title);
@@ -0,0 +1,329 @@
+"""
+The machinery behind :func:`Archive.reorganize`. Reorganizing happens in two
+phases:
+
+   * **Planning** - :func:`plan_moves` works out the new URL of every song up
+     front, and sets aside any move that would collide with another song or an
+     existing file. Moves onto a file that is itself being moved away are
+     ordered after it, and songs swapping places (A to B, B to A) go through
+     a temporary name.
+   * **Execution** - :func:`execute_moves` applies the plan. Moves within a
+     device are a single :func:`os.rename`. Moves across devices are copied
+     (one worker thread per source/target device pair) and the original is
+     only removed once the database points at the copy. A move whose file
+     has vanished, or whose target is still taken when its turn comes, is
+     logged and skipped.
+
+Progress is recorded in a :class:`Journal` under ``CACHE_DIR``, so an
+interrupted run picks up where it stopped instead of starting over.
+"""
+
+import errno, json, logging, os, shutil, threading
+from Queue import Queue
+
+from django.conf import settings
+
+_logger = logging.getLogger("archiver.reorganize")
+
+_format_fields = (
+		("%a", lambda song, filename: song.artist),
+		("%A", lambda song, filename: song.album),
+		("%d", lambda song, filename: song.disc_number),
+		("%e", lambda song, filename: song.disc_total),
+		("%f", lambda song, filename: filename),
+		("%g", lambda song, filename: os.path.splitext(filename)[0]),
+		("%n", lambda song, filename: song.track_number),
+		("%o", lambda song, filename: song.track_total),
+		("%y", lambda song, filename: song.year),
+		)
+
+def format_location(song, format_string):
+	"""
+	Fill in a reorganize `format_string` for a song. Path separators inside
+	tag values (``AC/DC``) are replaced so they don't create extra folders.
+
+	:rtype: String location relative to the archive's root folder
+	"""
+	filename = os.path.basename(song.url)
+
+	location = format_string
+	for escape, field in _format_fields:
+		value    = unicode(field(song, filename)).replace(os.sep, "_")
+		location = location.replace(escape, value)
+
+	return location
+
+def plan_moves(archive, songs, format_string):
+	"""
+	Work out where every song should go.
+
+	:param archive: The :class:`Archive` being reorganized
+	:param songs: Iterable of :class:`Song` instances to reorganize
+	:param format_string: See :func:`Archive.reorganize`
+	:rtype: Tuple of ``(moves, collisions)``, both lists of
+	        ``(song_id, url, new_url)``. `moves` are in the order they have to
+	        be made in, and may move a song twice (through a temporary name).
+	        `collisions` are moves that would overwrite another song or an
+	        existing file, and are not made.
+	"""
+	candidates = []
+	for song in songs:
+		new_url = os.path.normpath(os.path.join(archive.root_folder,
+		                                        format_location(song, format_string)))
+		if new_url != song.url:
+			candidates.append((song.id, song.url, new_url))
+
+	targets = {}
+	for move in candidates:
+		targets.setdefault(move[2], []).append(move)
+
+	collisions = set(move for move in candidates if len(targets[move[2]]) > 1)
+
+	#A file in the way is fine if it is moving away itself - unless that move
+	#is a collision, which can make more moves collide in turn
+	sources = dict((move[1], move) for move in candidates)
+	changed = True
+	while changed:
+		changed = False
+		for move in candidates:
+			if move in collisions or not os.path.lexists(move[2]):
+				continue
+
+			occupant = sources.get(move[2])
+			if occupant is None or occupant in collisions:
+				collisions.add(move)
+				changed = True
+
+	planned = [move for move in candidates if move not in collisions]
+	return (_order_moves(planned), [move for move in candidates if move in collisions])
+
+def _order_moves(planned):
+	"""
+	Order moves so that every target has been vacated by the time it is moved
+	onto. Targets are unique, so moves form chains and cycles - a cycle is
+	broken by moving its first song to a temporary name and finishing its
+	move last.
+	"""
+	sources = dict((move[1], move) for move in planned)
+	ordered = []
+	placed  = set()
+
+	for move in planned:
+		if move in placed:
+			continue
+
+		#Follow the moves that have to be made first
+		path    = [move]
+		blocker = sources.get(move[2])
+		while blocker is not None and blocker not in placed and blocker != path[0]:
+			path.append(blocker)
+			blocker = sources.get(blocker[2])
+
+		placed.update(path)
+
+		if blocker == path[0]:
+			song_id, url, new_url = path[0]
+			temporary_url = "%s.%d.reorganize" % (url, song_id)
+
+			ordered.append((song_id, url, temporary_url))
+			ordered.extend(reversed(path[1:]))
+			ordered.append((song_id, temporary_url, new_url))
+		else:
+			ordered.extend(reversed(path))
+
+	return ordered
+
+class Journal(object):
+	"""
+	Record of a reorganize in progress, stored as one JSON document per line
+	in ``CACHE_DIR``: the plan on the first line, followed by the
+	``[song_id, new_url]`` of every move that has been completed.
+
+	:param archive: The :class:`Archive` being reorganized
+	"""
+
+	def __init__(self, archive):
+		self.path = os.path.join(settings.CACHE_DIR,
+		                         "reorganize-%d.journal" % archive.id)
+
+	def load(self, format_string):
+		"""
+		Load an interrupted run for the same `format_string`.
+
+		:rtype: Tuple of ``(moves, completed)``, where `completed` is a set
+		        of ``(song_id, new_url)``, or ``None`` if there is nothing to
+		        resume.
+		"""
+		try:
+			journal_file = open(self.path, 'r')
+		except IOError:
+			return None
+
+		with journal_file:
+			try:
+				header = json.loads(journal_file.readline())
+			except ValueError:
+				return None
+
+			if header.get("format_string") != format_string:
+				return None
+
+			completed = set()
+			for line in journal_file:
+				try:
+					completed.add(tuple(json.loads(line)))
+				except (ValueError, TypeError):
+					#A line cut short by the interruption
+					pass
+
+		return ([tuple(move) for move in header["moves"]], completed)
+
+	def start(self, format_string, moves):
+		"Record a new plan, replacing any previous journal"
+		with open(self.path, 'w') as journal_file:
+			journal_file.write(json.dumps({"format_string": format_string,
+			                               "moves": moves}) + "\n")
+
+	def completed(self, move):
+		"Record that a move is done"
+		song_id, url, new_url = move
+		with open(self.path, 'a') as journal_file:
+			journal_file.write(json.dumps([song_id, new_url]) + "\n")
+
+	def finish(self):
+		"Remove the journal once everything is done"
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+
+def _makedirs(folder):
+	"`mkdir -p` functionality"
+	try:
+		os.makedirs(folder)
+	except OSError as exc:
+		if exc.errno == errno.EEXIST and os.path.isdir(folder):
+			#This is safe to skip - makedirs() is complaining about a folder already existing
+			pass
+		else: raise
+
+def _copy_worker(moves, results):
+	"Copy a list of moves across devices, posting each result to the `results` queue"
+	for move in moves:
+		song_id, url, new_url = move
+		partial_url = new_url + ".part"
+
+		try:
+			#Copy to a temporary name so a half-written file is never
+			#mistaken for the real thing
+			shutil.copyfile(url, partial_url)
+			shutil.copystat(url, partial_url)
+			os.rename(partial_url, new_url)
+			results.put((move, None))
+
+		except (IOError, OSError) as exc:
+			results.put((move, exc))
+
+def _run_copies(device_pairs, finish_move):
+	"Copy the moves grouped by device pair in parallel, finishing each as it lands"
+	results = Queue()
+	workers = [threading.Thread(target = _copy_worker, args = (pair_moves, results))
+	           for pair_moves in device_pairs.itervalues()]
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+
+	errors = []
+	for index in xrange(sum(len(pair_moves) for pair_moves in device_pairs.itervalues())):
+		move, error = results.get()
+		if error is None:
+			finish_move(move)
+		else:
+			errors.append(error)
+
+	for worker in workers:
+		worker.join()
+
+	return errors
+
+def execute_moves(moves, journal, on_moved, progress_function):
+	"""
+	Move files according to a plan.
+
+	:param moves: List of ``(song_id, url, new_url)`` still to be done, in
+	              the order given by :func:`plan_moves`
+	:param journal: The :class:`Journal` to record progress in
+	:param on_moved: Function called with ``(song_id, new_url)`` once a file is
+	                 in place, to point the database at it. Always called from
+	                 the calling thread.
+	:param progress_function: See :func:`Archive.reorganize`
+	:rtype: List of moves that were skipped because their file had vanished
+	        or their target was still taken
+	"""
+	total_moves = len(moves)
+	done        = [0]
+	skipped     = []
+
+	def finish_move(move):
+		song_id, url, new_url = move
+		on_moved(song_id, new_url)
+
+		#The database no longer references the original, safe to remove
+		if os.path.lexists(url):
+			os.remove(url)
+
+		journal.completed(move)
+		done[0] += 1
+		progress_function(done[0], total_moves, url, new_url)
+
+	#Moves within a device are done straight away, anything else is grouped
+	#by the pair of devices it crosses. A move onto a file that is still
+	#waiting to be copied away waits for the copies queued so far.
+	device_pairs = {}
+	copying      = set()
+	errors       = []
+	for move in moves:
+		song_id, url, new_url = move
+
+		if new_url in copying:
+			errors.extend(_run_copies(device_pairs, finish_move))
+			device_pairs = {}
+			copying      = set()
+
+		if not os.path.lexists(url) and os.path.exists(new_url):
+			#Moved before an interruption, but the database was never told
+			finish_move(move)
+			continue
+
+		try:
+			if os.path.lexists(new_url):
+				raise OSError(errno.EEXIST, "Target is still taken", new_url)
+
+			new_folder = os.path.dirname(new_url)
+			_makedirs(new_folder)
+
+			source_device = os.stat(url).st_dev
+			target_device = os.stat(new_folder).st_dev
+
+			if source_device == target_device:
+				os.rename(url, new_url)
+
+		except OSError as exc:
+			_logger.warning("Not moving %s to %s: %s", url, new_url, exc)
+			skipped.append(move)
+			continue
+
+		if source_device == target_device:
+			finish_move(move)
+		else:
+			device_pairs.setdefault((source_device, target_device), []).append(move)
+			copying.add(url)
+
+	if device_pairs:
+		errors.extend(_run_copies(device_pairs, finish_move))
+
+	if errors:
+		#Everything else has been recorded, so a re-run resumes from here
+		raise errors[0]
+
+	return skipped
@@ -0,0 +1,265 @@
+"""
+Full-text search over the library. The archiver keeps the search index up to
+date as it refreshes metadata and removes songs, and songs saved or deleted
+one at a time (including those deleted along with their archive) are
+re-indexed through their signals, so searching never has to scan the
+:class:`Song` table.
+
+The backend is pluggable through :data:`melodia_settings.SEARCH_BACKEND`,
+a dotted path to a :class:`SearchBackend` subclass. When it is ``None``,
+:class:`SqliteFTSBackend` is used on SQLite builds with FTS5, and
+:class:`LikeBackend` everywhere else.
+
+.. code-block:: python
+
+   from archiver import search
+   song_ids = search.search(u"church clothes", page = 1, page_size = 50)
+"""
+
+import re
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Q
+from django.db.models.signals import post_syncdb
+from django.utils.importlib import import_module
+
+from Melodia import melodia_settings
+from archiver.utils import chunked
+
+#Song fields that are searched
+SEARCH_FIELDS = ('title', 'artist', 'album', 'comment')
+
+_word_regex = re.compile(r"\w+", re.UNICODE)
+
+#Per-thread flag set while the archiver maintains the index in bulk itself
+_suspended = threading.local()
+
+class SearchBackend(object):
+	"""
+	Base class of search backends. A backend only has to implement
+	:func:`search`; backends that keep an index of their own also override
+	:func:`create_index`, :func:`index`, :func:`remove` and :func:`rebuild`,
+	which do nothing here.
+
+	The archiver calls :func:`index` whenever songs' tags are re-read and
+	:func:`remove` before songs are deleted, so the index never has to be
+	rebuilt during normal use. :func:`create_index` is called after every
+	``syncdb``.
+	"""
+
+	def create_index(self):
+		"Create whatever storage the index needs, if it doesn't exist yet"
+		pass
+
+	def index(self, song_ids):
+		"""
+		Add or refresh the index entries for some songs.
+
+		:param song_ids: List of :class:`Song` ids
+		"""
+		pass
+
+	def remove(self, song_ids):
+		"""
+		Remove the index entries for some songs.
+
+		:param song_ids: List of :class:`Song` ids
+		"""
+		pass
+
+	def rebuild(self):
+		"Throw away the index and build it again from every song"
+		pass
+
+	def search(self, query, page = 1, page_size = 50):
+		"""
+		Find the songs matching a query. Every backend must implement this.
+
+		:param query: Free text typed by the user
+		:param page: 1-based page number
+		:param page_size: Number of results per page
+		:rtype: List of :class:`Song` ids, best match first
+		"""
+		raise NotImplementedError
+
+class LikeBackend(SearchBackend):
+	"""
+	Fallback backend with no index of its own - every word of the query
+	must appear in one of the :data:`SEARCH_FIELDS`. Only suitable for
+	small libraries.
+	"""
+
+	def search(self, query, page = 1, page_size = 50):
+		from archiver.models import Song
+
+		songs = Song.objects.all()
+		for word in _word_regex.findall(query):
+			word_filter = Q()
+			for field in SEARCH_FIELDS:
+				word_filter |= Q(**{field + '__icontains': word})
+			songs = songs.filter(word_filter)
+
+		offset = (page - 1) * page_size
+		return list(songs.order_by('id').values_list('id', flat = True)[offset:offset + page_size])
+
+class SqliteFTSBackend(SearchBackend):
+	"""
+	SQLite FTS5 index, stored in the :data:`table` virtual table alongside the
+	rest of the database. The FTS rowid is the :class:`Song` id. Results are
+	ranked by bm25, and every word of the query is treated as a prefix.
+	"""
+
+	table = "archiver_song_fts"
+
+	@classmethod
+	def available(cls):
+		"Check that the database is SQLite and was built with FTS5"
+		if connection.vendor != 'sqlite':
+			return False
+
+		cursor = connection.cursor()
+		try:
+			cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+			return bool(cursor.fetchone()[0])
+		except DatabaseError:
+			return False
+
+	def create_index(self):
+		#The virtual table isn't a model, so syncdb doesn't create it itself
+		cursor = connection.cursor()
+		cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize = 'unicode61')"
+		               % (self.table, ", ".join(SEARCH_FIELDS)))
+		transaction.commit_unless_managed()
+
+	def _delete(self, cursor, song_ids):
+		cursor.execute("DELETE FROM %s WHERE rowid IN (%s)"
+		               % (self.table, ", ".join(["%s"] * len(song_ids))), song_ids)
+
+	def index(self, song_ids):
+		from archiver.models import Song
+
+		cursor = connection.cursor()
+		with transaction.commit_on_success():
+			for chunk in chunked(song_ids):
+				self._delete(cursor, chunk)
+
+				rows = Song.objects.filter(id__in = chunk).values_list('id', *SEARCH_FIELDS)
+				cursor.executemany("INSERT INTO %s (rowid, %s) VALUES (%s)"
+				                   % (self.table, ", ".join(SEARCH_FIELDS),
+				                      ", ".join(["%s"] * (len(SEARCH_FIELDS) + 1))),
+				                   list(rows))
+
+			#Raw SQL doesn't tell Django there is something to commit
+			transaction.set_dirty()
+
+	def remove(self, song_ids):
+		cursor = connection.cursor()
+		with transaction.commit_on_success():
+			for chunk in chunked(song_ids):
+				self._delete(cursor, chunk)
+
+			transaction.set_dirty()
+
+	def rebuild(self):
+		from archiver.models import Song
+
+		cursor = connection.cursor()
+		with transaction.commit_on_success():
+			cursor.execute("DELETE FROM %s" % self.table)
+			transaction.set_dirty()
+
+		self.index(list(Song.objects.values_list('id', flat = True)))
+
+	def _match_expression(self, query):
+		#Quote every word so FTS5 operators typed by the user are taken literally
+		return u" ".join(u'"%s"*' % word for word in _word_regex.findall(query))
+
+	def search(self, query, page = 1, page_size = 50):
+		match_expression = self._match_expression(query)
+		if not match_expression:
+			return []
+
+		cursor = connection.cursor()
+		cursor.execute("SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY rank LIMIT %%s OFFSET %%s"
+		               % (self.table, self.table),
+		               [match_expression, page_size, (page - 1) * page_size])
+
+		return [row[0] for row in cursor.fetchall()]
+
+_backend = None
+
+def get_backend():
+	"Return the configured search backend, creating it on first use"
+	global _backend
+
+	if _backend is None:
+		if melodia_settings.SEARCH_BACKEND:
+			module_name, class_name = melodia_settings.SEARCH_BACKEND.rsplit('.', 1)
+			_backend = getattr(import_module(module_name), class_name)()
+		elif SqliteFTSBackend.available():
+			_backend = SqliteFTSBackend()
+		else:
+			_backend = LikeBackend()
+
+	return _backend
+
+def _syncdb_finished(sender, **kwargs):
+	"Create the search index along with the archiver's tables"
+	if sender.__name__ == 'archiver.models':
+		get_backend().create_index()
+
+post_syncdb.connect(_syncdb_finished, dispatch_uid = "archiver.search.create_index")
+
+def index_songs(song_ids):
+	"Add or refresh the search index entries for some songs"
+	if song_ids:
+		get_backend().index(song_ids)
+
+def remove_songs(song_ids):
+	"Remove the search index entries for some songs"
+	if song_ids:
+		get_backend().remove(song_ids)
+
+@contextmanager
+def suspended():
+	"""
+	Stop songs saved or deleted one at a time within a ``with`` block from
+	being indexed through their signals. Used around :class:`BatchWriter`
+	flushes, after which the archiver indexes or removes the songs in bulk:
+
+	.. code-block:: python
+
+	   with search.suspended():
+	       with BatchWriter(Song) as writer:
+	           writer.delete(song_id)
+	   search.remove_songs([song_id])
+	"""
+	previous = getattr(_suspended, 'active', False)
+	_suspended.active = True
+	try:
+		yield
+	finally:
+		_suspended.active = previous
+
+def song_saved(sender, instance, **kwargs):
+	"Index a song saved one at a time - connected to :class:`Song`'s post_save"
+	if not getattr(_suspended, 'active', False):
+		index_songs([instance.id])
+
+def song_deleted(sender, instance, **kwargs):
+	"Remove a deleted song from the index - connected to :class:`Song`'s post_delete"
+	if not getattr(_suspended, 'active', False):
+		remove_songs([instance.id])
+
+def search(query, page = 1, page_size = 50):
+	"""
+	Search the library.
+
+	:param query: Free text typed by the user
+	:param page: 1-based page number
+	:param page_size: Number of results per page
+	:rtype: List of :class:`Song` ids, best match first
+	"""
+	return get_backend().search(query, page, page_size)
@@ -0,0 +1,193 @@
+"""
+Filter expressions for smart playlists. An expression compares :class:`Song`
+fields to values, and combines the comparisons with ``and``, ``or``, ``not``
+and parentheses:
+
+.. code-block:: none
+
+   rating >= 4 and (genre = "Hip Hop" or genre ~ rap) and not play_count = 0
+   add_date >= 2013-01-01 and year < 2000
+
+Operators are ``=``, ``!=``, ``<``, ``<=``, ``>``, ``>=`` and ``~`` (contains).
+String comparisons ignore case. Values containing spaces must be quoted, and
+dates are written ``YYYY-MM-DD``. :func:`parse` turns an expression into a
+:class:`Q` object that can be used to filter :class:`Song` querysets.
+"""
+
+import datetime, re
+
+from django.db.models import Q
+
+#Fields that can be used in an expression, and the type of their values
+FILTER_FIELDS = {
+		'title':        unicode,
+		'artist':       unicode,
+		'album_artist': unicode,
+		'album':        unicode,
+		'genre':        unicode,
+		'comment':      unicode,
+		'year':         int,
+		'bpm':          int,
+		'rating':       int,
+		'play_count':   int,
+		'skip_count':   int,
+		'duration':     float,
+		'add_date':     datetime.date,
+		}
+
+_lookups = {
+		'=':  'exact',
+		'!=': 'exact',
+		'<':  'lt',
+		'<=': 'lte',
+		'>':  'gt',
+		'>=': 'gte',
+		'~':  'icontains',
+		}
+
+_token_regex = re.compile(r"""\s*(?:
+		(?P<paren>[()]) |
+		(?P<operator><=|>=|!=|=|<|>|~) |
+		"(?P<string>(?:[^"\\]|\\.)*)" |
+		(?P<word>[^\s()<>=!~"]+)
+		)""", re.VERBOSE | re.UNICODE)
+
+class FilterSyntaxError(ValueError):
+	"Raised when a filter expression can't be parsed"
+	pass
+
+def _tokenize(expression):
+	"Split an expression into ``(kind, text)`` tokens"
+	tokens   = []
+	position = 0
+	expression = expression.rstrip()
+
+	while position < len(expression):
+		match = _token_regex.match(expression, position)
+		if match is None or match.end() == position:
+			raise FilterSyntaxError("Unexpected character at position %d: %r"
+			                        % (position, expression[position:position + 10]))
+
+		kind = match.lastgroup
+		text = match.group(kind)
+		if kind == 'string':
+			text = re.sub(r"\\(.)", r"\1", text)
+		elif kind == 'word' and text.lower() in ('and', 'or', 'not'):
+			kind = text = text.lower()
+
+		tokens.append((kind, text))
+		position = match.end()
+
+	return tokens
+
+def _convert_value(field, value):
+	"Convert the text of a value to the type of the field it is compared to"
+	value_type = FILTER_FIELDS[field]
+
+	try:
+		if value_type is datetime.date:
+			return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+		return value_type(value)
+
+	except ValueError:
+		raise FilterSyntaxError("Invalid value for %s: %r" % (field, value))
+
+class _Parser(object):
+	"""
+	Recursive descent parser for the grammar::
+
+	   expression := term ("or" term)*
+	   term       := factor ("and" factor)*
+	   factor     := "not" factor | "(" expression ")" | field operator value
+	"""
+
+	def __init__(self, expression):
+		self.tokens   = _tokenize(expression)
+		self.position = 0
+
+	def _peek(self):
+		if self.position < len(self.tokens):
+			return self.tokens[self.position]
+		return (None, None)
+
+	def _next(self, *kinds):
+		kind, text = self._peek()
+		if kind not in kinds:
+			raise FilterSyntaxError("Expected %s, found %s"
+			                        % (" or ".join(kinds), text if text is not None else "end of expression"))
+
+		self.position += 1
+		return text
+
+	def parse(self):
+		result = self._expression()
+		if self._peek()[0] is not None:
+			raise FilterSyntaxError("Unexpected %r" % self._peek()[1])
+
+		return result
+
+	def _expression(self):
+		result = self._term()
+		while self._peek()[0] == 'or':
+			self._next('or')
+			result = result | self._term()
+
+		return result
+
+	def _term(self):
+		result = self._factor()
+		while self._peek()[0] == 'and':
+			self._next('and')
+			result = result & self._factor()
+
+		return result
+
+	def _factor(self):
+		kind = self._peek()[0]
+		if kind == 'not':
+			self._next('not')
+			return ~self._factor()
+
+		if kind == 'paren':
+			if self._next('paren') != '(':
+				raise FilterSyntaxError("Unexpected ')'")
+			result = self._expression()
+			if self._next('paren') != ')':
+				raise FilterSyntaxError("Expected ')'")
+			return result
+
+		return self._comparison()
+
+	def _comparison(self):
+		field = self._next('word')
+		if field not in FILTER_FIELDS:
+			raise FilterSyntaxError("Unknown field: %r" % field)
+
+		operator = self._next('operator')
+		value    = _convert_value(field, self._next('word', 'string'))
+
+		if operator == '~' and FILTER_FIELDS[field] is not unicode:
+			raise FilterSyntaxError("Only text fields can be searched with '~'")
+
+		lookup = _lookups[operator]
+		if lookup == 'exact' and FILTER_FIELDS[field] is unicode:
+			lookup = 'iexact'
+
+		comparison = Q(**{"%s__%s" % (field, lookup): value})
+		if operator == '!=':
+			return ~comparison
+
+		return comparison
+
+def parse(expression):
+	"""
+	Parse a filter expression.
+
+	:param expression: The expression text
+	:rtype: :class:`Q` object matching the songs the expression selects
+	:raises FilterSyntaxError: If the expression is invalid
+	"""
+	if not expression or not expression.strip():
+		raise FilterSyntaxError("Empty filter expression")
+
+	return _Parser(expression).parse()
@@ -0,0 +1,154 @@
+"""
+Helpers for tests. Use :class:`QueryPlanTestMixin` alongside
+:class:`django.test.TestCase` (which already provides ``assertNumQueries``)
+to assert on a queryset's plan:
+
+.. code-block:: python
+
+   class SongQueryTest(QueryPlanTestMixin, TestCase):
+       def test_url_lookup(self):
+           self.assertUsesIndex(Song.objects.filter(url = "/music/one.mp3"))
+
+Code that talks HTTP can be tested against a :class:`LocalHTTPServer`:
+
+.. code-block:: python
+
+   with LocalHTTPServer({"/feed.xml": feed_xml}) as server:
+       response, etag, last_modified = download.open_feed(server.url("/feed.xml"))
+"""
+
+import BaseHTTPServer, SocketServer, hashlib, re, threading
+
+from django.db import connection
+
+def query_plan(queryset):
+	"""
+	Ask the database how it will run a queryset.
+
+	:rtype: List of strings, one for each step of the plan. On SQLite these
+	        are the ``detail`` column of ``EXPLAIN QUERY PLAN``, on other
+	        databases the rows of ``EXPLAIN`` joined together.
+	"""
+	sql, params = queryset.query.sql_with_params()
+
+	cursor = connection.cursor()
+	if connection.vendor == 'sqlite':
+		cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+		return [row[-1] for row in cursor.fetchall()]
+
+	cursor.execute("EXPLAIN " + sql, params)
+	return [" ".join(unicode(column) for column in row) for row in cursor.fetchall()]
+
+class QueryPlanTestMixin(object):
+	"Assertions on query plans, for use with :class:`django.test.TestCase`"
+
+	def assertUsesIndex(self, queryset, index_name = None):
+		"Assert that the query is answered using an index (a specific one, if `index_name` is given)"
+		plan = query_plan(queryset)
+
+		if index_name is None:
+			used = any("INDEX" in step.upper() for step in plan)
+		else:
+			used = any(index_name in step for step in plan)
+
+		self.assertTrue(used, "Query does not use %s:\n%s"
+		                % (index_name or "an index", "\n".join(plan)))
+
+	def assertNoTableScan(self, queryset):
+		"Assert that the query never reads a whole table without an index"
+		plan = query_plan(queryset)
+
+		for step in plan:
+			upper_step = step.upper()
+			self.assertFalse(upper_step.startswith("SCAN") and "INDEX" not in upper_step,
+			                 "Query scans a table:\n%s" % "\n".join(plan))
+
+	def assertNoSort(self, queryset):
+		"Assert that the query's ordering comes straight from an index"
+		plan = query_plan(queryset)
+
+		self.assertFalse(any("TEMP B-TREE" in step.upper() for step in plan),
+		                 "Query sorts its results:\n%s" % "\n".join(plan))
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class _FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"Serves the files of a :class:`LocalHTTPServer`, with ETags and byte ranges"
+
+	protocol_version = "HTTP/1.0"
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server.fixture
+		server.requests.append((self.path, dict(self.headers.items())))
+
+		if self.path not in server.files:
+			self.send_error(404)
+			return
+
+		body = server.files[self.path]
+		etag = '"%s"' % hashlib.sha1(body).hexdigest()
+		if self.headers.getheader("If-None-Match") == etag:
+			self.send_response(304)
+			self.end_headers()
+			return
+
+		start = 0
+		range_match = re.match(r"bytes=(\d+)-$", self.headers.getheader("Range") or "")
+		if range_match and server.ranges:
+			start = int(range_match.group(1))
+			if start >= len(body):
+				self.send_response(416)
+				self.send_header("Content-Range", "bytes */%d" % len(body))
+				self.end_headers()
+				return
+
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body)))
+		else:
+			self.send_response(200)
+
+		self.send_header("ETag", etag)
+		self.send_header("Content-Length", str(len(body) - start))
+		self.end_headers()
+		self.wfile.write(body[start:])
+
+class LocalHTTPServer(object):
+	"""
+	HTTP server on a free local port, running in a background thread for
+	the duration of a ``with`` block. Every response carries an ``ETag``, and
+	``If-None-Match`` and ``Range`` requests are honoured.
+
+	:param files: Dictionary mapping paths (like ``"/feed.xml"``) to the bytes served for them
+	:param ranges: Set to `False` to ignore ``Range`` headers, like some servers do
+
+	.. data:: requests
+
+	   List of ``(path, headers)`` for every request received, in order.
+	"""
+
+	def __init__(self, files, ranges = True):
+		self.files    = files
+		self.ranges   = ranges
+		self.requests = []
+
+	def __enter__(self):
+		self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _FixtureRequestHandler)
+		self._server.fixture = self
+
+		self._thread = threading.Thread(target = self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._server.shutdown()
+		self._server.server_close()
+		self._thread.join()
+
+	def url(self, path):
+		"Full URL for a path on this server"
+		return "http://127.0.0.1:%d%s" % (self._server.server_address[1], path)
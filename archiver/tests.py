@@ -7,6 +7,8 @@ Replace this with more appropriate tests for your application.
 
 from django.test import TestCase
 
+from archiver.test_utils import QueryPlanTestMixin
+
 class FilesystemScanTest(TestCase):
 	def test_filesystem_scan(self):
 		"Tests that we can scan a filesystem correctly."
@@ -128,3 +130,1508 @@ class PlaylistImportTest(TestCase):
 
 		another_playlist._import(playlist_string)
 		print len(another_playlist.song_list)
+
+class IncrementalScanTest(TestCase):
+	def test_incremental_scan(self):
+		"Tests that a rescan only touches files that were added, changed, moved or removed."
+		import os, shutil, tempfile
+		from archiver.models import Archive, Song
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			for name in ("one.mp3", "two.mp3", "three.ogg", "cover.jpg"):
+				with open(os.path.join(root_folder, name), 'wb') as song_file:
+					song_file.write(name)
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+
+			self.assertEqual(new_archive.quick_scan(), (3, 0, 0))
+			self.assertEqual(new_archive.quick_scan(), (0, 0, 0))
+
+			#Give a song some history that should survive being moved
+			moved_song = Song.objects.get(url = os.path.join(root_folder, "one.mp3"))
+			moved_song.play_count = 7
+			moved_song.metadata_stale = False
+			moved_song.save()
+
+			os.rename(os.path.join(root_folder, "one.mp3"),
+			          os.path.join(root_folder, "moved.mp3"))
+			os.remove(os.path.join(root_folder, "two.mp3"))
+			with open(os.path.join(root_folder, "three.ogg"), 'ab') as song_file:
+				song_file.write("changed")
+			with open(os.path.join(root_folder, "four.mp3"), 'wb') as song_file:
+				song_file.write("four")
+
+			self.assertEqual(new_archive.quick_scan(), (1, 1, 1))
+			self.assertEqual(new_archive.song_set.count(), 3)
+
+			moved_song = Song.objects.get(id = moved_song.id)
+			self.assertEqual(moved_song.url, os.path.join(root_folder, "moved.mp3"))
+			self.assertEqual(moved_song.play_count, 7)
+			self.assertFalse(moved_song.metadata_stale)
+
+			changed_song = Song.objects.get(url = os.path.join(root_folder, "three.ogg"))
+			self.assertTrue(changed_song.metadata_stale)
+
+		finally:
+			shutil.rmtree(root_folder)
+
+	def test_vanished_songs_sharing_inode(self):
+		"Tests that vanished songs with the same (inode, size) are all removed."
+		import os, shutil, tempfile
+		from archiver.models import Archive, Song
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+
+			#Rows from before scans recorded file details all share (-1, -1)
+			for name in ("one.mp3", "two.mp3", "three.mp3"):
+				Song(url = os.path.join(root_folder, name), parent_archive = new_archive).save()
+
+			self.assertEqual(new_archive.quick_scan(), (0, 0, 3))
+			self.assertEqual(new_archive.song_set.count(), 0)
+
+		finally:
+			shutil.rmtree(root_folder)
+
+class FileHashTest(TestCase):
+	def test_file_hash(self):
+		"Tests that the fingerprint short-circuits hashing, and content changes are still caught."
+		import os, tempfile
+		from archiver import hashing
+
+		file_handle, url = tempfile.mkstemp()
+		try:
+			os.write(file_handle, "melodia" * 100000)
+			os.close(file_handle)
+
+			stored_hash = hashing.file_hash(url)
+			self.assertEqual(hashing.check_file(url, stored_hash), (False, stored_hash))
+
+			#Touching the file changes the fingerprint, but not the content
+			os.utime(url, (0, 0))
+			changed, touched_hash = hashing.check_file(url, stored_hash)
+			self.assertFalse(changed)
+			self.assertNotEqual(touched_hash, stored_hash)
+			self.assertEqual(hashing.split_hash(touched_hash)[1], hashing.split_hash(stored_hash)[1])
+
+			with open(url, 'ab') as hash_file:
+				hash_file.write("changed")
+			self.assertTrue(hashing.check_file(url, touched_hash)[0])
+
+			#Anything not created by the hashing module counts as changed
+			self.assertTrue(hashing.check_file(url, None)[0])
+
+		finally:
+			os.remove(url)
+
+class BackupTest(TestCase):
+	def test_incremental_backup(self):
+		"Tests that backups only copy changed songs, and can be verified against the manifest."
+		import os, shutil, tempfile
+		from archiver.models import Archive
+
+		root_folder   = tempfile.mkdtemp()
+		backup_folder = tempfile.mkdtemp()
+		try:
+			for name in ("one.mp3", "two.mp3"):
+				with open(os.path.join(root_folder, name), 'wb') as song_file:
+					song_file.write(name)
+
+			new_archive = Archive(root_folder = root_folder, backup_location = backup_folder)
+			new_archive.save()
+			new_archive.quick_scan()
+
+			run_stats = new_archive.run_backup(force_backup = True)
+			self.assertEqual((run_stats["copied"], run_stats["skipped"]), (2, 0))
+			self.assertTrue(os.path.isfile(os.path.join(backup_folder, "one.mp3")))
+
+			run_stats = new_archive.run_backup(force_backup = True)
+			self.assertEqual((run_stats["copied"], run_stats["skipped"]), (0, 2))
+
+			with open(os.path.join(root_folder, "two.mp3"), 'ab') as song_file:
+				song_file.write("changed")
+			new_archive.quick_scan()
+
+			run_stats = new_archive.run_backup(force_backup = True)
+			self.assertEqual((run_stats["copied"], run_stats["skipped"]), (1, 1))
+			self.assertEqual(new_archive.verify_backup()["verified"], 2)
+
+			#Damage the backup behind the engine's back
+			with open(os.path.join(backup_folder, "one.mp3"), 'wb') as song_file:
+				song_file.write("x")
+			os.remove(os.path.join(backup_folder, "two.mp3"))
+
+			verify_stats = new_archive.verify_backup()
+			self.assertEqual(verify_stats["mismatched"], ["one.mp3"])
+			self.assertEqual(verify_stats["missing"], ["two.mp3"])
+
+		finally:
+			shutil.rmtree(root_folder)
+			shutil.rmtree(backup_folder)
+
+	def test_backup_schedule(self):
+		"Tests that scheduled backups compare against an aware last backup time."
+		import datetime, shutil, tempfile
+		from django.utils import timezone
+		from archiver.models import Archive
+
+		root_folder   = tempfile.mkdtemp()
+		backup_folder = tempfile.mkdtemp()
+		try:
+			new_archive = Archive(root_folder = root_folder, backup_location = backup_folder,
+			                      backup_frequency = 3600)
+			new_archive.save()
+			self.assertFalse(new_archive._needs_backup())
+
+			new_archive.last_backup = timezone.now() - datetime.timedelta(hours = 2)
+			self.assertTrue(new_archive._needs_backup())
+
+			new_archive.run_backup()
+			self.assertTrue(timezone.is_aware(new_archive.last_backup))
+			self.assertFalse(new_archive._needs_backup())
+
+		finally:
+			shutil.rmtree(root_folder)
+			shutil.rmtree(backup_folder)
+
+	def test_removed_songs(self):
+		"Tests that songs removed from the archive are removed from the backup and its manifest."
+		import os, shutil, tempfile
+		from archiver.backup import BackupEngine
+		from archiver.models import Archive
+
+		root_folder   = tempfile.mkdtemp()
+		backup_folder = tempfile.mkdtemp()
+		try:
+			for name in ("one.mp3", "two.mp3"):
+				with open(os.path.join(root_folder, name), 'wb') as song_file:
+					song_file.write(name)
+
+			new_archive = Archive(root_folder = root_folder, backup_location = backup_folder)
+			new_archive.save()
+			new_archive.quick_scan()
+			new_archive.run_backup(force_backup = True)
+
+			os.rename(os.path.join(root_folder, "two.mp3"), os.path.join(root_folder, "moved.mp3"))
+			os.remove(os.path.join(root_folder, "one.mp3"))
+			new_archive.quick_scan()
+
+			run_stats = new_archive.run_backup(force_backup = True)
+			self.assertEqual((run_stats["copied"], run_stats["removed"]), (1, 2))
+			self.assertEqual(sorted(os.listdir(backup_folder)), [".melodia-manifest.json", "moved.mp3"])
+			self.assertEqual(BackupEngine(new_archive).load_manifest()["files"].keys(), ["moved.mp3"])
+			self.assertEqual(new_archive.verify_backup()["verified"], 1)
+
+			#Nothing left to remove the next time
+			run_stats = new_archive.run_backup(force_backup = True)
+			self.assertEqual((run_stats["skipped"], run_stats["removed"]), (1, 0))
+
+		finally:
+			shutil.rmtree(root_folder)
+			shutil.rmtree(backup_folder)
+
+class MetadataCacheTest(TestCase):
+	def test_metadata_cache(self):
+		"Tests that cached metadata is served for unchanged files only, and can be evicted and invalidated."
+		import os, shutil, tempfile, time
+		from archiver.metadata_cache import MetadataCache
+
+		cache_folder = tempfile.mkdtemp()
+		try:
+			cache = MetadataCache(os.path.join(cache_folder, "metadata.sqlite"), max_entries = 2)
+
+			cache.put("/music/one.mp3", 10, 1.5, {"title": u"One"})
+			self.assertEqual(cache.get("/music/one.mp3", 10, 1.5), {"title": u"One"})
+			self.assertEqual(cache.get("/music/one.mp3", 10, 2.5), None)
+			self.assertEqual(cache.get("/music/one.mp3", 10, 1.5, namespace = "audiotools_file"), None)
+
+			#Keep the access times distinct so the LRU order is predictable
+			for name in ("two", "three"):
+				time.sleep(0.01)
+				cache.put("/music/%s.mp3" % name, 10, 1.5, {"title": name})
+
+			time.sleep(0.01)
+			cache.get("/music/one.mp3", 10, 1.5)
+			cache.evict()
+			self.assertEqual(cache.get("/music/two.mp3", 10, 1.5), None)
+			self.assertEqual(cache.get("/music/one.mp3", 10, 1.5), {"title": u"One"})
+
+			cache.invalidate_folder("/music")
+			self.assertEqual(cache.get("/music/one.mp3", 10, 1.5), None)
+
+		finally:
+			shutil.rmtree(cache_folder)
+
+	def test_batched_access_times(self):
+		"Tests that reads save their access times in batches, and writes from many threads are all counted."
+		import os, shutil, sqlite3, tempfile, threading
+		from archiver.metadata_cache import MetadataCache
+
+		cache_folder = tempfile.mkdtemp()
+		try:
+			path  = os.path.join(cache_folder, "metadata.sqlite")
+			cache = MetadataCache(path)
+
+			cache.put("/music/one.mp3", 10, 1.5, {"title": u"One"})
+			last_used = lambda: sqlite3.connect(path).execute("SELECT last_used FROM metadata").fetchone()[0]
+			stored = last_used()
+
+			cache.get("/music/one.mp3", 10, 1.5)
+			self.assertEqual(last_used(), stored)
+
+			#Saved before the least recently used entries are worked out
+			cache.evict()
+			self.assertTrue(last_used() > stored)
+
+			def put_songs(thread_index):
+				for index in range(50):
+					cache.put("/music/%d-%d.mp3" % (thread_index, index), 10, 1.5, {})
+
+			threads = [threading.Thread(target = put_songs, args = (thread_index,)) for thread_index in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			self.assertEqual(cache._writes, 201)
+
+		finally:
+			shutil.rmtree(cache_folder)
+
+	def test_audiotools_files(self):
+		"Tests that audiotools doesn't parse an unchanged file again when given the cache."
+		import os, shutil, struct, tempfile, wave
+		import audiotools
+		from archiver.metadata_cache import MetadataCache
+
+		cache_folder = tempfile.mkdtemp()
+		audiotools_open = audiotools.open
+		try:
+			cache = MetadataCache(os.path.join(cache_folder, "metadata.sqlite"))
+
+			url = os.path.join(cache_folder, "song.wav")
+			source = wave.open(url, 'wb')
+			source.setnchannels(2)
+			source.setsampwidth(2)
+			source.setframerate(8000)
+			source.writeframes(struct.pack("<hh", 0, 0) * 800)
+			source.close()
+
+			first, = audiotools.open_files([url], metadata_cache = cache)
+
+			def open_again(filename):
+				self.fail("File parsed again")
+			audiotools.open = open_again
+
+			second, = audiotools.open_files([url], metadata_cache = cache)
+			self.assertTrue(isinstance(second, audiotools.WaveAudio))
+			self.assertEqual((second.sample_rate(), second.channels(), second.total_frames()),
+			                 (first.sample_rate(), first.channels(), first.total_frames()))
+
+		finally:
+			audiotools.open = audiotools_open
+			shutil.rmtree(cache_folder)
+
+class MetadataExtractionTest(TestCase):
+	def _jobs(self, root_folder):
+		import os
+
+		jobs = []
+		for index in range(20):
+			url = os.path.join(root_folder, "%02d.mp3" % index)
+			with open(url, 'wb') as song_file:
+				song_file.write("song %d" % index)
+			jobs.append((index, url, None))
+
+		#A file that vanished since the scan
+		jobs.append((20, os.path.join(root_folder, "missing.mp3"), None))
+		return jobs
+
+	def test_worker_pools(self):
+		"Tests that thread and process pools give the same results as extracting in order."
+		import shutil, tempfile
+		from Melodia import melodia_settings
+		from archiver.metadata import iter_extracted
+
+		root_folder = tempfile.mkdtemp()
+		use_processes = melodia_settings.METADATA_USE_PROCESSES
+		try:
+			jobs = self._jobs(root_folder)
+
+			serial = list(iter_extracted(jobs, workers = 1))
+			self.assertEqual([song_id for song_id, fields in serial], range(21))
+			self.assertEqual(serial[20], (20, None))
+			self.assertFalse(serial[0][1]['metadata_stale'])
+
+			for use_pool_processes in (False, True):
+				melodia_settings.METADATA_USE_PROCESSES = use_pool_processes
+				pooled = list(iter_extracted(jobs, workers = 3))
+
+				#Results come back in whatever order they complete
+				self.assertEqual(sorted(pooled), sorted(serial))
+
+		finally:
+			melodia_settings.METADATA_USE_PROCESSES = use_processes
+			shutil.rmtree(root_folder)
+
+	def test_progress_callback(self):
+		"Tests that progress is reported once per song, missing files included, as (done, total)."
+		import shutil, tempfile
+		from archiver.models import Archive, Song
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			jobs = self._jobs(root_folder)
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+			for song_id, url, file_hash in jobs:
+				Song(url = url, parent_archive = new_archive).save()
+
+			progress = []
+			new_archive._update_song_metadata(progress_callback = lambda done, total: progress.append((done, total)))
+
+			self.assertEqual(progress, [(done, 21) for done in range(1, 22)])
+			self.assertEqual(new_archive.song_set.filter(metadata_stale = True).count(), 1)
+
+		finally:
+			shutil.rmtree(root_folder)
+
+	def test_cached_extraction(self):
+		"Tests that files read before in their current state are neither hashed nor parsed again."
+		import os, shutil, tempfile
+		from archiver import hashing, metadata_cache
+		from archiver.metadata import extract_metadata
+
+		root_folder    = tempfile.mkdtemp()
+		shared_cache   = metadata_cache._default_cache
+		hash_function  = hashing.check_file
+		try:
+			metadata_cache._default_cache = metadata_cache.MetadataCache(os.path.join(root_folder, "cache.sqlite"))
+
+			url = os.path.join(root_folder, "one.mp3")
+			with open(url, 'wb') as song_file:
+				song_file.write("song")
+
+			song_id, fields = extract_metadata((1, url, None))
+			file_hash = fields['file_hash']
+			self.assertEqual(metadata_cache.get_cache().get(url, fields['file_size'], fields['file_mtime'],
+			                                                namespace = "file_hash"), file_hash)
+
+			def check_file(url, known_file_hash):
+				self.fail("File hashed again")
+			hashing.check_file = check_file
+
+			#Unchanged since the stored hash - tags are left alone
+			song_id, fields = extract_metadata((1, url, file_hash))
+			self.assertEqual(fields['file_hash'], file_hash)
+			self.assertFalse('title' in fields)
+
+			#Tags for a changed song come from the cache too
+			metadata_cache.get_cache().put(url, fields['file_size'], fields['file_mtime'], {'title': u"Cached"})
+			song_id, fields = extract_metadata((1, url, None))
+			self.assertEqual(fields['file_hash'], file_hash)
+			self.assertEqual(fields['title'], u"Cached")
+
+		finally:
+			hashing.check_file            = hash_function
+			metadata_cache._default_cache = shared_cache
+			shutil.rmtree(root_folder)
+
+class SongQueryTest(QueryPlanTestMixin, TestCase):
+	def test_song_indexes(self):
+		"Tests that the hot Song queries are answered from indexes."
+		from archiver.models import Song
+
+		self.assertUsesIndex(Song.objects.filter(url = "/music/one.mp3"))
+		self.assertNoTableScan(Song.objects.filter(url__in = ["/music/one.mp3", "/music/two.mp3"]))
+
+		album_songs = Song.objects.filter(album_artist = "Artist", album = "Album")\
+		                          .order_by('disc_number', 'track_number')
+		self.assertUsesIndex(album_songs, "archiver_song_album_order")
+		self.assertNoSort(album_songs)
+
+		artist_songs = Song.objects.filter(artist = "Artist").order_by('title')
+		self.assertUsesIndex(artist_songs, "archiver_song_artist_title")
+		self.assertNoSort(artist_songs)
+
+	def test_unchanged_rescan_queries(self):
+		"Tests that rescanning an unchanged archive costs a single query."
+		import os, shutil, tempfile
+		from archiver.models import Archive
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			for name in ("one.mp3", "two.mp3"):
+				with open(os.path.join(root_folder, name), 'wb') as song_file:
+					song_file.write(name)
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+			new_archive.quick_scan()
+
+			with self.assertNumQueries(1):
+				new_archive.quick_scan()
+
+		finally:
+			shutil.rmtree(root_folder)
+
+class SearchTest(TestCase):
+	def test_search(self):
+		"Tests that indexed songs can be found, and removed songs can't."
+		from archiver import search
+		from archiver.models import Archive, Song
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		church_clothes = Song(url = "/music/one.mp3", title = "Church Clothes", artist = "Lecrae",
+		                      album = "Church Clothes", parent_archive = new_archive)
+		church_clothes.save()
+		other_song = Song(url = "/music/two.mp3", title = "Something Else", artist = "Somebody",
+		                  album = "Another Album", parent_archive = new_archive)
+		other_song.save()
+
+		search.index_songs([church_clothes.id, other_song.id])
+
+		#The index was created by syncdb, searching only runs the query
+		with self.assertNumQueries(1):
+			self.assertEqual(search.search("lecrae"), [church_clothes.id])
+		self.assertEqual(search.search("church cloth"), [church_clothes.id])
+		self.assertEqual(search.search("album"), [other_song.id])
+		self.assertEqual(search.search("album", page = 2), [])
+
+		search.remove_songs([church_clothes.id])
+		church_clothes.delete()
+		self.assertEqual(search.search("lecrae"), [])
+
+	def test_single_saves(self):
+		"Tests that songs saved or deleted one at a time, or with their archive, keep the index current."
+		from archiver import search
+		from archiver.models import Archive, Song
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		song = Song(url = "/music/one.mp3", title = "Church Clothes", artist = "Lecrae",
+		            parent_archive = new_archive)
+		song.save()
+		self.assertEqual(search.search("lecrae"), [song.id])
+
+		song.artist = "Somebody"
+		song.save()
+		self.assertEqual(search.search("lecrae"), [])
+		self.assertEqual(search.search("somebody"), [song.id])
+
+		song.delete()
+		self.assertEqual(search.search("somebody"), [])
+
+		Song(url = "/music/two.mp3", title = "Something Else", parent_archive = new_archive).save()
+		self.assertEqual(len(search.search("something")), 1)
+		new_archive.delete()
+		self.assertEqual(search.search("something"), [])
+
+class PlaylistStreamingExportTest(TestCase):
+	def test_playlist_streaming_export(self):
+		"Tests that exports keep order and duplicates, and fetch songs in bulk."
+		from archiver.models import Archive, Song, Playlist
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		songs = []
+		for name in ("one", "two", "three"):
+			song = Song(url = "/music/%s.mp3" % name, title = name, artist = "Artist",
+			            duration = 60, parent_archive = new_archive)
+			song.save()
+			songs.append(song)
+
+		a_playlist = Playlist(name = "Testing...")
+		for song in (songs[2], songs[0], songs[2]):
+			a_playlist.append(song)
+		a_playlist.save()
+
+		with self.assertNumQueries(1):
+			m3u_lines = list(a_playlist.iter_export("m3u"))
+
+		self.assertEqual(m3u_lines, [u"#EXTM3U\n",
+		                             u"#EXTINF:60,Artist - three\n", u"/music/three.mp3\n",
+		                             u"#EXTINF:60,Artist - one\n", u"/music/one.mp3\n",
+		                             u"#EXTINF:60,Artist - three\n", u"/music/three.mp3\n"])
+
+		pls_string = a_playlist.export("pls")
+		self.assertTrue(pls_string.startswith(u"[playlist]\nFile1=/music/three.mp3\n"))
+		self.assertTrue(u"File3=/music/three.mp3\n" in pls_string)
+		self.assertTrue(pls_string.endswith(u"NumberOfEntries=3\nVersion=2\n"))
+
+class PlaylistStreamingImportTest(TestCase):
+	def test_playlist_streaming_import(self):
+		"Tests that playlists are imported from files, with entries normalised and resolved in bulk."
+		from StringIO import StringIO
+		from archiver.models import Archive, Song, Playlist
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		songs = []
+		for name in ("One", "Two", "Three"):
+			song = Song(url = "/music/%s.mp3" % name, title = name, parent_archive = new_archive)
+			song.save()
+			songs.append(song)
+
+		m3u_file = StringIO("#EXTM3U\n"
+		                    "#EXTINF:60,Artist - One\n/music/One.mp3\n"
+		                    "#EXTINF:60,Artist - Two\nTwo.mp3\n"
+		                    "#EXTINF:60,Artist - Three\nfile:///music/Three.mp3\n"
+		                    "#EXTINF:60,Artist - Missing\n/music/Missing.mp3\n"
+		                    "/music/one.mp3\n")
+
+		a_playlist = Playlist(name = "Testing...")
+		with self.assertNumQueries(1):
+			self.assertTrue(a_playlist.playlist_import(m3u_file, base_folder = "/music"))
+		self.assertEqual(list(a_playlist.song_list), [songs[0].id, songs[1].id, songs[2].id])
+
+		pls_string = ("[playlist]\n"
+		              "File1=/music/Three.mp3\nTitle1=Three\n"
+		              "file2=/music/two.mp3\n"
+		              "NumberOfEntries=2\nVersion=2\n")
+
+		another_playlist = Playlist(name = "Testing 2...")
+		self.assertTrue(another_playlist.playlist_import(pls_string, case_insensitive = True))
+		self.assertEqual(list(another_playlist.song_list), [songs[2].id, songs[1].id])
+
+		self.assertFalse(another_playlist.playlist_import("Not a playlist"))
+
+class IntegerListFieldTest(TestCase):
+	def test_integer_list_field(self):
+		"Tests that song lists survive the database, including lists stored in the old text format."
+		from django.core.management import call_command
+		from django.db import connection
+		from archiver.models import Playlist
+
+		a_playlist = Playlist(name = "Testing...", song_list = [12, 345, 6789, 12])
+		a_playlist.save()
+		self.assertEqual(list(Playlist.objects.get(id = a_playlist.id).song_list), [12, 345, 6789, 12])
+
+		#Write a list the way older versions of the field did
+		cursor = connection.cursor()
+		cursor.execute("UPDATE archiver_playlist SET song_list = %s WHERE id = %s",
+		               [u"[1, 23, 456]", a_playlist.id])
+		self.assertEqual(list(Playlist.objects.get(id = a_playlist.id).song_list), [1, 23, 456])
+
+		call_command("convert_playlists")
+		cursor.execute("SELECT song_list FROM archiver_playlist WHERE id = %s", [a_playlist.id])
+		self.assertFalse(isinstance(cursor.fetchone()[0], basestring))
+		self.assertEqual(list(Playlist.objects.get(id = a_playlist.id).song_list), [1, 23, 456])
+
+	def test_serialization(self):
+		"Tests that song lists survive dumpdata and loaddata."
+		from django.core import serializers
+		from archiver.models import Playlist
+
+		a_playlist = Playlist(name = "Testing...", song_list = [12, 345, 6789, 12])
+		a_playlist.save()
+		empty_playlist = Playlist(name = "Empty")
+		empty_playlist.save()
+
+		for serializer_format in ("json", "xml"):
+			data = serializers.serialize(serializer_format, [a_playlist, empty_playlist])
+			Playlist.objects.all().delete()
+
+			for deserialized in serializers.deserialize(serializer_format, data):
+				deserialized.save()
+
+			self.assertEqual(list(Playlist.objects.get(id = a_playlist.id).song_list), [12, 345, 6789, 12])
+			self.assertEqual(list(Playlist.objects.get(id = empty_playlist.id).song_list), [])
+
+class PlaylistEntryTest(TestCase):
+	def test_playlist_entries(self):
+		"Tests that entry-based playlists keep order through inserts, moves and renumbering."
+		from archiver.models import Archive, Song, Playlist, PlaylistEntry
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		songs = []
+		for name in ("one", "two", "three", "four"):
+			song = Song(url = "/music/%s.mp3" % name, title = name, parent_archive = new_archive)
+			song.save()
+			songs.append(song)
+
+		a_playlist = Playlist(name = "Testing...")
+		a_playlist.song_list = [songs[0].id, songs[1].id]
+		a_playlist.save()
+		a_playlist.convert_to_entries()
+
+		song_ids = lambda: [song.id for song in a_playlist._iter_songs()]
+		self.assertEqual(song_ids(), [songs[0].id, songs[1].id])
+
+		a_playlist.append(songs[2])
+		a_playlist.insert(0, songs[3])
+		self.assertEqual(song_ids(), [songs[3].id, songs[0].id, songs[1].id, songs[2].id])
+
+		a_playlist.move(0, 3)
+		self.assertEqual(song_ids(), [songs[0].id, songs[1].id, songs[3].id, songs[2].id])
+
+		#Neighbours are found by seeking on the key, in a single query
+		last_entry = a_playlist._entry_at(3)
+		with self.assertNumQueries(1):
+			key = PlaylistEntry.key_between(a_playlist, last_entry)
+		self.assertTrue(a_playlist._entry_at(2).position < key < last_entry.position)
+
+		#Keep inserting at the same spot until the keys run out of room
+		for attempt in range(25):
+			a_playlist.insert(1, songs[2])
+		self.assertEqual(len(song_ids()), 29)
+		self.assertEqual(song_ids()[:2], [songs[0].id, songs[2].id])
+		self.assertEqual(song_ids()[-3:], [songs[1].id, songs[3].id, songs[2].id])
+
+		a_playlist.remove(0)
+		self.assertEqual(a_playlist.entries.count(), 28)
+		self.assertEqual(song_ids()[0], songs[2].id)
+
+		self.assertEqual(a_playlist.move(28, 0), False)
+		self.assertEqual(a_playlist.remove(28), False)
+		self.assertEqual(a_playlist.entries.count(), 28)
+
+		#Renumbering rewrites every key in bulk, not one row at a time
+		before = song_ids()
+		with self.assertNumQueries(3):
+			PlaylistEntry.renumber(a_playlist)
+		self.assertEqual(song_ids(), before)
+		self.assertEqual(list(a_playlist.entries.values_list('position', flat = True)),
+		                 [(index + 1) * PlaylistEntry.GAP for index in range(28)])
+
+class SmartPlaylistTest(TestCase):
+	def test_filter_expressions(self):
+		"Tests that filter expressions are parsed, and bad ones rejected."
+		from archiver import smart_query
+
+		for expression in ('rating >= 4', 'genre = "Hip Hop" or genre ~ rap',
+		                   'not (play_count = 0 and year < 2000)', 'add_date > 2013-01-01'):
+			smart_query.parse(expression)
+
+		for expression in ('', 'rating >=', 'colour = red', 'rating = high',
+		                   'year ~ 19', '(rating = 1', 'rating = 1 rating = 2'):
+			self.assertRaises(smart_query.FilterSyntaxError, smart_query.parse, expression)
+
+	def test_smart_playlist_membership(self):
+		"Tests that smart playlist membership follows songs as they change."
+		from archiver.models import Archive, Song, SmartPlaylist
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		good_song = Song(url = "/music/good.mp3", genre = "Rock", rating = 4, parent_archive = new_archive)
+		good_song.save()
+		bad_song = Song(url = "/music/bad.mp3", genre = "rock", rating = 1, parent_archive = new_archive)
+		bad_song.save()
+
+		smart_playlist = SmartPlaylist(name = "Good rock", query = 'genre = rock and rating >= 4')
+		smart_playlist.save()
+		self.assertEqual(list(smart_playlist.songs.all()), [good_song])
+
+		bad_song.rating = 5
+		bad_song.save()
+		good_song.rating = 2
+		good_song.save()
+		self.assertEqual(list(smart_playlist.songs.all()), [bad_song])
+
+		#Only the changed songs are looked at
+		Song.objects.filter(id = good_song.id).update(rating = 5)
+		with self.assertNumQueries(3):
+			smart_playlist.update_songs([good_song.id])
+		self.assertEqual(set(smart_playlist.songs.all()), set([good_song, bad_song]))
+
+		smart_playlist.query = 'rating = 5 and genre != rock'
+		smart_playlist.save()
+		self.assertEqual(list(smart_playlist.songs.all()), [])
+
+	def test_scanned_songs_refreshed(self):
+		"Tests that songs added by a filesystem scan join smart playlists straight away."
+		import os, shutil, tempfile
+		from archiver.models import Archive, SmartPlaylist
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			with open(os.path.join(root_folder, "new.mp3"), 'wb') as song_file:
+				song_file.write("new")
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+
+			recent = SmartPlaylist(name = "Recent", query = 'add_date > 2000-01-01')
+			recent.save()
+
+			new_archive.quick_scan()
+			self.assertEqual([song.url for song in recent.songs.all()],
+			                 [os.path.join(root_folder, "new.mp3")])
+
+		finally:
+			shutil.rmtree(root_folder)
+
+	def test_deferred_refresh(self):
+		"Tests that songs saved in a deferred_refresh block are refreshed together."
+		from archiver.models import Archive, Song, SmartPlaylist
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		for name in ("Low", "High"):
+			SmartPlaylist(name = name, query = 'rating >= 4' if name == "High" else 'rating < 4').save()
+
+		songs = [Song(url = "/music/%d.mp3" % index, parent_archive = new_archive) for index in range(5)]
+		with SmartPlaylist.deferred_refresh():
+			for song in songs:
+				song.rating = 5
+				song.save()
+
+			self.assertEqual(SmartPlaylist.objects.get(name = "High").songs.count(), 0)
+
+		self.assertEqual(SmartPlaylist.objects.get(name = "High").songs.count(), 5)
+
+		#Every song moves from one playlist to the other in a single refresh
+		Song.objects.filter(id__in = [song.id for song in songs]).update(rating = 1)
+		SmartPlaylist.refresh_songs([song.id for song in songs])
+		self.assertEqual(SmartPlaylist.objects.get(name = "High").songs.count(), 0)
+		self.assertEqual(sorted(SmartPlaylist.objects.get(name = "Low").songs.values_list('id', flat = True)),
+		                 sorted(song.id for song in songs))
+
+	def test_saves_without_smart_playlists(self):
+		"Tests that saving songs costs no refresh queries when there are no smart playlists."
+		from archiver import search
+		from archiver.models import Archive, Song, SmartPlaylist
+		from archiver.models.smart_playlist import _smart_playlists_changed
+
+		#Playlists rolled back with earlier tests never sent a signal
+		_smart_playlists_changed()
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		#Only count the song's own query, not those of the search index
+		previous_backend, search._backend = search._backend, search.LikeBackend()
+		try:
+			Song(url = "/music/0.mp3", parent_archive = new_archive).save()
+			with self.assertNumQueries(1):
+				Song(url = "/music/1.mp3", parent_archive = new_archive).save()
+		finally:
+			search._backend = previous_backend
+
+		#A new smart playlist is noticed straight away
+		SmartPlaylist(name = "Everything", query = 'rating < 10').save()
+		song = Song(url = "/music/2.mp3", parent_archive = new_archive)
+		song.save()
+		self.assertTrue(SmartPlaylist.objects.get(name = "Everything").songs.filter(id = song.id).exists())
+
+class DownloadTest(TestCase):
+	def test_conditional_feed_fetch(self):
+		"Tests that an unchanged feed is answered with a 304."
+		from archiver import download
+		from archiver.test_utils import LocalHTTPServer
+
+		with LocalHTTPServer({"/feed.xml": "<rss></rss>"}) as server:
+			response, etag, last_modified = download.open_feed(server.url("/feed.xml"))
+			self.assertEqual(response.read(), "<rss></rss>")
+			response.close()
+
+			self.assertEqual(download.open_feed(server.url("/feed.xml"), etag),
+			                 (None, etag, None))
+			self.assertEqual(server.requests[-1][1].get("if-none-match"), etag)
+
+	def test_resumed_download(self):
+		"Tests that partial downloads are continued with a Range request."
+		import os, shutil, tempfile
+		from archiver import download
+		from archiver.test_utils import LocalHTTPServer
+
+		episode = os.urandom(100000)
+		target_folder = tempfile.mkdtemp()
+		try:
+			target_url = os.path.join(target_folder, "episode.mp3")
+			with open(target_url + ".part", "wb") as partial_file:
+				partial_file.write(episode[:30000])
+
+			with LocalHTTPServer({"/episode.mp3": episode}) as server:
+				job = (server.url("/episode.mp3"), target_url)
+				self.assertEqual(download.download_file(job), (job, 70000, None))
+				self.assertEqual(server.requests[-1][1].get("range"), "bytes=30000-")
+
+			with open(target_url, "rb") as episode_file:
+				self.assertEqual(episode_file.read(), episode)
+			self.assertFalse(os.path.exists(target_url + ".part"))
+
+		finally:
+			shutil.rmtree(target_folder)
+
+	def test_sync_podcast(self):
+		"Tests that new episodes are downloaded into the archive, and unchanged feeds skipped."
+		import os, shutil, tempfile
+		from archiver.models import Archive, Feed
+		from archiver.test_utils import LocalHTTPServer
+
+		feed_xml = """<?xml version="1.0"?><rss version="2.0"><channel><title>Test</title>
+		<item><title>Two</title><pubDate>Tue, 02 Apr 2013 10:00:00 GMT</pubDate>
+		<enclosure url="%(base)s/two.mp3" type="audio/mpeg" length="5"/></item>
+		<item><title>One</title><pubDate>Mon, 01 Apr 2013 10:00:00 GMT</pubDate>
+		<enclosure url="%(base)s/one.mp3" type="audio/mpeg" length="5"/></item>
+		</channel></rss>"""
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+
+			files = {"/one.mp3": "one..", "/two.mp3": "two.."}
+			with LocalHTTPServer(files) as server:
+				files["/feed.xml"] = feed_xml % {"base": server.url("")}
+
+				a_feed = Feed(url = server.url("/feed.xml"), name = "Test", parent_archive = new_archive)
+				a_feed.save()
+
+				downloaded, deleted = a_feed.sync_podcast()
+				self.assertEqual(sorted(os.path.basename(url) for url in downloaded),
+				                 ["2013-04-01 one.mp3", "2013-04-02 two.mp3"])
+				self.assertEqual(new_archive.song_set.count(), 2)
+				self.assertEqual(a_feed.current_episodes, 2)
+
+				requests = len(server.requests)
+				self.assertEqual(a_feed.sync_podcast(), ([], []))
+				self.assertEqual(len(server.requests), requests + 1)
+
+				#A feed loaded from the database has an aware last_episode
+				files["/three.mp3"] = "three"
+				files["/feed.xml"] = (feed_xml % {"base": server.url("")}).replace("<item>",
+						'<item><title>Three</title><pubDate>Wed, 03 Apr 2013 10:00:00 GMT</pubDate>'
+						'<enclosure url="%s" type="audio/mpeg" length="5"/></item><item>'
+						% server.url("/three.mp3"), 1)
+
+				a_feed = Feed.objects.get(id = a_feed.id)
+				downloaded, deleted = a_feed.sync_podcast()
+				self.assertEqual([os.path.basename(url) for url in downloaded], ["2013-04-03 three.mp3"])
+				self.assertEqual(Feed.objects.get(id = a_feed.id).last_episode.day, 3)
+
+		finally:
+			shutil.rmtree(root_folder)
+
+class FeedSchedulerTest(TestCase):
+	def test_feed_scheduler(self):
+		"Tests that feeds are synced with per-host limits, and that failures back off."
+		import datetime, threading, time
+		from django.utils import timezone
+		from archiver.models import Archive, Feed
+		from archiver.feed_scheduler import FeedScheduler
+		from Melodia import melodia_settings
+
+		new_archive = Archive(root_folder = "/music")
+		new_archive.save()
+
+		for index in range(4):
+			Feed(url = "http://one.example.com/%d.xml" % index, name = "one %d" % index,
+			     parent_archive = new_archive).save()
+		Feed(url = "http://two.example.com/feed.xml", name = "two",
+		     update_interval = 12 * 60 * 60, parent_archive = new_archive).save()
+		Feed(url = "http://broken.example.com/feed.xml", name = "broken",
+		     parent_archive = new_archive).save()
+
+		lock          = threading.Lock()
+		running_hosts = {}
+		most_running  = {}
+		def sync_function(feed):
+			host = feed.url.split("/")[2]
+			with lock:
+				running_hosts[host] = running_hosts.get(host, 0) + 1
+				most_running[host]  = max(most_running.get(host, 0), running_hosts[host])
+
+			time.sleep(0.05)
+			with lock:
+				running_hosts[host] -= 1
+
+			if host == "broken.example.com":
+				raise IOError("Connection refused")
+
+		scheduler = FeedScheduler(workers = 4, per_host = 2, sync_function = sync_function)
+
+		#New feeds are spread out rather than all being due at once
+		later = timezone.now() + datetime.timedelta(seconds = melodia_settings.FEED_SYNC_MIN_INTERVAL)
+		self.assertEqual(scheduler.run_once(later), (5, 1))
+		self.assertEqual(most_running["one.example.com"], 2)
+
+		self.assertEqual(scheduler.due_feeds(), [])
+		self.assertEqual(Feed.objects.get(name = "broken").sync_failures, 1)
+		self.assertEqual(Feed.objects.get(name = "one 0").sync_failures, 0)
+
+		#The twice daily feed is checked about every 6 hours
+		two_sync = Feed.objects.get(name = "two").next_sync - timezone.now()
+		self.assertTrue(4 * 60 * 60 < two_sync.total_seconds() < 8 * 60 * 60)
+
+		broken_feed = Feed.objects.get(name = "broken")
+		broken_feed.sync_failures = 3
+		self.assertEqual(scheduler.backoff(broken_feed), 4 * melodia_settings.FEED_SYNC_MIN_INTERVAL)
+
+class FeedParserTest(TestCase):
+	def test_incremental_feed_parse(self):
+		"Tests that only the head of a feed is read when most episodes are already known."
+		import datetime
+		from StringIO import StringIO
+		from archiver import feed_parser
+
+		first_episode = datetime.datetime(2013, 1, 1)
+		items = "".join('<item><title>Episode %d</title><pubDate>%s</pubDate>'
+		                '<enclosure url="http://example.com/%d.mp3" type="audio/mpeg" length="1"/></item>'
+		                % (index, (first_episode - datetime.timedelta(days = index))
+		                          .strftime("%a, %d %b %Y %H:%M:%S +0000"), index)
+		                for index in range(5000))
+		feed_xml = '<?xml version="1.0"?><rss version="2.0"><channel><title>Test</title>%s</channel></rss>' % items
+
+		class CountingReader(StringIO):
+			bytes_read = 0
+			def read(self, size = -1):
+				data = StringIO.read(self, size)
+				self.bytes_read += len(data)
+				return data
+
+		feed_file = CountingReader(feed_xml)
+		episodes  = feed_parser.read_episodes(feed_file, first_episode - datetime.timedelta(days = 3))
+		self.assertEqual(len(episodes), 10)
+		self.assertEqual(episodes[0]["title"], "Episode 0")
+		self.assertEqual(episodes[0]["enclosures"][0]["href"], "http://example.com/0.mp3")
+		self.assertTrue(feed_file.bytes_read < len(feed_xml) / 10)
+
+		#Feed.last_episode is aware once it has been loaded from the database
+		from django.utils import timezone
+		known_until = timezone.make_aware(first_episode - datetime.timedelta(days = 3), timezone.utc)
+		self.assertEqual(len(feed_parser.read_episodes(StringIO(feed_xml), known_until)), 10)
+
+		self.assertEqual(len(feed_parser.read_episodes(StringIO(feed_xml))), 5000)
+
+		atom_xml = ('<feed xmlns="http://www.w3.org/2005/Atom"><title>Test</title>'
+		            '<entry><title>One</title><published>2013-04-01T10:00:00+02:00</published>'
+		            '<link rel="enclosure" type="audio/mpeg" href="http://example.com/1.mp3"/></entry></feed>')
+		episodes = feed_parser.read_episodes(StringIO(atom_xml))
+		self.assertEqual(episodes[0]["published_parsed"][:4], (2013, 4, 1, 8))
+		self.assertEqual(episodes[0]["enclosures"][0]["href"], "http://example.com/1.mp3")
+
+		#RSS 1.0 items are namespaced, feedparser reads those instead
+		rdf_xml = ('<?xml version="1.0"?><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+		           'xmlns="http://purl.org/rss/1.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+		           '<channel rdf:about="http://example.com/"><title>Test</title></channel>'
+		           '<item rdf:about="http://example.com/1"><title>One</title>'
+		           '<link>http://example.com/1</link><dc:date>2013-04-01T10:00:00+02:00</dc:date></item>'
+		           '<item rdf:about="http://example.com/2"><title>Two</title>'
+		           '<link>http://example.com/2</link></item></rdf:RDF>')
+		episodes = feed_parser.read_episodes(StringIO(rdf_xml))
+		self.assertEqual([episode["title"] for episode in episodes], ["One", "Two"])
+		self.assertEqual(episodes[0]["updated_parsed"][:4], (2013, 4, 1, 8))
+
+class TranscodeTest(TestCase):
+	def test_transcode_cache(self):
+		"Tests that transcodes can be read while running, and are cached and evicted."
+		import math, os, shutil, struct, tempfile, wave
+		from archiver import transcode
+		from archiver.models import Archive, Song
+		from Melodia import melodia_settings
+
+		root_folder = tempfile.mkdtemp()
+		old_formats = melodia_settings.TRANSCODE_FORMATS
+		try:
+			#WAV needs no external encoder
+			melodia_settings.TRANSCODE_FORMATS = ('wav',)
+
+			source = wave.open(os.path.join(root_folder, "song.wav"), 'wb')
+			source.setnchannels(1)
+			source.setsampwidth(2)
+			source.setframerate(44100)
+			source.writeframes("".join(struct.pack("<h", int(10000 * math.sin(index / 10.0)))
+			                           for index in range(44100 * 5)))
+			source.close()
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+			song = Song(url = "song.wav", parent_archive = new_archive)
+			song.save()
+
+			cache = transcode.TranscodeCache(os.path.join(root_folder, "cache"), max_bytes = 10 ** 9)
+			job   = transcode.start_transcode(song, "wav", None, cache)
+
+			output = "".join(transcode.iter_growing_file(job, chunk_size = 4096))
+			self.assertEqual(job.error, None)
+			self.assertEqual(len(output), os.path.getsize(job.path))
+
+			key = cache.key(song, "wav", None)
+			self.assertEqual(cache.get(key, "wav"), job.path)
+
+			cache.max_bytes = 1
+			cache.evict()
+			self.assertEqual(cache.get(key, "wav"), None)
+
+			self.assertRaises(transcode.TranscodeError, transcode.get_format, "flac")
+
+		finally:
+			melodia_settings.TRANSCODE_FORMATS = old_formats
+			shutil.rmtree(root_folder)
+
+class ThumbnailTest(TestCase):
+	def test_covers_deduplicated(self):
+		"Tests that covers are stored once by content, and songs without one are marked."
+		import os, shutil, tempfile, wave
+		from django.conf import settings
+		from archiver import thumbnails
+		from archiver.models import Archive, Song
+
+		root_folder   = tempfile.mkdtemp()
+		old_cache_dir = settings.CACHE_DIR
+		try:
+			settings.CACHE_DIR = os.path.join(root_folder, "cache")
+
+			cover_hash = thumbnails.store_cover("cover image")
+			self.assertEqual(thumbnails.store_cover("cover image"), cover_hash)
+			self.assertEqual(thumbnails.store_cover("other image") == cover_hash, False)
+			self.assertEqual(os.listdir(os.path.join(settings.CACHE_DIR, "covers", cover_hash[:2])),
+			                 [cover_hash])
+
+			#WAV files can't carry a cover
+			source = wave.open(os.path.join(root_folder, "song.wav"), 'wb')
+			source.setnchannels(1)
+			source.setsampwidth(2)
+			source.setframerate(44100)
+			source.writeframes("\0\0" * 44100)
+			source.close()
+
+			new_archive = Archive(root_folder = root_folder)
+			new_archive.save()
+			Song(url = "song.wav", parent_archive = new_archive).save()
+			Song(url = "missing.wav", parent_archive = new_archive).save()
+
+			new_archive.update_covers()
+			self.assertEqual(Song.objects.get(url = "song.wav").cover_hash, "")
+			self.assertEqual(Song.objects.get(url = "missing.wav").cover_hash, None)
+
+		finally:
+			settings.CACHE_DIR = old_cache_dir
+			shutil.rmtree(root_folder)
+
+class WaveformTest(TestCase):
+	def test_peak_pyramid(self):
+		"Tests that peaks are computed per level and the closest level is read back."
+		import os, shutil, struct, tempfile, wave
+		from archiver import waveform
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			#Stereo, loud on the left channel for the second half only
+			source = wave.open(os.path.join(root_folder, "song.wav"), 'wb')
+			source.setnchannels(2)
+			source.setsampwidth(2)
+			source.setframerate(8000)
+			source.writeframes(struct.pack("<hh", 0, 0) * 4000 + struct.pack("<hh", 25600, -100) * 4000)
+			source.close()
+
+			sample_rate, total_frames, levels = waveform.compute_peaks(os.path.join(root_folder, "song.wav"),
+			                                                           frames_per_peak = 100, min_peaks = 10)
+			self.assertEqual((sample_rate, total_frames), (8000, 8000))
+			self.assertEqual([len(level) // 2 for level in levels], [80, 40, 20, 10])
+			self.assertEqual(list(levels[0][:2]), [0, 0])
+			self.assertEqual(list(levels[0][-2:]), [-1, 100])
+			self.assertEqual(list(levels[-1]), [0, 0] * 5 + [-1, 100] * 5)
+
+			path = os.path.join(root_folder, "song.peaks")
+			waveform.write_peaks(path, sample_rate, total_frames, levels, frames_per_peak = 100)
+
+			level = waveform.read_peaks(path, 30)
+			self.assertEqual(level["frames_per_peak"], 200)
+			self.assertEqual(len(level["peaks"]) // 2, 40)
+
+			#Asking for more than there is gets the finest level
+			self.assertEqual(waveform.read_peaks(path, 1000)["frames_per_peak"], 100)
+
+			#Files cut short anywhere are rejected, not half read
+			with open(path, 'rb') as peaks_file:
+				peaks_data = peaks_file.read()
+			for length in (3, struct.calcsize("<4sHIII") + 6, len(peaks_data) - 1):
+				with open(path, 'wb') as peaks_file:
+					peaks_file.write(peaks_data[:length])
+				self.assertRaises(IOError, waveform.read_peaks, path, 10)
+
+		finally:
+			shutil.rmtree(root_folder)
+
+class FormatSniffTest(TestCase):
+	def test_sniff_types(self):
+		"Tests that files are identified from their first bytes, without probing every type."
+		import os, shutil, tempfile, wave
+		import audiotools
+
+		root_folder = tempfile.mkdtemp()
+		try:
+			source = wave.open(os.path.join(root_folder, "song.wav"), 'wb')
+			source.setnchannels(1)
+			source.setsampwidth(2)
+			source.setframerate(44100)
+			source.writeframes("\0\0" * 100)
+			source.close()
+
+			with open(os.path.join(root_folder, "song.wav"), 'rb') as song_file:
+				self.assertEqual(audiotools.sniff_types(song_file, "song.wav"),
+				                 [(audiotools.WaveAudio, False)])
+			self.assertEqual(audiotools.open(os.path.join(root_folder, "song.wav")).NAME, "wav")
+
+			with open(os.path.join(root_folder, "notes.txt"), 'wb') as other_file:
+				other_file.write("Not a song at all" * 10)
+			self.assertRaises(audiotools.UnsupportedFile, audiotools.open,
+			                  os.path.join(root_folder, "notes.txt"))
+
+		finally:
+			shutil.rmtree(root_folder)
+
+class WatcherTest(TestCase):
+	def setUp(self):
+		import os, tempfile
+		from archiver.models import Archive
+
+		self.root_folder = tempfile.mkdtemp()
+
+		#A relative root folder must still give the same URLs as a scan
+		self.archive = Archive(root_folder = os.path.relpath(self.root_folder))
+		self.archive.save()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.root_folder)
+
+	def _write(self, name, data = "song"):
+		import os
+		with open(os.path.join(self.root_folder, name), 'wb') as song_file:
+			song_file.write(data)
+		return os.path.join(self.root_folder, name)
+
+	def test_update_paths(self):
+		"Tests that specific files are added, changed and removed without a full scan."
+		import os
+
+		url = self._write("one.mp3")
+		self.assertEqual(self.archive.update_paths([os.path.relpath(url)]), (1, 0, 0))
+		self.assertEqual(self.archive.quick_scan(), (0, 0, 0))
+
+		self._write("one.mp3", "longer song")
+		self.assertEqual(self.archive.update_paths([url]), (0, 1, 0))
+
+		os.remove(url)
+		self.assertEqual(self.archive.update_paths([url]), (0, 0, 1))
+		self.assertEqual(self.archive.song_set.count(), 0)
+
+	def test_event_coalescing(self):
+		"Tests that several events for the same file are applied as one change."
+		from archiver import watcher
+
+		archive_watcher = watcher.ArchiveWatcher([self.archive])
+		try:
+			if not archive_watcher._watches:
+				#No inotify here - the sweep test covers this case
+				return
+
+			root_watch = [watch_descriptor for watch_descriptor, (archive, dirname)
+			              in archive_watcher._watches.items() if dirname == self.root_folder][0]
+
+			url = self._write("one.mp3")
+			for mask in (watcher.IN_CREATE, watcher.IN_CLOSE_WRITE, watcher.IN_ATTRIB):
+				archive_watcher._handle_event(root_watch, mask, "one.mp3")
+			archive_watcher._handle_event(root_watch, watcher.IN_CLOSE_WRITE, "cover.jpg")
+
+			self.assertEqual(archive_watcher._dirty, {self.archive.id: set([url])})
+
+			archive_watcher.flush()
+			self.assertEqual(list(self.archive.song_set.values_list('url', flat = True)), [url])
+			self.assertEqual(self.archive.quick_scan(), (0, 0, 0))
+
+		finally:
+			archive_watcher.close()
+
+	def test_sweep_fallback(self):
+		"Tests that folders which can't be watched are swept instead."
+		import errno
+		from archiver import watcher
+
+		class FullInotify(object):
+			"Inotify that is out of watches"
+			def add_watch(self, path, mask):
+				raise OSError(errno.ENOSPC, "No space left on device", path)
+
+			def close(self):
+				pass
+
+		real_inotify   = watcher.Inotify
+		watcher.Inotify = FullInotify
+		try:
+			archive_watcher = watcher.ArchiveWatcher([self.archive])
+		finally:
+			watcher.Inotify = real_inotify
+
+		self.assertEqual(archive_watcher._unwatched, {self.root_folder: self.archive})
+
+		url = self._write("one.mp3")
+		archive_watcher.sweep()
+		self.assertEqual(archive_watcher._dirty, {self.archive.id: set([url])})
+
+		archive_watcher.flush()
+		self.assertEqual(list(self.archive.song_set.values_list('url', flat = True)), [url])
+
+		#Nothing changed since the last sweep
+		archive_watcher.sweep()
+		self.assertEqual(archive_watcher._dirty, {})
+
+class ReorganizeTest(TestCase):
+	def setUp(self):
+		import os, tempfile
+		from django.conf import settings
+		from archiver.models import Archive
+
+		self.root_folder   = tempfile.mkdtemp()
+		self.old_cache_dir = settings.CACHE_DIR
+		settings.CACHE_DIR = tempfile.mkdtemp()
+
+		self.archive = Archive(root_folder = self.root_folder)
+		self.archive.save()
+
+	def tearDown(self):
+		import shutil
+		from django.conf import settings
+
+		shutil.rmtree(settings.CACHE_DIR)
+		settings.CACHE_DIR = self.old_cache_dir
+		shutil.rmtree(self.root_folder)
+
+	def _add_song(self, name, artist):
+		import os
+		from archiver.models import Song
+
+		url = os.path.join(self.root_folder, name)
+		if not os.path.isdir(os.path.dirname(url)):
+			os.makedirs(os.path.dirname(url))
+		with open(url, 'wb') as song_file:
+			song_file.write(name)
+
+		song = Song(url = url, artist = artist, parent_archive = self.archive)
+		song.save()
+		return song
+
+	def test_collisions(self):
+		"Tests that moves onto another song or an existing file are set aside."
+		import os
+		from archiver import reorganize
+
+		first  = self._add_song("a/song.mp3", "Band")
+		second = self._add_song("b/song.mp3", "Band")
+		third  = self._add_song("c/other.mp3", "Band")
+		fourth = self._add_song("d/taken.mp3", "Solo")
+		os.makedirs(os.path.join(self.root_folder, "Solo"))
+		with open(os.path.join(self.root_folder, "Solo", "taken.mp3"), 'wb') as existing_file:
+			existing_file.write("not a song")
+
+		moves, collisions = reorganize.plan_moves(self.archive, self.archive.song_set.all(), "%a/%f")
+		self.assertEqual(sorted(move[0] for move in moves), [third.id])
+		self.assertEqual(sorted(move[0] for move in collisions), sorted([first.id, second.id, fourth.id]))
+
+		self.assertEqual(len(self.archive.reorganize("%a/%f")), 3)
+		self.assertTrue(os.path.exists(os.path.join(self.root_folder, "a", "song.mp3")))
+		self.assertTrue(os.path.exists(os.path.join(self.root_folder, "b", "song.mp3")))
+		with open(os.path.join(self.root_folder, "Solo", "taken.mp3"), 'rb') as existing_file:
+			self.assertEqual(existing_file.read(), "not a song")
+
+	def test_resume(self):
+		"Tests that an interrupted reorganize resumes without losing or repeating moves."
+		import os
+		from archiver import reorganize
+		from archiver.models import Song
+
+		songs = [self._add_song("old/%d.mp3" % index, "Artist %d" % index) for index in range(4)]
+
+		class Interrupted(Exception):
+			pass
+
+		def interrupt(done, total, url, new_url):
+			if done == 1:
+				raise Interrupted()
+
+		self.assertRaises(Interrupted, self.archive.reorganize, "%a/%f", interrupt)
+		self.assertTrue(os.path.exists(reorganize.Journal(self.archive).path))
+
+		moves, completed = reorganize.Journal(self.archive).load("%a/%f")
+		self.assertEqual(len(moves), 4)
+		self.assertEqual(len(completed), 1)
+
+		#Moved on disk, but interrupted before the database was told
+		pending = [move for move in moves if (move[0], move[2]) not in completed]
+		song_id, url, new_url = pending[0]
+		os.makedirs(os.path.dirname(new_url))
+		os.rename(url, new_url)
+
+		#A different plan doesn't resume this one
+		self.assertEqual(reorganize.Journal(self.archive).load("%f"), None)
+
+		self.assertEqual(self.archive.reorganize("%a/%f"), [])
+		self.assertFalse(os.path.exists(reorganize.Journal(self.archive).path))
+
+		for index, song in enumerate(songs):
+			new_url = os.path.join(self.root_folder, "Artist %d" % index, "%d.mp3" % index)
+			self.assertEqual(Song.objects.get(id = song.id).url, new_url)
+			with open(new_url, 'rb') as song_file:
+				self.assertEqual(song_file.read(), "old/%d.mp3" % index)
+
+		self.assertEqual(os.listdir(os.path.join(self.root_folder, "old")), [])
+
+	def test_swaps(self):
+		"Tests that moves onto files being moved away are ordered, and swaps go through a temporary name."
+		import os
+		from archiver import reorganize
+		from archiver.models import Song
+
+		first  = self._add_song("Two/first.mp3", "One")
+		second = self._add_song("One/first.mp3", "Two")
+		third  = self._add_song("Three/third.mp3", "Four")
+		fourth = self._add_song("Four/third.mp3", "Five")
+
+		moves, collisions = reorganize.plan_moves(self.archive, self.archive.song_set.all(), "%a/%f")
+		self.assertEqual(collisions, [])
+		self.assertEqual(len(moves), 5)
+		self.assertTrue(moves.index((fourth.id, fourth.url, os.path.join(self.root_folder, "Five", "third.mp3")))
+		                < moves.index((third.id, third.url, fourth.url)))
+
+		self.assertEqual(self.archive.reorganize("%a/%f"), [])
+		for song, folder in ((first, "One"), (second, "Two"), (third, "Four"), (fourth, "Five")):
+			url = Song.objects.get(id = song.id).url
+			self.assertEqual(url, os.path.join(self.root_folder, folder, os.path.basename(song.url)))
+			with open(url, 'rb') as song_file:
+				self.assertEqual(song_file.read(), os.path.relpath(song.url, self.root_folder))
+
+	def test_vanished_source(self):
+		"Tests that a move whose file has vanished is skipped without stopping the others."
+		import os
+		from archiver.models import Song
+
+		gone  = self._add_song("old/gone.mp3", "Artist")
+		other = self._add_song("old/other.mp3", "Artist")
+		os.remove(gone.url)
+
+		skipped = self.archive.reorganize("%a/%f")
+		self.assertEqual([move[0] for move in skipped], [gone.id])
+		self.assertEqual(Song.objects.get(id = gone.id).url, gone.url)
+		self.assertEqual(Song.objects.get(id = other.id).url,
+		                 os.path.join(self.root_folder, "Artist", "other.mp3"))
+
+	def test_copy_worker(self):
+		"Tests that cross-device copies go through a .part file, and failures are reported."
+		import os
+		from Queue import Queue
+		from archiver import reorganize
+
+		song    = self._add_song("song.mp3", "Artist")
+		new_url = os.path.join(self.root_folder, "copy.mp3")
+		missing = os.path.join(self.root_folder, "missing", "copy.mp3")
+
+		results = Queue()
+		reorganize._copy_worker([(song.id, song.url, new_url), (song.id, song.url, missing)], results)
+
+		self.assertEqual(results.get(), ((song.id, song.url, new_url), None))
+		move, error = results.get()
+		self.assertTrue(isinstance(error, IOError))
+
+		with open(new_url, 'rb') as song_file:
+			self.assertEqual(song_file.read(), "song.mp3")
+		#The original stays until the database points at the copy
+		self.assertTrue(os.path.exists(song.url))
+		self.assertEqual(sorted(name for name in os.listdir(self.root_folder) if name.endswith(".part")), [])
+
+class BatchWriterTest(TestCase):
+	def setUp(self):
+		from archiver.models import Archive
+
+		self.archive = Archive(root_folder = "/music")
+		self.archive.save()
+
+	def _song(self, index):
+		from archiver.models import Song
+		return Song(url = "/music/%d.mp3" % index, parent_archive = self.archive)
+
+	def test_flush_threshold(self):
+		"Tests that a batch is written once it is full, and the rest on exit."
+		from archiver.batch import BatchWriter
+
+		with BatchWriter(self.archive.song_set.model, batch_size = 3) as writer:
+			writer.insert(self._song(0))
+			writer.insert(self._song(1))
+			self.assertEqual(self.archive.song_set.count(), 0)
+
+			writer.insert(self._song(2))
+			self.assertEqual(self.archive.song_set.count(), 3)
+			self.assertEqual(writer.batches, 1)
+
+			writer.insert(self._song(3))
+
+		self.assertEqual(self.archive.song_set.count(), 4)
+		self.assertEqual(writer.stats()['rows'], 4)
+		self.assertEqual(writer.stats()['batches'], 2)
+
+		#Nothing partial is written on top of an error
+		try:
+			with BatchWriter(self.archive.song_set.model) as writer:
+				writer.insert(self._song(4))
+				raise ValueError
+		except ValueError:
+			pass
+		self.assertEqual(self.archive.song_set.count(), 4)
+
+	def test_grouped_updates(self):
+		"Tests that updates setting the same values share one statement."
+		from archiver.batch import BatchWriter
+		from archiver.models import Song
+
+		songs = [self._song(index) for index in range(4)]
+		for song in songs:
+			song.save()
+
+		writer = BatchWriter(Song)
+		for song in songs[:3]:
+			writer.update(song.id, metadata_stale = False, rating = 3)
+		writer.update(songs[3].id, rating = 5, metadata_stale = False)
+
+		with self.assertNumQueries(2):
+			writer.flush()
+
+		self.assertEqual(sorted(Song.objects.values_list('rating', flat = True)), [3, 3, 3, 5])
+		self.assertEqual(Song.objects.filter(metadata_stale = True).count(), 0)
+
+	def test_insert_chunks(self):
+		"Tests that inserts are split to stay under SQLite's parameter limit."
+		from archiver.batch import BatchWriter
+		from archiver.models import Song
+
+		chunk_size = 999 // len(Song._meta.local_fields)
+
+		writer = BatchWriter(Song, batch_size = chunk_size * 10)
+		for index in range(chunk_size + 1):
+			writer.insert(self._song(index))
+
+		with self.assertNumQueries(2):
+			writer.flush()
+		self.assertEqual(Song.objects.count(), chunk_size + 1)
+
+	def test_deletes(self):
+		"Tests that queued deletes are applied in chunks, and leave other rows alone."
+		from archiver.batch import BatchWriter
+		from archiver.models import Song
+		from archiver.utils import QUERY_CHUNK_SIZE
+
+		with BatchWriter(Song, batch_size = QUERY_CHUNK_SIZE * 3) as writer:
+			for index in range(QUERY_CHUNK_SIZE + 5):
+				writer.insert(self._song(index))
+
+		song_ids = list(Song.objects.order_by('id').values_list('id', flat = True))
+		with BatchWriter(Song, batch_size = QUERY_CHUNK_SIZE * 3) as writer:
+			for song_id in song_ids[1:]:
+				writer.delete(song_id)
+
+		self.assertEqual(list(Song.objects.values_list('id', flat = True)), song_ids[:1])
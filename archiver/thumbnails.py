@@ -0,0 +1,176 @@
+"""
+Cover art thumbnails. The same cover is usually embedded in every track of
+an album, so covers are stored once by the hash of their content
+(:data:`Song.cover_hash`) under ``CACHE_DIR/covers``, next to thumbnails in
+each of the :data:`melodia_settings.THUMBNAIL_SIZES`. An album's worth of
+tracks costs one resize per size, and displaying a cover is a single read
+of a file that is already the right size.
+
+:func:`iter_covers` extracts covers and generates their thumbnails over a
+pool of :data:`melodia_settings.THUMBNAIL_WORKERS` processes, since resizing
+is CPU-bound. :func:`Archive.update_covers` runs it for the songs whose cover
+hasn't been found yet - new songs, and songs whose file changed.
+"""
+
+import hashlib, os, threading
+from multiprocessing import Pool
+
+from django.conf import settings
+
+from Melodia import melodia_settings
+
+#Content types of the formats thumbnails can be saved as
+_mime_types = {
+		'JPEG': 'image/jpeg',
+		'PNG':  'image/png',
+		'GIF':  'image/gif',
+		}
+
+def cover_folder():
+	"Folder the covers and thumbnails are stored in"
+	return os.path.join(settings.CACHE_DIR, "covers")
+
+def cover_path(cover_hash, size = None):
+	"""
+	Location of a stored cover, or of one of its thumbnails.
+
+	:param cover_hash: The cover's :data:`Song.cover_hash`
+	:param size: Thumbnail size, or None for the original image
+	"""
+	if size is None:
+		filename = cover_hash
+	else:
+		filename = "%s-%d.%s" % (cover_hash, size, melodia_settings.THUMBNAIL_FORMAT.lower())
+
+	return os.path.join(cover_folder(), cover_hash[:2], filename)
+
+def thumbnail_mime_type():
+	"MIME type of the generated thumbnails"
+	return _mime_types.get(melodia_settings.THUMBNAIL_FORMAT.upper(), 'application/octet-stream')
+
+def _write_file(path, data):
+	"Write a file so that readers never see half of it"
+	folder = os.path.dirname(path)
+	if not os.path.isdir(folder):
+		try:
+			os.makedirs(folder)
+		except OSError:
+			#Another worker may have created it first
+			if not os.path.isdir(folder):
+				raise
+
+	partial_path = "%s.%d-%d.part" % (path, os.getpid(), threading.current_thread().ident)
+	with open(partial_path, 'wb') as partial_file:
+		partial_file.write(data)
+	os.rename(partial_path, path)
+
+def extract_cover(url):
+	"""
+	Read the cover embedded in an audio file.
+
+	:rtype: The image data of the front cover (or the first image if there is
+	        no front cover), or None if the file has no images.
+	:raises IOError: If the file can't be read
+	"""
+	import audiotools
+
+	try:
+		metadata = audiotools.open(url).get_metadata()
+	except (audiotools.UnsupportedFile, audiotools.InvalidFile):
+		return None
+
+	if metadata is None:
+		return None
+
+	images = metadata.front_covers() or metadata.images()
+	if not images:
+		return None
+
+	return images[0].data
+
+def store_cover(data):
+	"""
+	Store a cover's image data, unless the same image is already stored.
+
+	:rtype: The cover's hash
+	"""
+	cover_hash = hashlib.sha1(data).hexdigest()
+
+	path = cover_path(cover_hash)
+	if not os.path.exists(path):
+		_write_file(path, data)
+
+	return cover_hash
+
+def make_thumbnail(cover_hash, size):
+	"""
+	Make a thumbnail of a stored cover, unless it has already been made.
+
+	:rtype: Path of the thumbnail
+	:raises IOError: If the cover isn't stored, or isn't an image we can read,
+	                 or PIL isn't installed
+	"""
+	path = cover_path(cover_hash, size)
+	if os.path.exists(path):
+		return path
+
+	import audiotools
+
+	if not audiotools.can_thumbnail():
+		raise IOError("PIL is needed to make thumbnails")
+
+	with open(cover_path(cover_hash), 'rb') as cover_file:
+		data = cover_file.read()
+
+	_write_file(path, audiotools.thumbnail_image(data, size, size, melodia_settings.THUMBNAIL_FORMAT))
+	return path
+
+def _cover_job(job):
+	"""
+	Worker function for :func:`iter_covers` - find the cover of one song and
+	make sure its thumbnails exist.
+	"""
+	song_id, url = job
+
+	try:
+		data = extract_cover(url)
+		if data is None:
+			return (song_id, "")
+
+		cover_hash = store_cover(data)
+
+	except (IOError, OSError):
+		return (song_id, None)
+
+	for size in melodia_settings.THUMBNAIL_SIZES:
+		try:
+			make_thumbnail(cover_hash, size)
+		except (IOError, OSError):
+			#Not an image we can read - requests for it get a 404
+			break
+
+	return (song_id, cover_hash)
+
+def iter_covers(jobs, workers = None):
+	"""
+	Find the covers of many songs at once.
+
+	:param jobs: List of ``(song_id, full_url)`` tuples
+	:param workers: Number of worker processes - defaults to :data:`melodia_settings.THUMBNAIL_WORKERS`
+	:rtype: Iterator of ``(song_id, cover_hash)`` tuples, in no particular
+	        order. ``cover_hash`` is ``""`` for songs without a cover, and
+	        None for songs whose file couldn't be read.
+	"""
+	pool = Pool(workers or melodia_settings.THUMBNAIL_WORKERS)
+	try:
+		for result in pool.imap_unordered(_cover_job, jobs, chunksize = 16):
+			yield result
+
+		pool.close()
+
+	except:
+		pool.terminate()
+		raise
+
+	finally:
+		pool.join()
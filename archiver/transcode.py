@@ -0,0 +1,310 @@
+"""
+Transcoding songs with :mod:`audiotools`, for clients that can't play the
+original format. A song is decoded to PCM (:func:`AudioFile.to_pcm`) and
+encoded by the target format's :func:`from_pcm`.
+
+Finished transcodes are kept in a :class:`TranscodeCache` under
+``CACHE_DIR/transcode``, addressed by the source file's content and the
+output settings, so playing the same song again is served from disk without
+any encoding. The cache holds at most
+:data:`melodia_settings.TRANSCODE_CACHE_SIZE` bytes, evicting the least
+recently used outputs.
+
+Encoders write their output file as they go, so a transcode can be read
+while it is still running (see :func:`start_transcode` and
+:func:`iter_growing_file`) - clients start receiving audio straight away
+rather than after the whole song has been encoded. (Encoders that go back
+and fill in a header once they finish, like LAME's VBR header, only get that
+header to clients served from the cache.)
+
+.. code-block:: python
+
+   from archiver import transcode
+   job = transcode.start_transcode(song, "mp3", transcode.compression_for_bitrate("mp3", 128))
+   for chunk in transcode.iter_growing_file(job):
+       ...
+"""
+
+import hashlib, os, threading, time
+
+from django.conf import settings
+
+from Melodia import melodia_settings
+import audiotools
+
+#Approximate average bitrate (kbps) of each compression mode, for formats
+#whose modes aren't bitrates themselves
+_mode_bitrates = {
+		'mp3': {"0": 245, "1": 225, "2": 190, "3": 175, "4": 165,
+		        "5": 130, "6": 115, "7": 100, "8": 85, "9": 65},
+		'ogg': {"0": 64, "1": 80, "2": 96, "3": 112, "4": 128, "5": 160,
+		        "6": 192, "7": 224, "8": 256, "9": 320, "10": 500},
+		}
+
+#How long a reader waits for more output from a running encoder
+_poll_interval = 0.05
+
+class TranscodeError(Exception):
+	"Raised when a file can't be transcoded"
+	pass
+
+def get_format(output_format):
+	"""
+	Find the :mod:`audiotools` class for a format name like ``"mp3"``.
+
+	:raises TranscodeError: If the format isn't supported or allowed
+	"""
+	if output_format not in melodia_settings.TRANSCODE_FORMATS or output_format not in audiotools.TYPE_MAP:
+		raise TranscodeError("Unsupported output format: %s" % output_format)
+
+	return audiotools.TYPE_MAP[output_format]
+
+def compression_for_bitrate(output_format, bitrate):
+	"""
+	Pick the compression mode of a format closest to a bitrate.
+
+	:param output_format: Format name, like ``"mp3"``
+	:param bitrate: Wanted bitrate in kbps
+	:rtype: Compression mode string for :func:`from_pcm`
+	"""
+	format_class = get_format(output_format)
+
+	mode_bitrates = _mode_bitrates.get(output_format)
+	if mode_bitrates is None:
+		#Formats like MP2 use the bitrate as the mode, lossless formats have
+		#no bitrate to pick
+		mode_bitrates = dict((mode, int(mode)) for mode in format_class.COMPRESSION_MODES
+		                     if mode.isdigit() and int(mode) >= 32)
+	if not mode_bitrates:
+		return format_class.DEFAULT_COMPRESSION
+
+	return min(mode_bitrates, key = lambda mode: abs(mode_bitrates[mode] - bitrate))
+
+def transcode(source_url, target_url, output_format, compression = None):
+	"""
+	Transcode a file.
+
+	:param source_url: File to read
+	:param target_url: File to write
+	:param output_format: Format name, like ``"mp3"``
+	:param compression: Compression mode of the format, or None for its default
+	:raises TranscodeError: If the file can't be read or encoded
+	"""
+	format_class = get_format(output_format)
+	if compression is not None and compression not in format_class.COMPRESSION_MODES:
+		raise TranscodeError("Unsupported compression for %s: %s" % (output_format, compression))
+
+	try:
+		pcm_reader = audiotools.open(source_url).to_pcm()
+		format_class.from_pcm(target_url, pcm_reader, compression)
+
+	except (IOError, audiotools.UnsupportedFile, audiotools.EncodingError, audiotools.DecodingError) as exc:
+		raise TranscodeError("Could not transcode %s: %s" % (source_url, exc))
+
+class TranscodeCache(object):
+	"""
+	Content-addressed store of transcoded files, evicting the least recently
+	used ones once their total size goes over `max_bytes`. A file's last use
+	is its modification time, which is bumped every time it is served.
+
+	:param folder: Location of the cache - defaults to ``transcode`` in ``CACHE_DIR``
+	:param max_bytes: Maximum total size - defaults to :data:`melodia_settings.TRANSCODE_CACHE_SIZE`
+	"""
+
+	def __init__(self, folder = None, max_bytes = None):
+		self.folder    = folder or os.path.join(settings.CACHE_DIR, "transcode")
+		self.max_bytes = max_bytes or melodia_settings.TRANSCODE_CACHE_SIZE
+
+	def key(self, song, output_format, compression):
+		"Cache key for a song transcoded with some settings"
+		#The file hash addresses the content, wherever the file lives. Without
+		#one, fall back on what the filesystem scan knows about the file.
+		source = song.file_hash or "%s:%s:%s" % (song.url, song.file_size, song.file_mtime)
+		return hashlib.sha1("%s|%s|%s" % (source, output_format, compression)).hexdigest()
+
+	def path(self, key, output_format):
+		"Location of a cache entry - entries are spread over subfolders"
+		return os.path.join(self.folder, key[:2], "%s.%s" % (key, output_format))
+
+	def get(self, key, output_format):
+		"Return the path of a cached transcode and mark it as used, or None"
+		path = self.path(key, output_format)
+		try:
+			os.utime(path, None)
+		except OSError:
+			return None
+
+		return path
+
+	def evict(self):
+		"Remove the least recently used entries until the cache is within its size"
+		entries     = []
+		total_bytes = 0
+		for dirname, dirnames, filenames in os.walk(self.folder):
+			for filename in filenames:
+				if filename.endswith(".part"):
+					continue
+
+				path = os.path.join(dirname, filename)
+				try:
+					file_stat = os.stat(path)
+				except OSError:
+					continue
+
+				entries.append((file_stat.st_mtime, file_stat.st_size, path))
+				total_bytes += file_stat.st_size
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total_bytes <= self.max_bytes:
+				break
+
+			try:
+				os.remove(path)
+				total_bytes -= size
+			except OSError:
+				pass
+
+class TranscodeJob(object):
+	"""
+	A transcode running in a background thread, writing into the cache.
+
+	.. data:: partial_path
+
+	   File the encoder is writing - readable while the job runs.
+
+	.. data:: path
+
+	   Where the finished output ends up.
+
+	.. data:: done
+
+	   :class:`threading.Event` set once the job has finished.
+
+	.. data:: error
+
+	   :class:`TranscodeError` if the job failed, otherwise None.
+	"""
+
+	def __init__(self, cache, key, source_url, output_format, compression):
+		self.cache         = cache
+		self.key           = key
+		self.source_url    = source_url
+		self.output_format = output_format
+		self.compression   = compression
+
+		self.path         = cache.path(key, output_format)
+		self.partial_path = self.path + ".part"
+		self.done         = threading.Event()
+		self.error        = None
+
+	def start(self):
+		folder = os.path.dirname(self.path)
+		if not os.path.isdir(folder):
+			try:
+				os.makedirs(folder)
+			except OSError:
+				if not os.path.isdir(folder):
+					raise
+
+		#Create the file up front, so readers can open it straight away
+		open(self.partial_path, 'wb').close()
+
+		thread = threading.Thread(target = self._run)
+		thread.daemon = True
+		thread.start()
+
+	def _run(self):
+		try:
+			transcode(self.source_url, self.partial_path, self.output_format, self.compression)
+			os.rename(self.partial_path, self.path)
+			self.cache.evict()
+
+		except (TranscodeError, OSError) as exc:
+			self.error = exc if isinstance(exc, TranscodeError) else TranscodeError(str(exc))
+			try:
+				os.remove(self.partial_path)
+			except OSError:
+				pass
+
+		finally:
+			with _jobs_lock:
+				_jobs.pop(self.key, None)
+			self.done.set()
+
+#Transcodes currently running, by cache key - a second listener for the same
+#output follows the running job instead of starting another one
+_jobs      = {}
+_jobs_lock = threading.Lock()
+
+_default_cache = None
+
+def get_cache():
+	"Return the shared transcode cache, creating it on first use"
+	global _default_cache
+
+	if _default_cache is None:
+		_default_cache = TranscodeCache()
+
+	return _default_cache
+
+def start_transcode(song, output_format, compression = None, cache = None):
+	"""
+	Start transcoding a song in the background, or join a transcode of the
+	same song and settings that is already running.
+
+	:param song: The :class:`Song` to transcode
+	:param output_format: Format name, like ``"mp3"``
+	:param compression: Compression mode of the format, or None for its default
+	:param cache: :class:`TranscodeCache` to write to - defaults to the shared one
+	:rtype: :class:`TranscodeJob`
+	"""
+	cache = cache or get_cache()
+	key   = cache.key(song, output_format, compression)
+
+	with _jobs_lock:
+		job = _jobs.get(key)
+		if job is None:
+			job = TranscodeJob(cache, key, song._get_full_url(), output_format, compression)
+			job.start()
+			_jobs[key] = job
+
+	return job
+
+def iter_growing_file(job, chunk_size = None):
+	"""
+	Read a transcode's output while it is being written, ending once the job
+	has finished and everything it wrote has been read.
+
+	:param job: A :class:`TranscodeJob`
+	:param chunk_size: Bytes per chunk - defaults to :data:`melodia_settings.STREAM_CHUNK_SIZE`
+	:raises TranscodeError: If the job fails
+	"""
+	chunk_size = chunk_size or melodia_settings.STREAM_CHUNK_SIZE
+
+	try:
+		output_file = open(job.partial_path, 'rb')
+	except IOError:
+		#Already finished (or failed) before we got here
+		job.done.wait()
+		if job.error is not None:
+			raise job.error
+		output_file = open(job.path, 'rb')
+
+	#The open file keeps working after the job renames it into place
+	with output_file:
+		while True:
+			finished = job.done.is_set()
+
+			chunk = output_file.read(chunk_size)
+			if chunk:
+				yield chunk
+				continue
+
+			if finished:
+				break
+
+			time.sleep(_poll_interval)
+
+	if job.error is not None:
+		raise job.error
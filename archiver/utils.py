@@ -0,0 +1,51 @@
+"""
+Small helpers shared by the archiver models. Nothing in here touches the
+database directly.
+"""
+
+import os, re
+from itertools import islice
+
+from Melodia.melodia_settings import SUPPORTED_AUDIO_EXTENSIONS
+
+#SQLite refuses queries with more than 999 bound parameters, so anything
+#built from an ``__in`` lookup is split into chunks of this size.
+QUERY_CHUNK_SIZE = 500
+
+_supported_extns_regex = '|'.join(( '.*\\.' + ext + '$' for ext
+                                    in SUPPORTED_AUDIO_EXTENSIONS))
+_supported_regex = re.compile(_supported_extns_regex, re.IGNORECASE)
+
+def is_supported_file(filename):
+	"Check whether a filename has one of the :data:`SUPPORTED_AUDIO_EXTENSIONS`"
+	return _supported_regex.match(filename) is not None
+
+def chunked(iterable, size = QUERY_CHUNK_SIZE):
+	"""
+	Split an iterable into lists of at most `size` elements.
+
+	:param iterable: Any iterable
+	:param size: Maximum number of elements per chunk
+	:rtype: Generator of lists
+	"""
+	iterator = iter(iterable)
+	while True:
+		chunk = list(islice(iterator, size))
+		if not chunk:
+			return
+
+		yield chunk
+
+def stat_file(url):
+	"""
+	Grab the fields used to decide whether a file has changed on disk.
+
+	:param url: Full path to the file
+	:rtype: Tuple of ``(size, mtime, inode)``, or ``None`` if the file can not be read.
+	"""
+	try:
+		file_stat = os.stat(url)
+	except OSError:
+		return None
+
+	return (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino)
@@ -0,0 +1,322 @@
+"""
+Live watching of :class:`Archive` folders. The :class:`ArchiveWatcher` listens
+for inotify events under every archive's :data:`root_folder`, collects the
+paths that changed and applies them in batches with :func:`Archive.update_paths`
+once things have been quiet for a moment - so copying in an album results in
+one batch instead of one per file.
+
+If the kernel runs out of inotify watches (see
+``/proc/sys/fs/inotify/max_user_watches``), the folders that could not be
+watched are swept periodically instead, comparing file sizes and mtimes
+against the previous sweep.
+"""
+
+import ctypes, ctypes.util
+import errno, os, select, struct, time
+
+from Melodia import melodia_settings
+from archiver.utils import is_supported_file, stat_file
+
+#Constants from <sys/inotify.h>
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+_watch_mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+_event_header = struct.Struct("iIII")
+
+class Inotify(object):
+	"""
+	Minimal wrapper around the Linux inotify system calls using :mod:`ctypes`.
+	Raises :class:`OSError` on creation if inotify is not available.
+	"""
+
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+
+		try:
+			self._add_watch = libc.inotify_add_watch
+			self._rm_watch  = libc.inotify_rm_watch
+			self.fd         = libc.inotify_init()
+		except AttributeError:
+			raise OSError(errno.ENOSYS, "inotify is not supported on this platform")
+
+		if self.fd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+
+	def add_watch(self, path, mask):
+		"Watch a path for the events in `mask` - returns the watch descriptor"
+		if isinstance(path, unicode):
+			path = path.encode('utf-8')
+
+		watch_descriptor = self._add_watch(self.fd, path, mask)
+		if watch_descriptor < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error), path)
+
+		return watch_descriptor
+
+	def rm_watch(self, watch_descriptor):
+		"Stop watching a watch descriptor"
+		self._rm_watch(self.fd, watch_descriptor)
+
+	def read_events(self, timeout):
+		"""
+		Wait up to `timeout` seconds for events.
+
+		:rtype: List of ``(watch_descriptor, mask, cookie, name)`` tuples
+		"""
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return []
+
+		buffer = os.read(self.fd, 64 * 1024)
+
+		events = []
+		offset = 0
+		while offset < len(buffer):
+			watch_descriptor, mask, cookie, length = _event_header.unpack_from(buffer, offset)
+			offset += _event_header.size
+
+			name    = buffer[offset:offset + length].rstrip('\0')
+			offset += length
+
+			events.append((watch_descriptor, mask, cookie, name))
+
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+class ArchiveWatcher(object):
+	"""
+	Watch a set of archives and keep their songs up to date.
+
+	:param archives: Iterable of :class:`Archive` instances to watch
+	:param coalesce_delay: Seconds without new events before changes are applied
+	:param max_delay: Maximum seconds a change waits while events keep coming
+	:param sweep_interval: Seconds between sweeps of folders inotify can't watch
+	:param progress_callback: Function called after a batch is applied, with
+	                          the archive first and the ``(added, changed, removed)``
+	                          counts second.
+	"""
+
+	def __init__(self, archives, coalesce_delay = None, max_delay = None,
+	             sweep_interval = None, progress_callback = lambda x, y: None):
+		self.archives          = list(archives)
+		self.coalesce_delay    = coalesce_delay or melodia_settings.WATCHER_COALESCE_DELAY
+		self.max_delay         = max_delay or melodia_settings.WATCHER_MAX_DELAY
+		self.sweep_interval    = sweep_interval or melodia_settings.WATCHER_SWEEP_INTERVAL
+		self.progress_callback = progress_callback
+
+		#watch descriptor -> (archive, folder)
+		self._watches   = {}
+		#folder -> archive, for folders swept instead of watched
+		self._unwatched = {}
+		#url -> (archive, (size, mtime, inode)) as of the last sweep
+		self._swept     = {}
+
+		#archive id -> set of urls waiting to be applied
+		self._dirty       = {}
+		self._first_event = None
+		self._last_event  = None
+		self._last_sweep  = time.time()
+
+		try:
+			self._inotify = Inotify()
+		except OSError:
+			self._inotify = None
+
+		#Song URLs are absolute (see Archive._walk_filesystem), and every path
+		#the watcher builds starts from the root folder
+		for archive in self.archives:
+			self._watch_tree(archive, os.path.abspath(archive.root_folder))
+
+		self._swept = self._sweep_folders()
+
+	def _archive(self, archive_id):
+		for archive in self.archives:
+			if archive.id == archive_id:
+				return archive
+
+	def _mark_dirty(self, archive, url = None):
+		"Queue a file to be applied - with no `url`, queue a full scan of the archive"
+		if url is None:
+			self._dirty[archive.id] = None
+		else:
+			urls = self._dirty.setdefault(archive.id, set())
+			if urls is not None:
+				urls.add(url)
+
+		now = time.time()
+		if self._first_event is None:
+			self._first_event = now
+		self._last_event = now
+
+	def _watch_tree(self, archive, folder):
+		"""
+		Watch a folder and everything under it. Returns the supported files
+		found, since they may have been created before the watch existed.
+		"""
+		found = []
+
+		for dirname, dirnames, filenames in os.walk(folder):
+			try:
+				if self._inotify is None:
+					raise OSError(errno.ENOSYS, "inotify is not available")
+
+				watch_descriptor = self._inotify.add_watch(dirname, _watch_mask)
+				self._watches[watch_descriptor] = (archive, dirname)
+
+			except OSError as exc:
+				if exc.errno not in (errno.ENOSPC, errno.ENOSYS):
+					raise
+
+				#Out of watches - sweep this whole subtree instead
+				self._unwatched[dirname] = archive
+				del dirnames[:]
+
+			found.extend(os.path.join(dirname, filename)
+			             for filename in filenames if is_supported_file(filename))
+
+		return found
+
+	def _unwatch_tree(self, folder):
+		"Stop watching a folder that was moved or deleted, and everything under it"
+		prefix = folder + os.sep
+
+		for watch_descriptor, (archive, dirname) in self._watches.items():
+			if dirname == folder or dirname.startswith(prefix):
+				self._inotify.rm_watch(watch_descriptor)
+				del self._watches[watch_descriptor]
+
+	def _handle_event(self, watch_descriptor, mask, name):
+		if mask & IN_Q_OVERFLOW:
+			#Events were dropped - only a full scan can tell what happened
+			for archive in self.archives:
+				self._mark_dirty(archive)
+			return
+
+		if watch_descriptor not in self._watches:
+			return
+
+		archive, dirname = self._watches[watch_descriptor]
+
+		if mask & IN_IGNORED:
+			del self._watches[watch_descriptor]
+			return
+
+		if not name:
+			return
+
+		url = os.path.join(dirname, name)
+
+		if mask & IN_ISDIR:
+			if mask & (IN_CREATE | IN_MOVED_TO):
+				for found_url in self._watch_tree(archive, url):
+					self._mark_dirty(archive, found_url)
+
+			elif mask & (IN_DELETE | IN_MOVED_FROM):
+				self._unwatch_tree(url)
+				for song_url in archive.song_set.filter(url__startswith = url + os.sep)\
+				                                .values_list('url', flat = True):
+					self._mark_dirty(archive, song_url)
+
+		elif mask & (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+			if is_supported_file(name):
+				self._mark_dirty(archive, url)
+
+	def _sweep_folders(self):
+		"Stat every supported file in the folders inotify could not watch"
+		swept = {}
+		for folder, archive in self._unwatched.items():
+			for dirname, dirnames, filenames in os.walk(folder):
+				for filename in filenames:
+					if not is_supported_file(filename):
+						continue
+
+					url       = os.path.join(dirname, filename)
+					file_stat = stat_file(url)
+					if file_stat is not None:
+						swept[url] = (archive, file_stat)
+
+		return swept
+
+	def sweep(self):
+		"Compare the folders inotify could not watch against the previous sweep"
+		swept = self._sweep_folders()
+
+		for url, (archive, file_stat) in swept.iteritems():
+			previous = self._swept.get(url)
+			if previous is None or previous[1] != file_stat:
+				self._mark_dirty(archive, url)
+
+		for url, (archive, file_stat) in self._swept.iteritems():
+			if url not in swept:
+				self._mark_dirty(archive, url)
+
+		self._swept      = swept
+		self._last_sweep = time.time()
+
+	def flush(self):
+		"Apply every pending change to the database"
+		dirty = self._dirty
+		self._dirty       = {}
+		self._first_event = None
+		self._last_event  = None
+
+		for archive_id, urls in dirty.iteritems():
+			archive = self._archive(archive_id)
+
+			if urls is None:
+				counts = archive.quick_scan()
+			else:
+				counts = archive.update_paths(urls)
+
+			archive._update_song_metadata(only_stale = True)
+			self.progress_callback(archive, counts)
+
+	def poll(self, timeout = None):
+		"""
+		Handle events for up to `timeout` seconds, and apply any changes that
+		are due.
+		"""
+		if timeout is None:
+			timeout = self.coalesce_delay
+
+		if self._inotify is not None:
+			for watch_descriptor, mask, cookie, name in self._inotify.read_events(timeout):
+				self._handle_event(watch_descriptor, mask, name)
+		else:
+			time.sleep(timeout)
+
+		now = time.time()
+		if self._unwatched and now - self._last_sweep >= self.sweep_interval:
+			self.sweep()
+
+		if self._dirty and (now - self._last_event >= self.coalesce_delay or
+		                    now - self._first_event >= self.max_delay):
+			self.flush()
+
+	def run(self):
+		"Watch forever"
+		try:
+			while True:
+				self.poll()
+		finally:
+			self.close()
+
+	def close(self):
+		if self._inotify is not None:
+			self._inotify.close()
+			self._inotify = None
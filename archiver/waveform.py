@@ -0,0 +1,233 @@
+"""
+Waveform peaks for drawing songs in the web player. Each song is decoded once
+(:func:`AudioFile.to_pcm`) and reduced to a pyramid of peaks - the lowest and
+highest sample (scaled to -128..127) over every
+:data:`melodia_settings.WAVEFORM_FRAMES_PER_PEAK` frames, then over twice as
+many frames, and so on until a level has at most
+:data:`melodia_settings.WAVEFORM_MIN_PEAKS` peaks. A client asks for about as
+many peaks as it has pixels, and gets the level closest to that with a single
+read of just that level.
+
+Peaks are stored in a binary file per song under ``CACHE_DIR/waveforms``,
+addressed by the song's content like transcodes are (so a changed file gets
+new peaks, and a moved one keeps them). The file starts with a header::
+
+   "MPKS" | level count (uint16) | frames per peak of level 0 (uint32)
+          | sample rate (uint32) | total frames (uint32)
+
+followed by the number of peaks in each level (uint32 each, little-endian),
+and then each level's peaks as interleaved ``min, max`` signed bytes.
+
+:func:`Archive.update_waveforms` computes the peaks of a whole archive over
+a pool of :data:`melodia_settings.WAVEFORM_WORKERS` processes.
+"""
+
+import hashlib, os, struct, sys
+from array import array
+from multiprocessing import Pool
+
+from django.conf import settings
+
+from Melodia import melodia_settings
+
+_magic         = "MPKS"
+_header        = struct.Struct("<4sHIII")
+_level_count   = struct.Struct("<I")
+
+#Decoded audio is reduced this many peaks at a time
+_peaks_per_chunk = 256
+
+def song_key(song):
+	"Key of a song's peaks - changes whenever the file's content does"
+	#Same idea as TranscodeCache.key
+	source = song.file_hash or "%s:%s:%s" % (song.url, song.file_size, song.file_mtime)
+	return hashlib.sha1("%s|peaks" % source).hexdigest()
+
+def waveform_path(key):
+	"Location of the peaks file for a key"
+	return os.path.join(settings.CACHE_DIR, "waveforms", key[:2], key + ".peaks")
+
+def _reduce_samples(samples, samples_per_peak):
+	"""
+	Reduce interleaved 16-bit samples to interleaved ``min, max`` bytes, one
+	pair per `samples_per_peak` samples. The work is done by :func:`min` and
+	:func:`max` over array slices, not a Python loop over samples.
+	"""
+	peaks = array('b')
+	for start in xrange(0, len(samples), samples_per_peak):
+		block = samples[start:start + samples_per_peak]
+		peaks.append(min(block) >> 8)
+		peaks.append(max(block) >> 8)
+
+	return peaks
+
+def _halve_level(peaks):
+	"Build the next level of the pyramid, merging neighbouring peaks in pairs"
+	if len(peaks) % 4:
+		#Odd number of peaks - the last one is merged with itself
+		peaks = peaks + peaks[-2:]
+
+	merged = array('b', [0]) * (len(peaks) // 2)
+	merged[0::2] = array('b', map(min, peaks[0::4], peaks[2::4]))
+	merged[1::2] = array('b', map(max, peaks[1::4], peaks[3::4]))
+
+	return merged
+
+def compute_peaks(url, frames_per_peak = None, min_peaks = None):
+	"""
+	Decode an audio file and build its peak pyramid.
+
+	:param url: File to read
+	:param frames_per_peak: Frames per peak in the finest level - defaults to :data:`melodia_settings.WAVEFORM_FRAMES_PER_PEAK`
+	:param min_peaks: No more levels are built once a level has this many peaks or fewer - defaults to :data:`melodia_settings.WAVEFORM_MIN_PEAKS`
+	:rtype: Tuple of ``(sample_rate, total_frames, levels)``, `levels` being a
+	        list of :class:`array` of interleaved ``min, max`` peaks, finest first
+	"""
+	import audiotools
+
+	frames_per_peak = frames_per_peak or melodia_settings.WAVEFORM_FRAMES_PER_PEAK
+	min_peaks       = min_peaks or melodia_settings.WAVEFORM_MIN_PEAKS
+
+	pcm_reader = audiotools.open(url).to_pcm()
+	if pcm_reader.bits_per_sample != 16:
+		pcm_reader = audiotools.PCMConverter(pcm_reader, pcm_reader.sample_rate, pcm_reader.channels,
+		                                     pcm_reader.channel_mask, 16)
+
+	#Peaks cover every channel, so a block is frames_per_peak interleaved frames
+	samples_per_peak = frames_per_peak * pcm_reader.channels
+	chunk_bytes      = samples_per_peak * _peaks_per_chunk * 2
+	big_endian       = sys.byteorder == "big"
+
+	finest       = array('b')
+	pending      = array('h')
+	total_frames = 0
+	try:
+		while True:
+			frames = pcm_reader.read(chunk_bytes)
+			if frames.frames == 0:
+				break
+
+			total_frames += frames.frames
+			pending.fromstring(frames.to_bytes(big_endian, True))
+
+			#Only whole blocks, so a peak never straddles two reads
+			whole = len(pending) - len(pending) % samples_per_peak
+			finest.extend(_reduce_samples(pending[:whole], samples_per_peak))
+			del pending[:whole]
+
+	finally:
+		pcm_reader.close()
+
+	if pending:
+		finest.extend(_reduce_samples(pending, samples_per_peak))
+
+	levels = [finest]
+	while len(levels[-1]) // 2 > min_peaks:
+		levels.append(_halve_level(levels[-1]))
+
+	return (pcm_reader.sample_rate, total_frames, levels)
+
+def write_peaks(path, sample_rate, total_frames, levels, frames_per_peak = None):
+	"Save a peak pyramid to `path`, so that readers never see half of it"
+	frames_per_peak = frames_per_peak or melodia_settings.WAVEFORM_FRAMES_PER_PEAK
+
+	folder = os.path.dirname(path)
+	if not os.path.isdir(folder):
+		try:
+			os.makedirs(folder)
+		except OSError:
+			#Another worker may have created it first
+			if not os.path.isdir(folder):
+				raise
+
+	partial_path = "%s.%d.part" % (path, os.getpid())
+	with open(partial_path, 'wb') as peaks_file:
+		peaks_file.write(_header.pack(_magic, len(levels), frames_per_peak, sample_rate, total_frames))
+		for level in levels:
+			peaks_file.write(_level_count.pack(len(level) // 2))
+		for level in levels:
+			peaks_file.write(level.tostring())
+
+	os.rename(partial_path, path)
+
+def read_peaks(path, peak_count):
+	"""
+	Read the level of a peak pyramid closest to `peak_count` peaks - the
+	coarsest level with at least that many, or the finest level if none has.
+	Only the header and the chosen level are read.
+
+	:rtype: Dictionary with ``sample_rate``, ``total_frames``,
+	        ``frames_per_peak`` and ``peaks`` (:class:`array` of interleaved
+	        ``min, max`` values)
+	:raises IOError: If there is no valid peaks file at `path`
+	"""
+	with open(path, 'rb') as peaks_file:
+		header = peaks_file.read(_header.size)
+		if len(header) != _header.size:
+			raise IOError("Truncated peaks file: %s" % path)
+
+		magic, level_total, frames_per_peak, sample_rate, total_frames = _header.unpack(header)
+		if magic != _magic or level_total == 0:
+			raise IOError("Not a peaks file: %s" % path)
+
+		counts = []
+		for index in xrange(level_total):
+			count = peaks_file.read(_level_count.size)
+			if len(count) != _level_count.size:
+				raise IOError("Truncated peaks file: %s" % path)
+			counts.append(_level_count.unpack(count)[0])
+
+		level = 0
+		for index, count in enumerate(counts):
+			if count >= peak_count:
+				level = index
+
+		peaks_file.seek(2 * sum(counts[:level]), os.SEEK_CUR)
+		level_peaks = peaks_file.read(2 * counts[level])
+		if len(level_peaks) != 2 * counts[level]:
+			raise IOError("Truncated peaks file: %s" % path)
+
+		peaks = array('b')
+		peaks.fromstring(level_peaks)
+
+	return {"sample_rate": sample_rate,
+	        "total_frames": total_frames,
+	        "frames_per_peak": frames_per_peak << level,
+	        "peaks": peaks}
+
+def _waveform_job(job):
+	"Worker function for :func:`iter_waveforms` - compute and save one song's peaks"
+	song_id, url, path = job
+
+	try:
+		sample_rate, total_frames, levels = compute_peaks(url)
+		write_peaks(path, sample_rate, total_frames, levels)
+
+	except Exception:
+		#Missing files, formats we can't decode and decoder errors all mean
+		#the song has no waveform for now
+		return (song_id, False)
+
+	return (song_id, True)
+
+def iter_waveforms(jobs, workers = None):
+	"""
+	Compute the peaks of many songs at once.
+
+	:param jobs: List of ``(song_id, full_url, peaks_path)`` tuples
+	:param workers: Number of worker processes - defaults to :data:`melodia_settings.WAVEFORM_WORKERS`
+	:rtype: Iterator of ``(song_id, succeeded)`` tuples, in no particular order
+	"""
+	pool = Pool(workers or melodia_settings.WAVEFORM_WORKERS)
+	try:
+		for result in pool.imap_unordered(_waveform_job, jobs):
+			yield result
+
+		pool.close()
+
+	except:
+		pool.terminate()
+		raise
+
+	finally:
+		pool.join()
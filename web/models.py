@@ -1,3 +1,11 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+
+from archiver.models import Playlist
+from web.views.web_utils import invalidate_template_resources
 
 # Create your models here.
+
+#Keep the cached template resources in step with the models they come from
+post_save.connect(invalidate_template_resources, sender = Playlist)
+post_delete.connect(invalidate_template_resources, sender = Playlist)
@@ -14,3 +14,294 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+class LibraryAPITest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from archiver.models import Archive, Song
+
+        User.objects.create_user("melodia", "melodia@example.com", "melodia")
+        self.client.login(username = "melodia", password = "melodia")
+
+        new_archive = Archive(root_folder = "/music")
+        new_archive.save()
+
+        for index in range(7):
+            Song(url = "/music/%d.mp3" % index, title = "Song %d" % index,
+                 artist = "Artist %d" % (index % 3), album_artist = "Artist %d" % (index % 3),
+                 album = "Album %d" % (index % 2), track_number = index,
+                 parent_archive = new_archive).save()
+
+    def _get_all(self, url, **params):
+        "Follow the cursors through every page of a list"
+        from django.utils import simplejson
+
+        items = []
+        while True:
+            response = simplejson.loads(self.client.get(url, params).content)
+            self.assertTrue(response["success"])
+
+            items.extend(response["items"])
+            if response["next"] is None:
+                return items
+            params["after"] = response["next"]
+
+    def test_song_pages(self):
+        """
+        Tests that songs are paged through in order, with only the requested fields.
+        """
+        songs = self._get_all("/api/songs/", sort = "artist", limit = 2, fields = "artist,title")
+        self.assertEqual(len(songs), 7)
+        self.assertEqual(sorted(songs[0].keys()), ["artist", "title"])
+        self.assertEqual([(song["artist"], song["title"]) for song in songs],
+                         sorted((song["artist"], song["title"]) for song in songs))
+
+        songs = self._get_all("/api/songs/", sort = "album", limit = 3, album_artist = "Artist 0")
+        self.assertEqual([song["title"] for song in songs], ["Song 0", "Song 6", "Song 3"])
+
+    def test_album_and_artist_pages(self):
+        """
+        Tests that albums and artists are listed once each.
+        """
+        albums = self._get_all("/api/albums/", limit = 2)
+        self.assertEqual(len(albums), 6)
+        self.assertEqual(albums[0], {"album_artist": "Artist 0", "album": "Album 0"})
+
+        artists = self._get_all("/api/artists/", limit = 1)
+        self.assertEqual([artist["artist"] for artist in artists], ["Artist 0", "Artist 1", "Artist 2"])
+
+    def test_invalid_requests(self):
+        """
+        Tests that bad fields and cursors are reported rather than crashing.
+        """
+        import base64
+        from django.utils import simplejson
+        from web.views.web_utils import encode_cursor
+
+        for params in ({"fields": "file_hash"}, {"after": "garbage"}, {"sort": "url"}, {"limit": "0"},
+                       {"after": encode_cursor([[1, 2]])}, {"after": encode_cursor([{"id": 1}])},
+                       {"after": base64.urlsafe_b64encode(simplejson.dumps({"id": 1}))}):
+            response = self.client.get("/api/songs/", params)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(simplejson.loads(response.content)["success"])
+
+class StreamTest(TestCase):
+    def setUp(self):
+        import os, tempfile
+        from django.contrib.auth.models import User
+        from archiver.models import Archive, Song
+
+        User.objects.create_user("melodia", "melodia@example.com", "melodia")
+        self.client.login(username = "melodia", password = "melodia")
+
+        self.root_folder = tempfile.mkdtemp()
+        self.audio = os.urandom(1000)
+        with open(os.path.join(self.root_folder, "song.mp3"), "wb") as song_file:
+            song_file.write(self.audio)
+
+        new_archive = Archive(root_folder = self.root_folder)
+        new_archive.save()
+
+        self.song = Song(url = "song.mp3", parent_archive = new_archive)
+        self.song.save()
+        self.url = "/stream/%d/" % self.song.id
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root_folder)
+
+    def _content(self, response):
+        "Read a response the way a server would, streamed or not"
+        if getattr(response, "streaming", False):
+            return "".join(response.streaming_content)
+        return response.content
+
+    def test_ranges(self):
+        """
+        Tests that whole files and byte ranges are served.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "audio/mpeg")
+        self.assertEqual(self._content(response), self.audio)
+
+        response = self.client.get(self.url, HTTP_RANGE = "bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 100-199/1000")
+        self.assertEqual(self._content(response), self.audio[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE = "bytes=-10")
+        self.assertEqual(self._content(response), self.audio[-10:])
+
+        response = self.client.get(self.url, HTTP_RANGE = "bytes=5000-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */1000")
+
+    def test_conditional_requests(self):
+        """
+        Tests that a song the client already has isn't sent again.
+        """
+        etag = self.client.get(self.url)["ETag"]
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH = etag).status_code, 304)
+
+        response = self.client.get(self.url, HTTP_RANGE = "bytes=0-9", HTTP_IF_RANGE = '"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_transfer_statistics(self):
+        """
+        Tests that bytes sent are counted, and that hearing most of a song is a play.
+        """
+        from archiver.models import Song
+
+        response = self.client.get(self.url, HTTP_RANGE = "bytes=0-99")
+        self._content(response)
+        response.close()
+
+        response = self.client.get(self.url)
+        self._content(response)
+        response.close()
+
+        song = Song.objects.get(id = self.song.id)
+        self.assertEqual(song.bytes_streamed, 1100)
+        self.assertEqual(song.play_count, 1)
+
+    def test_played_smart_playlist(self):
+        """
+        Tests that a smart playlist on play counts picks up a song once it is streamed.
+        """
+        from archiver.models import SmartPlaylist
+
+        played = SmartPlaylist(name = "Played", query = "play_count >= 1")
+        played.save()
+        self.assertEqual(played.songs.count(), 0)
+
+        response = self.client.get(self.url)
+        self._content(response)
+        response.close()
+
+        self.assertEqual(list(played.songs.values_list('id', flat = True)), [self.song.id])
+
+    def test_transcode_requests(self):
+        """
+        Tests that transcodes to formats that aren't allowed are refused.
+        """
+        self.assertEqual(self.client.get(self.url + "exe/").status_code, 400)
+        self.assertEqual(self.client.get(self.url + "mp3/", {"quality": "loud"}).status_code, 400)
+
+class TemplateResourcesTest(TestCase):
+    def test_template_resources_cache(self):
+        """
+        Tests that template resources are served from the cache until a playlist changes.
+        """
+        from archiver.models import Playlist
+        from web.views import web_utils
+
+        Playlist(name = "First").save()
+        web_utils.template_resources()
+
+        stats = web_utils.template_resources_stats()
+        with self.assertNumQueries(0):
+            resources = web_utils.template_resources()
+        self.assertEqual([playlist.name for playlist in resources["playlist_list"]], ["First"])
+        self.assertEqual(web_utils.template_resources_stats()["hits"], stats["hits"] + 1)
+
+        second_playlist = Playlist(name = "Second")
+        second_playlist.save()
+        resources = web_utils.template_resources()
+        self.assertEqual([playlist.name for playlist in resources["playlist_list"]], ["First", "Second"])
+        self.assertEqual(web_utils.template_resources_stats()["misses"], stats["misses"] + 1)
+
+        second_playlist.delete()
+        self.assertEqual(len(web_utils.template_resources()["playlist_list"]), 1)
+
+class WaveformTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.conf import settings
+        from django.contrib.auth.models import User
+        from archiver.models import Archive, Song
+
+        User.objects.create_user("melodia", "melodia@example.com", "melodia")
+        self.client.login(username = "melodia", password = "melodia")
+
+        self.cache_dir = settings.CACHE_DIR
+        settings.CACHE_DIR = tempfile.mkdtemp()
+
+        new_archive = Archive(root_folder = "/music")
+        new_archive.save()
+
+        song = Song(url = "/music/song.mp3", parent_archive = new_archive)
+        song.save()
+        self.song = Song.objects.get(id = song.id)
+        self.url = "/waveform/%d/" % self.song.id
+
+    def tearDown(self):
+        import shutil
+        from django.conf import settings
+
+        shutil.rmtree(settings.CACHE_DIR)
+        settings.CACHE_DIR = self.cache_dir
+
+    def _write_peaks(self):
+        "Store a two level pyramid for the song, the way update_waveforms does"
+        from array import array
+        from archiver import waveform
+
+        levels = [array('b', [-1, 1, -2, 2, -3, 3, -4, 4]), array('b', [-2, 2, -4, 4])]
+        path = waveform.waveform_path(waveform.song_key(self.song))
+        waveform.write_peaks(path, 44100, 4000, levels, frames_per_peak = 1000)
+        return path
+
+    def test_missing_peaks(self):
+        """
+        Tests that songs without peaks, or with a damaged peaks file, are a 404.
+        """
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get("/waveform/%d/" % (self.song.id + 1)).status_code, 404)
+
+        path = self._write_peaks()
+        with open(path, 'rb') as peaks_file:
+            peaks_data = peaks_file.read()
+        with open(path, 'wb') as peaks_file:
+            peaks_file.write(peaks_data[:20])
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        for params in ({"peaks": "0"}, {"peaks": "many"}, {"format": "png"}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+    def test_formats(self):
+        """
+        Tests that the closest level is sent as JSON or as raw bytes with headers.
+        """
+        from django.utils import simplejson
+
+        self._write_peaks()
+
+        response = simplejson.loads(self.client.get(self.url, {"peaks": 2}).content)
+        self.assertEqual(response["peaks"], [-2, 2, -4, 4])
+        self.assertEqual((response["sample_rate"], response["total_frames"], response["frames_per_peak"]),
+                         (44100, 4000, 2000))
+
+        response = self.client.get(self.url, {"peaks": 4, "format": "binary"})
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        self.assertEqual(response.content, "\xff\x01\xfe\x02\xfd\x03\xfc\x04")
+        self.assertEqual(response["X-Waveform-Sample-Rate"], "44100")
+        self.assertEqual(response["X-Waveform-Total-Frames"], "4000")
+        self.assertEqual(response["X-Waveform-Frames-Per-Peak"], "1000")
+
+    def test_conditional_requests(self):
+        """
+        Tests that peaks the client already has aren't sent again.
+        """
+        self._write_peaks()
+
+        etag = self.client.get(self.url, {"peaks": 2})["ETag"]
+        response = self.client.get(self.url, {"peaks": 2}, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        #Another number of peaks or format is another response
+        self.assertNotEqual(self.client.get(self.url, {"peaks": 4})["ETag"], etag)
+        self.assertEqual(self.client.get(self.url, {"peaks": 2, "format": "binary"},
+                                         HTTP_IF_NONE_MATCH = etag).status_code, 200)
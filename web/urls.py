@@ -8,4 +8,19 @@ web_urls = patterns('web.views',
 	url(r'^$|main/', 'index.main'),
 	url(r'^login/', 'authentication.login'),
 	url(r'^logout/', 'authentication.logout'),
+
+	#JSON library API
+	url(r'^api/songs/$', 'library.songs'),
+	url(r'^api/albums/$', 'library.albums'),
+	url(r'^api/artists/$', 'library.artists'),
+	url(r'^api/playlists/$', 'library.playlists'),
+	url(r'^api/cache_stats/$', 'library.cache_stats'),
+
+	#Audio
+	url(r'^stream/(?P<song_id>\d+)/$', 'stream.song'),
+	url(r'^stream/(?P<song_id>\d+)/(?P<output_format>\w+)/$', 'stream.transcoded'),
+	url(r'^waveform/(?P<song_id>\d+)/$', 'waveform.peaks'),
+
+	#Cover art
+	url(r'^covers/(?P<cover_hash>[0-9a-f]{40})/(?P<size>\d+)/$', 'covers.cover'),
 )
@@ -0,0 +1,42 @@
+"""
+Serving cover art thumbnails (see :mod:`archiver.thumbnails`). A cover's URL
+contains the hash of its content, so whatever is at a URL never changes -
+thumbnails are sent with a far-future ``Cache-Control`` and browsers don't
+ask for them again. Thumbnails are normally made ahead of time by
+:func:`Archive.update_covers`, and otherwise on the first request.
+"""
+
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+
+from Melodia import melodia_settings
+from archiver import thumbnails
+
+#One year, the longest HTTP/1.1 caches are asked to keep anything
+_max_age = 365 * 24 * 60 * 60
+
+@login_required
+def cover(request, cover_hash, size):
+	"Send a thumbnail of a cover, `size` pixels square"
+	size = int(size)
+	if size not in melodia_settings.THUMBNAIL_SIZES:
+		raise Http404
+
+	etag = '"%s-%d"' % (cover_hash, size)
+	if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+		response = HttpResponseNotModified()
+		response["ETag"] = etag
+		return response
+
+	try:
+		with open(thumbnails.make_thumbnail(cover_hash, size), 'rb') as thumbnail_file:
+			data = thumbnail_file.read()
+	except IOError:
+		raise Http404
+
+	response = HttpResponse(data, content_type = thumbnails.thumbnail_mime_type())
+	response["Content-Length"] = str(len(data))
+	response["ETag"]           = etag
+	response["Cache-Control"]  = "private, max-age=%d" % _max_age
+
+	return response
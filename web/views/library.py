@@ -0,0 +1,137 @@
+"""
+JSON API for browsing the library. Every list is paged with keyset
+pagination (see :func:`web_utils.keyset_page`) over indexed sort keys, so
+requesting a deep page costs the same as the first one. Query parameters:
+
+``fields``
+   Comma-separated list of the fields to return - only these columns are
+   selected. Defaults to a small set for each list.
+
+``limit``
+   Number of items per page, at most :data:`_max_limit`.
+
+``after``
+   The ``next`` cursor returned with the previous page.
+
+Responses look like ``{"success": true, "items": [...], "next": "<cursor>"}``,
+with ``next`` set to ``null`` on the last page. Invalid parameters are answered
+with a 400 and ``{"success": false, "error": "<reason>"}``.
+"""
+
+from django.contrib.auth.decorators import login_required
+
+from archiver.models import Song, Playlist
+
+#Melodia-specific utilities
+from web_utils import json_response as json, keyset_page, template_resources_stats
+
+_default_limit = 50
+_max_limit     = 500
+
+#Song fields that may be requested
+_song_fields = ('id', 'title', 'artist', 'album_artist', 'album', 'year', 'genre',
+                'bpm', 'disc_number', 'disc_total', 'track_number', 'track_total',
+                'comment', 'bit_rate', 'duration', 'add_date', 'play_count',
+                'skip_count', 'rating', 'cover_hash')
+
+#Orderings for songs - each one is covered by an index, with the id last to
+#make it unique
+_song_sorts = {
+		'id':     ('id',),
+		'artist': ('artist', 'title', 'id'),
+		'album':  ('album_artist', 'album', 'disc_number', 'track_number', 'id'),
+		}
+
+#Songs can be narrowed down to an artist or album
+_song_filters = ('artist', 'album_artist', 'album')
+
+_playlist_fields = ('id', 'name', 'song_list', 'use_entries')
+
+_song_list_field = Playlist._meta.get_field('song_list')
+
+def _invalid(error):
+	"Answer a request with invalid parameters"
+	response = json(success = False, error = error)
+	response.status_code = 400
+	return response
+
+def _page(request, queryset, sort_keys, allowed_fields, default_fields):
+	"Answer a request for one page of `queryset`"
+	fields = request.GET.get('fields')
+	fields = fields.split(',') if fields else list(default_fields)
+	unknown_fields = [field for field in fields if field not in allowed_fields]
+	if unknown_fields:
+		return _invalid("Unknown fields: " + ", ".join(unknown_fields))
+
+	try:
+		limit = min(int(request.GET.get('limit', _default_limit)), _max_limit)
+		if limit < 1:
+			raise ValueError
+
+	except ValueError:
+		return _invalid("Invalid limit")
+
+	try:
+		items, next_cursor = keyset_page(queryset, sort_keys, fields,
+		                                 request.GET.get('after'), limit)
+	except ValueError:
+		return _invalid("Invalid cursor")
+
+	for item in items:
+		#Values the JSON encoder doesn't know about
+		if 'add_date' in item:
+			item['add_date'] = item['add_date'].isoformat()
+		if 'song_list' in item:
+			#values() hands back what is stored in the database
+			item['song_list'] = list(_song_list_field.to_python(item['song_list']))
+
+	return json(items = items, next = next_cursor)
+
+@login_required
+def songs(request):
+	"""
+	List songs. Also accepts ``sort`` (``id``, ``artist`` or ``album``) and
+	exact filters on ``artist``, ``album_artist`` and ``album``.
+	"""
+	sort = request.GET.get('sort', 'id')
+	if sort not in _song_sorts:
+		return _invalid("Unknown sort: " + sort)
+
+	queryset = Song.objects.all()
+	for field in _song_filters:
+		if field in request.GET:
+			queryset = queryset.filter(**{field: request.GET[field]})
+
+	return _page(request, queryset, _song_sorts[sort], _song_fields,
+	             ('id', 'title', 'artist', 'album', 'duration'))
+
+@login_required
+def albums(request):
+	"List albums, by album artist and then album name"
+	queryset = Song.objects.values('album_artist', 'album').distinct()
+	if 'album_artist' in request.GET:
+		queryset = queryset.filter(album_artist = request.GET['album_artist'])
+
+	return _page(request, queryset, ('album_artist', 'album'),
+	             ('album_artist', 'album'), ('album_artist', 'album'))
+
+@login_required
+def artists(request):
+	"List artists, by name"
+	queryset = Song.objects.values('artist').distinct()
+
+	return _page(request, queryset, ('artist',), ('artist',), ('artist',))
+
+@login_required
+def playlists(request):
+	"""
+	List playlists. The (potentially long) ``song_list`` is only sent if asked
+	for. It is empty for playlists that store their songs as entries
+	(``use_entries``).
+	"""
+	return _page(request, Playlist.objects.all(), ('id',), _playlist_fields, ('id', 'name'))
+
+@login_required
+def cache_stats(request):
+	"Hit and miss counts of this process's template resources cache"
+	return json(template_resources = template_resources_stats())
@@ -0,0 +1,274 @@
+"""
+Streaming songs to the web client. Songs are served with ``Range`` support so
+players can seek, and with ``ETag``/``Last-Modified`` validators so a cached
+song isn't sent again. Files are sent in chunks of
+:data:`melodia_settings.STREAM_CHUNK_SIZE` bytes straight from disk, without
+reading the whole song into memory or touching the database while the
+transfer is running - a worker only holds one open file and one chunk per
+listener.
+
+For zero-copy transfers, set :data:`melodia_settings.STREAM_SENDFILE_HEADER`
+(for example to ``X-Sendfile``) and the file is handed to the front-end web
+server, which can use ``sendfile()`` and handles ranges itself.
+
+Songs can also be transcoded on the fly for clients that can't play the
+original format (see :mod:`archiver.transcode`).
+
+The bytes sent for each song are added to :data:`Song.bytes_streamed` when
+the response finishes, and a response from the start of a song that covers
+more than :data:`melodia_settings.STREAM_PLAY_FRACTION` of it counts as a
+play - so the client doesn't have to report plays separately.
+"""
+
+import os, re
+from wsgiref.util import FileWrapper
+
+from django.contrib.auth.decorators import login_required
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, Http404
+try:
+	from django.http import StreamingHttpResponse
+except ImportError:
+	#Django 1.4 streams any iterator handed to a plain HttpResponse
+	StreamingHttpResponse = HttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from Melodia import melodia_settings
+from archiver import transcode
+from archiver.models import Song, SmartPlaylist
+
+_range_regex = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+_mime_types = {
+		'.mp3': 'audio/mpeg',
+		'.ogg': 'audio/ogg',
+		}
+
+def _parse_range(header, size):
+	"""
+	Parse a ``Range`` header for a file of `size` bytes.
+
+	:rtype: ``(start, end)`` with `end` exclusive, ``None`` if the whole file
+	        should be sent (no header, or several ranges), or ``False`` if the
+	        range can't be satisfied.
+	"""
+	match = _range_regex.match(header.replace(" ", "")) if header else None
+	if match is None:
+		return None
+
+	start, end = match.groups()
+	if not start and not end:
+		return None
+
+	if not start:
+		#Suffix range - the last `end` bytes
+		length = int(end)
+		if length == 0:
+			return False
+		return (max(size - length, 0), size)
+
+	start = int(start)
+	end   = min(int(end) + 1, size) if end else size
+	if start >= size or end <= start:
+		return False
+
+	return (start, end)
+
+def _record_transfer(song_id, size, start, sent):
+	"""
+	Add a finished transfer to a song's statistics. The counters are updated
+	in the database without a :func:`Song.save`, so smart playlists are
+	refreshed here when the play count changes.
+	"""
+	Song.objects.filter(id = song_id).update(bytes_streamed = F("bytes_streamed") + sent)
+
+	if start == 0 and size and float(sent) / size > melodia_settings.STREAM_PLAY_FRACTION:
+		#Songs that were never played start at -1
+		if not Song.objects.filter(id = song_id, play_count__gte = 0).update(play_count = F("play_count") + 1):
+			Song.objects.filter(id = song_id).update(play_count = 1)
+
+		SmartPlaylist.refresh_songs([song_id])
+
+class _FileRange(object):
+	"""
+	Iterate over part of a file in chunks, and record how much was actually
+	sent once the server is done with the response. Nothing is recorded if
+	the response was closed before it was iterated over.
+	"""
+
+	def __init__(self, song_id, file_object, size, start, end):
+		self.song_id  = song_id
+		self.size     = size
+		self.start    = start
+		self.sent     = 0
+		self.iterated = False
+
+		file_object.seek(start)
+		self.remaining = end - start
+		self.chunks    = FileWrapper(file_object, melodia_settings.STREAM_CHUNK_SIZE)
+
+	def __iter__(self):
+		if self.chunks is None:
+			return
+
+		self.iterated = True
+		for chunk in self.chunks:
+			if self.remaining <= 0:
+				break
+
+			chunk = chunk[:self.remaining]
+			self.remaining -= len(chunk)
+			self.sent      += len(chunk)
+			yield chunk
+
+	def close(self):
+		#Called by the server when the response is finished, or the client has gone away
+		if self.chunks is None:
+			return
+
+		self.chunks.close()
+		self.chunks = None
+		if self.iterated:
+			_record_transfer(self.song_id, self.size, self.start, self.sent)
+
+def _not_modified(request, etag, mtime):
+	"Check the request's conditional headers against the file"
+	if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+	if if_none_match is not None:
+		return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+	if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE") or "")
+	return if_modified_since is not None and int(mtime) <= if_modified_since
+
+class _GrowingFile(object):
+	"Iterate over a transcode that is still running, and record how much was sent"
+
+	def __init__(self, song_id, job):
+		self.song_id  = song_id
+		self.chunks   = transcode.iter_growing_file(job)
+		self.sent     = 0
+		self.iterated = False
+
+	def __iter__(self):
+		if self.chunks is None:
+			return
+
+		self.iterated = True
+		for chunk in self.chunks:
+			self.sent += len(chunk)
+			yield chunk
+
+	def close(self):
+		if self.chunks is None:
+			return
+
+		self.chunks.close()
+		self.chunks = None
+
+		#The final size isn't known, so this never counts as a play
+		if self.iterated:
+			_record_transfer(self.song_id, 0, 0, self.sent)
+
+def _get_song(song_id):
+	try:
+		return Song.objects.select_related('parent_archive').get(id = song_id)
+	except Song.DoesNotExist:
+		raise Http404
+
+@login_required
+def song(request, song_id):
+	"Stream a song's file"
+	song_object = _get_song(song_id)
+	full_url    = song_object._get_full_url()
+
+	return _serve_file(request, song_object.id, full_url,
+	                   _mime_types.get(os.path.splitext(full_url)[1].lower(), 'application/octet-stream'))
+
+@login_required
+def transcoded(request, song_id, output_format):
+	"""
+	Stream a song transcoded to another format. The quality is picked with
+	either ``bitrate`` (in kbps) or ``quality`` (an :mod:`audiotools`
+	compression mode) in the query string. Finished transcodes are served
+	from the cache like any other file, otherwise the transcode is started
+	(or joined) and streamed as it is encoded.
+	"""
+	song_object = _get_song(song_id)
+
+	try:
+		format_class = transcode.get_format(output_format)
+		if 'bitrate' in request.GET:
+			compression = transcode.compression_for_bitrate(output_format, int(request.GET['bitrate']))
+		else:
+			compression = request.GET.get('quality') or None
+			if compression is not None and compression not in format_class.COMPRESSION_MODES:
+				raise ValueError
+
+	except (transcode.TranscodeError, ValueError):
+		return HttpResponseBadRequest()
+
+	content_type = _mime_types.get('.' + output_format, 'application/octet-stream')
+
+	cache  = transcode.get_cache()
+	key    = cache.key(song_object, output_format, compression)
+	cached = cache.get(key, output_format)
+	if cached is not None:
+		return _serve_file(request, song_object.id, cached, content_type)
+
+	job = transcode.start_transcode(song_object, output_format, compression, cache)
+	return StreamingHttpResponse(_GrowingFile(song_object.id, job), content_type = content_type)
+
+def _serve_file(request, song_id, full_url, content_type):
+	"Send a file for a song, honouring conditional and range requests"
+	try:
+		file_stat = os.stat(full_url)
+	except OSError:
+		raise Http404
+
+	size  = file_stat.st_size
+	mtime = file_stat.st_mtime
+	etag  = '"%x-%x-%x"' % (file_stat.st_ino, size, int(mtime * 1000))
+
+	if _not_modified(request, etag, mtime):
+		response = HttpResponseNotModified()
+		response["ETag"] = etag
+		return response
+
+	byte_range = _parse_range(request.META.get("HTTP_RANGE"), size)
+
+	#A range only applies to the version of the file the client already has part of
+	if_range = request.META.get("HTTP_IF_RANGE")
+	if if_range is not None and if_range != etag and parse_http_date_safe(if_range) != int(mtime):
+		byte_range = None
+
+	if byte_range is False:
+		response = HttpResponse(status = 416)
+		response["Content-Range"] = "bytes */%d" % size
+		return response
+
+	start, end = byte_range or (0, size)
+
+	if melodia_settings.STREAM_SENDFILE_HEADER:
+		#The front-end server sends the file (and its range) itself
+		response = HttpResponse(content_type = content_type)
+		response[melodia_settings.STREAM_SENDFILE_HEADER] = full_url
+		_record_transfer(song_id, size, start, end - start)
+
+	else:
+		try:
+			file_object = open(full_url, 'rb')
+		except IOError:
+			raise Http404
+
+		response = StreamingHttpResponse(_FileRange(song_id, file_object, size, start, end),
+		                                 content_type = content_type,
+		                                 status = 206 if byte_range else 200)
+		response["Content-Length"] = str(end - start)
+		if byte_range:
+			response["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+
+	response["Accept-Ranges"] = "bytes"
+	response["ETag"]          = etag
+	response["Last-Modified"] = http_date(mtime)
+
+	return response
@@ -0,0 +1,69 @@
+"""
+Waveform peaks for the web player's scrubber (see :mod:`archiver.waveform`).
+Peaks are computed ahead of time by :func:`Archive.update_waveforms`, so a
+request only reads the one level of the stored pyramid closest to the number
+of peaks asked for. Query parameters:
+
+``peaks``
+   About how many peaks the client wants - usually the width of the
+   waveform in pixels. Defaults to :data:`_default_peaks`.
+
+``format``
+   ``json`` (the default) for ``{"success": true, "peaks": [min, max, ...],
+   ...}``, or ``binary`` for the peaks as interleaved signed bytes, with the
+   other values in ``X-Waveform-*`` headers.
+"""
+
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotModified
+
+from archiver import waveform
+from archiver.models import Song
+
+#Melodia-specific utilities
+from web_utils import json_response as json
+
+_default_peaks = 1000
+
+@login_required
+def peaks(request, song_id):
+	"Send a song's waveform peaks, 404 if they haven't been computed yet"
+	try:
+		song = Song.objects.only('file_hash', 'url', 'file_size', 'file_mtime').get(id = song_id)
+	except Song.DoesNotExist:
+		return HttpResponseNotFound()
+
+	output_format = request.GET.get('format', 'json')
+	try:
+		peak_count = int(request.GET.get('peaks', _default_peaks))
+		if peak_count < 1 or output_format not in ('json', 'binary'):
+			raise ValueError
+
+	except ValueError:
+		return HttpResponseBadRequest()
+
+	key  = waveform.song_key(song)
+	etag = '"%s-%d-%s"' % (key, peak_count, output_format)
+	if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+		response = HttpResponseNotModified()
+		response["ETag"] = etag
+		return response
+
+	try:
+		level = waveform.read_peaks(waveform.waveform_path(key), peak_count)
+	except IOError:
+		return HttpResponseNotFound()
+
+	if output_format == 'json':
+		response = json(sample_rate = level["sample_rate"],
+		                total_frames = level["total_frames"],
+		                frames_per_peak = level["frames_per_peak"],
+		                peaks = level["peaks"].tolist())
+	else:
+		response = HttpResponse(level["peaks"].tostring(), content_type = "application/octet-stream")
+		response["X-Waveform-Sample-Rate"]     = str(level["sample_rate"])
+		response["X-Waveform-Total-Frames"]    = str(level["total_frames"])
+		response["X-Waveform-Frames-Per-Peak"] = str(level["frames_per_peak"])
+
+	response["ETag"] = etag
+	return response
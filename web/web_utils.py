@@ -1,9 +1,13 @@
 #Utilities file for the web client
 from django.utils import simplejson
 from django.http import HttpResponse
+from django.core.cache import cache
+from django.db.models import Q
 
 from archiver.models.playlist import Playlist
 
+import base64, threading, time
+
 def json_response(**kwargs):
 	#This is used to make sure that we have a standard json response
 	response = {}
@@ -16,11 +20,141 @@ def json_response(**kwargs):
 
 	return HttpResponse(simplejson.dumps(response))
 
-def template_resources():
-	"Return a dictionary of resources templates will need"
-	#For example, giving templates a reference to all playlists.
+#Template resources are cached in each process, and rebuilt when the version
+#counter in the shared Django cache moves on - see invalidate_template_resources
+_version_key = "melodia.template_resources.version"
+
+_resources_lock  = threading.Lock()
+_resources       = {"version": None, "resource_dict": None}
+_resources_stats = {"hits": 0, "misses": 0}
+
+def _resources_version():
+	"Current version of the template resources, shared between processes"
+	version = cache.get(_version_key)
+	if version is None:
+		#Never set, or evicted - start from a value no process has cached
+		version = int(time.time() * 1000)
+		cache.add(_version_key, version)
+		version = cache.get(_version_key, version)
+
+	return version
+
+def invalidate_template_resources(**kwargs):
+	"""
+	Make every process rebuild its template resources on the next render.
+	Connected to the signals of the models the resources are built from.
+	"""
+	try:
+		cache.incr(_version_key)
+	except ValueError:
+		#The counter isn't there, so nobody can be using it
+		pass
+
+def _build_template_resources():
 	resource_dict = {}
 
-	resource_dict.update({"playlist_list": Playlist.objects.all()})
+	#Templates only need the names, so leave the song lists in the database
+	resource_dict.update({"playlist_list": list(Playlist.objects.only('name'))})
 
 	return resource_dict
+
+def template_resources():
+	"""
+	Return a dictionary of resources templates will need. The dictionary is
+	cached in this process until the resources change, so rendering a page
+	doesn't query the database for them.
+	"""
+	#For example, giving templates a reference to all playlists.
+	version = _resources_version()
+
+	with _resources_lock:
+		if _resources["version"] == version:
+			_resources_stats["hits"] += 1
+			return dict(_resources["resource_dict"])
+
+		_resources_stats["misses"] += 1
+
+	resource_dict = _build_template_resources()
+	with _resources_lock:
+		_resources["version"]       = version
+		_resources["resource_dict"] = resource_dict
+
+	return dict(resource_dict)
+
+def template_resources_stats():
+	"Return the hit and miss counts of the template resources cache in this process"
+	with _resources_lock:
+		return dict(_resources_stats)
+
+_cursor_types = (basestring, int, long, float, bool, type(None))
+
+def encode_cursor(values):
+	"Turn the sort key values of the last row on a page into an opaque cursor string"
+	return base64.urlsafe_b64encode(simplejson.dumps(values))
+
+def decode_cursor(cursor):
+	"Reverse :func:`encode_cursor` - raises ValueError for a cursor we didn't make"
+	try:
+		values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+	except (TypeError, UnicodeError):
+		raise ValueError("Invalid cursor")
+
+	#Sort key values are only ever strings, numbers or null - anything else
+	#would end up in a filter()
+	if not isinstance(values, list) or not all(isinstance(value, _cursor_types) for value in values):
+		raise ValueError("Invalid cursor")
+
+	return values
+
+def _after(sort_keys, values):
+	"""
+	Build the filter for rows sorting after `values`. Equivalent to the row
+	comparison ``(key_1, ..., key_n) > (value_1, ..., value_n)``, written out
+	so every database understands it.
+	"""
+	after = Q()
+	for index in range(len(sort_keys)):
+		step = Q(**{sort_keys[index] + "__gt": values[index]})
+		for key, value in zip(sort_keys[:index], values[:index]):
+			step &= Q(**{key: value})
+		after |= step
+
+	#The redundant bound on the first key lets the database seek straight to
+	#the cursor's position in the index, rather than filtering from the start
+	return Q(**{sort_keys[0] + "__gte": values[0]}) & after
+
+def keyset_page(queryset, sort_keys, fields, cursor = None, limit = 50):
+	"""
+	Fetch one page of a queryset with keyset (seek) pagination. Instead of
+	an ``OFFSET``, each page carries on from the sort key values of the last
+	row of the previous page, so a deep page costs the same as the first one
+	as long as `sort_keys` is covered by an index. Only `fields` (plus the
+	sort keys) are selected.
+
+	:param queryset: The rows to page through
+	:param sort_keys: Tuple of field names that give a unique ordering
+	:param fields: Field names to return for each row
+	:param cursor: Cursor from the previous page, or None for the first page
+	:param limit: Maximum number of rows on the page
+	:rtype: Tuple of ``(rows, next_cursor)`` - ``rows`` is a list of
+	        dictionaries, and ``next_cursor`` is None on the last page.
+	:raises ValueError: If the cursor is invalid
+	"""
+	if cursor:
+		values = decode_cursor(cursor)
+		if len(values) != len(sort_keys):
+			raise ValueError("Invalid cursor")
+
+		queryset = queryset.filter(_after(sort_keys, values))
+
+	selected = list(fields) + [key for key in sort_keys if key not in fields]
+
+	#One extra row tells us whether there is another page
+	rows = list(queryset.order_by(*sort_keys).values(*selected)[:limit + 1])
+
+	next_cursor = None
+	if len(rows) > limit:
+		rows = rows[:limit]
+		next_cursor = encode_cursor([rows[-1][key] for key in sort_keys])
+
+	return ([dict((field, row[field]) for field in fields) for row in rows], next_cursor)